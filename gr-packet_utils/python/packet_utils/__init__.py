@@ -4,6 +4,7 @@
 
 from .packet_encoder_continuous import packet_encoder_continuous
 from .packet_decoder_continuous import packet_decoder_continuous
+from .packet_decoder_soft import packet_decoder_soft
 from .packet_tx_continuous import packet_tx_continuous
 from .packet_rx_continuous import packet_rx_continuous
 from .smart_multimedia_source import smart_multimedia_source
@@ -0,0 +1,84 @@
+"""
+Closed-loop ARQ for groups the erasure code could not recover.
+
+With arq=True the decoder outputs an unrecoverable group with its gaps (as
+without ARQ) and reports the missing data slots as a NACK on its "nack"
+message port; the encoder resends those frames from a bounded retransmit
+buffer between new data, and the decoder outputs them at their byte offset
+(OFFSET_TAG) once the group is whole. Unanswered NACKs are repeated a few
+times, then the group is given up. After END the encoder keeps answering
+NACKs (idle training frames in between) until arq_linger frames went by
+without one, and the decoder ends the stream once nothing is pending.
+Groups a resumed transfer skips (OFFSET_TAG jumps) are not lost: the encoder
+announces them in SKIP packets, and the decoder does not NACK them.
+
+NACKs are PDUs (empty metadata dict, u8vector), so any message transport
+carries them: a msg_connect in a one-machine loopback, blocks.socket_pdu
+over UDP, or the ZMQ message blocks between two machines. The payload is
+4 bytes per missing slot: the 24-bit group ID (big endian) and the slot ID,
+at most NACK_MAX_ENTRIES slots per PDU.
+"""
+import numpy as np
+import pmt
+
+NACK_PORT = "nack"
+NACK_ENTRY_BYTES = 4
+NACK_MAX_ENTRIES = 256 # Per PDU: 1 KB fits one UDP datagram on any link
+SKIP_COPIES = 4 # SKIP packets are not resent: every part goes out this many times
+
+def nack_pdu(group_ids, slot_ids):
+    """NACK PDU for the given (group ID, slot ID) pairs."""
+    group_ids = np.asarray(group_ids, dtype=np.uint32)
+    entries = np.empty((len(group_ids), NACK_ENTRY_BYTES), dtype=np.uint8)
+    entries[:, :3] = (group_ids[:, None] >> np.array([16, 8, 0], dtype=np.uint32)) & 0xFF
+    entries[:, 3] = slot_ids
+    return pmt.cons(pmt.make_dict(), pmt.init_u8vector(entries.size, entries.reshape(-1).tolist()))
+
+def nack_entries(msg):
+    """(group IDs, slot IDs) arrays of a NACK PDU. Raises ValueError if malformed."""
+    if not pmt.is_pair(msg):
+        raise ValueError("NACK is not a PDU")
+    payload = np.array(pmt.u8vector_elements(pmt.cdr(msg)), dtype=np.uint8)
+    if len(payload) % NACK_ENTRY_BYTES:
+        raise ValueError(f"NACK length {len(payload)} is not a multiple of {NACK_ENTRY_BYTES}")
+    entries = payload.reshape(-1, NACK_ENTRY_BYTES).astype(np.uint32)
+    return (entries[:, 0] << 16) | (entries[:, 1] << 8) | entries[:, 2], entries[:, 3].astype(np.uint8)
+
+class RetransmitBuffer:
+    """
+    Data frames of the last 'groups' groups, for resending. Group g lives in
+    ring row g % groups; a slot is valid while its recorded group ID matches.
+    """
+    def __init__(self, groups, slots, frame_len):
+        if groups < 1:
+            raise ValueError("the retransmit buffer needs at least 1 group")
+        self.groups = groups
+        self.slots = slots
+        self.frames = np.zeros((groups, slots, frame_len), dtype=np.uint8)
+        self.ids = np.zeros((groups, slots), dtype=np.uint32) # 0: empty (group IDs start at 1)
+
+    def store(self, group_ids, slot_ids, frames):
+        rows = group_ids % self.groups
+        self.frames[rows, slot_ids] = frames
+        self.ids[rows, slot_ids] = group_ids
+
+    def lookup(self, group_ids, slot_ids):
+        """Frames still held for the given (group ID, slot ID) pairs, in order."""
+        group_ids = np.asarray(group_ids, dtype=np.uint32)
+        slot_ids = np.asarray(slot_ids, dtype=np.int64)
+        ok = slot_ids < self.slots
+        rows = group_ids[ok] % self.groups
+        held = self.ids[rows, slot_ids[ok]] == group_ids[ok]
+        return self.frames[rows[held], slot_ids[ok][held]]
+
+class PendingGroup:
+    """A group output with gaps, waiting for the repairs of its NACK."""
+    def __init__(self, seq, slots, needed, now):
+        self.seq = seq # Groups since START (gives the byte offset)
+        self.slots = slots # SlotID -> payload received so far
+        self.needed = needed # Data slots not output yet
+        self.nack_at = now # Frame count of the last NACK
+        self.tries = 1
+
+    def missing(self):
+        return [i for i in self.needed if i not in self.slots]
@@ -0,0 +1,339 @@
+"""
+Headless benchmarks for the packet_utils TX/RX chain.
+
+Micro-benchmarks time the hot paths (Scrambler, CRC-32, Hamming74, Viterbi,
+hard and soft decoding, sync search, reference modem, make_packet, flush_group,
+metrics) in isolation. The loopback benchmark runs
+vector source -> packet_tx_continuous -> channels.channel_model ->
+packet_rx_continuous -> vector sink without a throttle or GUI and reports
+packets/s, bytes/s, CPU time per packet, CRC-fail and recovery rates. With
+--arq the receiver's NACKs go back to the transmitter (closed-loop ARQ, see
+arq.py), directly or through a blocks.socket_pdu pair on 127.0.0.1 (UDP).
+
+Results can be written as JSON and compared against a previous run:
+    python -m gnuradio.packet_utils.benchmark --json before.json
+    python -m gnuradio.packet_utils.benchmark --json after.json --compare before.json
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import threading
+import subprocess
+import numpy as np
+
+from .fec_utils import Scrambler, Hamming74, ConvolutionalCode, SyncDetector, SoftSyncDetector, get_crc32, \
+    crc32_batch, crc32_verify
+from .modem import FrameCodec, TYPE_DATA, EOF_TAG, OFFSET_TAG, inject_bit_errors, soft_channel
+from .profiling import PROFILE_ENV
+
+def timeit(fn, items, min_time=0.5):
+    """Runs fn() repeatedly for at least min_time seconds. Returns items/s and us/item."""
+    fn() # warm-up
+    calls = 0
+    wall0 = time.perf_counter()
+    while True:
+        fn()
+        calls += 1
+        elapsed = time.perf_counter() - wall0
+        if elapsed >= min_time:
+            break
+    rate = calls * items / elapsed
+    return {"items_per_s": rate, "us_per_item": 1e6 / rate, "calls": calls}
+
+def micro_benchmarks(n_frames=1024, min_time=0.5):
+    """Returns a list of {name, items, items_per_s, us_per_item} results."""
+    rng = np.random.default_rng(1)
+    results = []
+
+    def add(name, fn, items):
+        r = timeit(fn, items, min_time)
+        r.update(name=name, items=items)
+        results.append(r)
+        print(f"  {name:<36} {r['items_per_s']:>14,.0f} items/s  {r['us_per_item']:>9.3f} us/item")
+
+    # Scrambler: per-frame process() vs. one process_batch() over N x 27
+    scrambler = Scrambler(seed=0x7F)
+    frames = rng.integers(0, 256, (n_frames, 27), dtype=np.uint8)
+    def scramble_loop():
+        for row in frames:
+            scrambler.reset()
+            scrambler.process(row.tobytes())
+    add("scrambler.process (per frame)", scramble_loop, n_frames)
+    add("scrambler.process_batch", lambda: scrambler.process_batch(frames), n_frames)
+
+    # CRC-32: one binascii call per payload vs. the table-driven batch
+    payloads = rng.integers(0, 256, (n_frames, 10), dtype=np.uint8)
+    crcs = crc32_batch(payloads)
+    add("crc32 (per payload)", lambda: [get_crc32(row.tobytes()) for row in payloads], n_frames)
+    add("crc32_batch", lambda: crc32_batch(payloads), n_frames)
+    add("crc32_verify", lambda: crc32_verify(payloads, crcs), n_frames)
+
+    # Hamming(7,4): per-nibble calls vs. table-driven batch
+    fec = Hamming74()
+    codewords = fec.encode_bytes(payloads)
+    def hamming_loop():
+        for row in codewords.tolist():
+            bytes((fec.decode(row[2*i]) << 4) | fec.decode(row[2*i+1]) for i in range(10))
+    add("hamming74.decode (per nibble)", hamming_loop, n_frames)
+    add("hamming74.encode_bytes", lambda: fec.encode_bytes(payloads), n_frames)
+    add("hamming74.decode_bytes", lambda: fec.decode_bytes(codewords), n_frames)
+    soft_words = soft_channel(codewords, 1e-2, rng)
+    add("hamming74.decode_soft (ML)", lambda: fec.decode_soft(soft_words), n_frames)
+
+    # Convolutional K=7 r=1/2: batch encoder and Viterbi decoder
+    conv = ConvolutionalCode()
+    conv_words = conv.encode_bytes(payloads)
+    add("conv_k7.encode_bytes", lambda: conv.encode_bytes(payloads), n_frames)
+    add("conv_k7.decode_bytes (Viterbi)", lambda: conv.decode_bytes(conv_words), n_frames)
+    soft_conv = soft_channel(conv_words, 1e-2, rng)
+    add("conv_k7.decode_soft (Viterbi)", lambda: conv.decode_soft(soft_conv), n_frames)
+
+    # Sync search over an 8192-byte buffer (items = bytes)
+    buf = rng.integers(0, 256, 8192, dtype=np.uint8)
+    detector = SyncDetector(0xDEADBEEF)
+    add("sync search (8192 B buffer)", lambda: detector.search(buf, 2), len(buf))
+    soft_buf = rng.normal(0.0, 1.0, 8192).astype(np.float32)
+    soft_detector = SoftSyncDetector(0xDEADBEEF)
+    add("soft sync search (8192 bit buffer)", lambda: soft_detector.search(soft_buf), len(soft_buf))
+
+    # Reference modem: encode -> bit errors -> decode, no flowgraph
+    codec = FrameCodec()
+    def modem_roundtrip():
+        frames = codec.encode(TYPE_DATA, 1, 0, payloads)
+        inject_bit_errors(frames, 1e-3, rng)
+        codec.decode(frames[:, codec.preamble_len:codec.preamble_len + codec.span])
+    add("modem encode+errors+decode", modem_roundtrip, n_frames)
+    soft_frames = soft_channel(codec.encode(TYPE_DATA, 1, 0, payloads), 1e-2, rng)
+    soft_frames = soft_frames[:, 8 * codec.preamble_len:8 * (codec.preamble_len + codec.span)]
+    add("modem decode_soft (BER 1e-2, Chase)", lambda: codec.decode_soft(soft_frames), n_frames)
+
+    # Block-level paths (need the GNU Radio runtime)
+    try:
+        from .packet_encoder_continuous import packet_encoder_continuous
+        from .packet_decoder_continuous import packet_decoder_continuous
+    except ImportError as e:
+        print(f"  block-level benchmarks skipped (no GNU Radio runtime: {e})")
+        return results
+    enc = packet_encoder_continuous()
+    add("encoder.make_packet", lambda: enc.make_packet(payloads[0], 0x01, 1, 0), 1)
+
+    dec = packet_decoder_continuous()
+    out = np.zeros(dec.max_flush, dtype=np.uint8)
+    k = dec.parity_group_size
+    group = {i: payloads[i].copy() for i in range(k)}
+    group.update((k + i, row) for i, row in enumerate(dec.erasure.encode(payloads[:k])))
+    def flush_recover():
+        # Same group at the stream start every time: no offset tag (the
+        # decoder is not in a flowgraph, so it must not add tags)
+        dec.head_seq = 0
+        dec.out_offset = 0
+        dec.group_buffer[1] = dict(group)
+        del dec.group_buffer[1][1]
+        dec.flush_group(1, out, 0)
+    add("decoder.flush_group (1 recovery)", flush_recover, 1)
+
+    # Metrics cost per work call: latency observation + (not due) tick
+    def metrics_per_call():
+        dec.work_latency.observe(2e-4)
+        dec.metrics.tick()
+    add("decoder metrics (per work call)", metrics_per_call, 1)
+    return results
+
+def make_payload(size, seed=0, payload_len=10):
+    """
+    Random payload padded to whole encoder vectors the way the Smart Source
+    does it. Returns (data, stream); the EOF tag goes on the last vector.
+    """
+    data = np.random.default_rng(seed).integers(0, 256, size, dtype=np.uint8).tobytes()
+    align_pad = (payload_len - (size % payload_len)) % payload_len
+    return data, data + b"\x00" * align_pad
+
+def loopback(payload_size, noise_voltage, samples_per_symbol, timeout=600.0, payload_len=10,
+             fec="hamming74", soft=False, arq=None, arq_port=52001):
+    """
+    Runs one headless TX -> channel -> RX pass. Returns a result dict.
+    arq: None, "direct" (message connection) or "udp" (socket_pdu on arq_port).
+    """
+    from gnuradio import gr, blocks, channels
+    import pmt
+    from .packet_tx_continuous import packet_tx_continuous
+    from .packet_rx_continuous import packet_rx_continuous
+
+    data, stream = make_payload(payload_size, payload_len=payload_len)
+    tb = gr.top_block("packet_utils_benchmark", catch_exceptions=True)
+    eof = gr.tag_t()
+    eof.offset = len(stream) - payload_len
+    eof.key = pmt.intern(EOF_TAG)
+    eof.value = pmt.from_uint64(len(data))
+    src = blocks.vector_source_b(np.frombuffer(stream, dtype=np.uint8).tolist(), False, 1, [eof])
+    tx = packet_tx_continuous(samples_per_symbol=samples_per_symbol, payload_len=payload_len, fec=fec,
+                              arq=arq is not None)
+    chan = channels.channel_model(noise_voltage=noise_voltage, frequency_offset=0.0, epsilon=1.0,
+                                  taps=[1.0 + 1.0j], noise_seed=0, block_tags=False)
+    rx = packet_rx_continuous(samples_per_symbol=samples_per_symbol, payload_len=payload_len, soft=soft,
+                              arq=arq is not None)
+    sink = blocks.vector_sink_b()
+    tb.connect(src, tx, chan, rx, sink)
+    if arq == "direct":
+        tb.msg_connect(rx, "nack", tx, "nack")
+    elif arq == "udp":
+        # The return channel of a two-machine setup, on one machine
+        nack_in = blocks.socket_pdu("UDP_SERVER", "127.0.0.1", str(arq_port), 10000, False)
+        nack_out = blocks.socket_pdu("UDP_CLIENT", "127.0.0.1", str(arq_port), 10000, False)
+        tb.msg_connect(rx, "nack", nack_out, "pdus")
+        tb.msg_connect(nack_in, "pdus", tx, "nack")
+
+    cpu0 = time.process_time()
+    wall0 = time.perf_counter()
+    tb.start()
+    # The graph stops by itself (EOF tag -> END packets); the timeout is a safety net
+    done = threading.Event()
+    threading.Thread(target=lambda: (tb.wait(), done.set()), daemon=True).start()
+    if not done.wait(timeout):
+        print(f"  loopback timed out after {timeout:.0f} s")
+        tb.stop()
+        tb.wait()
+    wall = time.perf_counter() - wall0
+    cpu = time.process_time() - cpu0
+
+    dec = rx.decoder
+    received = bytes(sink.data())
+    if arq is not None:
+        # Repairs come out of order: put every byte at its offset and cut at the
+        # byte count, like the Smart Sink
+        received = place(received, sink.tags())[:len(data)]
+    got = received[:len(data)]
+    matched = np.count_nonzero(np.frombuffer(got, np.uint8) ==
+                               np.frombuffer(data[:len(got)], np.uint8))
+    frames = dec.training_rx + dec.start_rx + dec.data_rx + dec.parity_rx
+    groups = max(dec.data_rx // dec.parity_group_size, 1)
+    result = {
+        "payload_bytes": payload_size,
+        "noise_voltage": noise_voltage,
+        "samples_per_symbol": samples_per_symbol,
+        "payload_len": payload_len,
+        "fec": fec,
+        "soft": soft,
+        "arq": arq,
+        "wall_s": wall,
+        "cpu_s": cpu,
+        "frames_ok": frames,
+        "data_packets": dec.data_rx,
+        "packets_per_s": frames / wall,
+        "bytes_per_s": len(got) / wall,
+        "cpu_us_per_packet": 1e6 * cpu / max(frames, 1),
+        "crc_fail_rate": dec.crc_fail / max(frames + dec.crc_fail, 1),
+        "recovery_rate": dec.recovered_rx / groups,
+        "nack_tx": dec.nack_tx,
+        "repaired_rx": dec.repaired_rx,
+        "arq_lost": dec.arq_lost,
+        "bytes_delivered": len(got),
+        "byte_accuracy": matched / payload_size,
+        # The decoder cuts the alignment padding: a complete transfer is exact
+        "complete": received == data,
+    }
+    print(f"  {payload_size:>9} B  L {payload_len:<4} {fec:<9} {'soft' if soft else 'hard'} noise {noise_voltage:<5} sps {samples_per_symbol}  "
+          f"{result['packets_per_s']:>9.0f} pkt/s  {result['bytes_per_s'] / 1024:>8.1f} KB/s  "
+          f"{result['cpu_us_per_packet']:>7.1f} us/pkt  crc_fail {result['crc_fail_rate']:.3f}  "
+          f"recovered {result['recovery_rate']:.3f}  accuracy {result['byte_accuracy']:.4f}"
+          + (f"  arq {arq}: nack {dec.nack_tx} repaired {dec.repaired_rx} lost {dec.arq_lost}" if arq else ""))
+    return result
+
+def place(received, tags):
+    """Decoder output with every byte moved to its OFFSET_TAG offset (gaps zero)."""
+    import pmt
+    jumps = sorted((t.offset, pmt.to_uint64(t.value)) for t in tags if pmt.symbol_to_string(t.key) == OFFSET_TAG)
+    edges = [(0, 0)] + jumps + [(len(received), 0)]
+    pieces = [(offset, received[pos:end]) for (pos, offset), (end, _) in zip(edges, edges[1:])]
+    out = bytearray(max(offset + len(piece) for offset, piece in pieces))
+    for offset, piece in pieces:
+        out[offset:offset + len(piece)] = piece
+    return bytes(out)
+
+def metadata():
+    meta = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+    }
+    try:
+        from gnuradio import gr
+        meta["gnuradio"] = gr.version()
+    except Exception:
+        pass
+    try:
+        meta["commit"] = subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(__file__),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        pass
+    return meta
+
+def compare(results, baseline_file):
+    """Prints the speed-up of every result relative to a previous JSON run."""
+    with open(baseline_file) as f:
+        base = json.load(f)
+    print(f"\nComparison against {baseline_file} ({base['meta'].get('commit', '?')}):")
+    old = {r["name"]: r for r in base.get("micro", [])}
+    for r in results.get("micro", []):
+        if r["name"] in old:
+            print(f"  {r['name']:<36} x{r['items_per_s'] / old[r['name']]['items_per_s']:.2f}")
+    key = lambda r: (r["payload_bytes"], r["noise_voltage"], r["samples_per_symbol"],
+                     r.get("payload_len", 10), r.get("fec", "hamming74"), r.get("soft", False))
+    old = {key(r): r for r in base.get("loopback", [])}
+    for r in results.get("loopback", []):
+        if key(r) in old:
+            o = old[key(r)]
+            print(f"  loopback {key(r)}  pkt/s x{r['packets_per_s'] / o['packets_per_s']:.2f}  "
+                  f"cpu/pkt x{r['cpu_us_per_packet'] / o['cpu_us_per_packet']:.2f}  "
+                  f"crc_fail {o['crc_fail_rate']:.3f} -> {r['crc_fail_rate']:.3f}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="packet_utils headless benchmarks")
+    parser.add_argument("--micro-only", action="store_true", help="skip the loopback flowgraph")
+    parser.add_argument("--loopback-only", action="store_true", help="skip the micro-benchmarks")
+    parser.add_argument("--noise", type=float, nargs="+", default=[0.0, 0.2], help="channel noise voltages")
+    parser.add_argument("--payload-kb", type=float, nargs="+", default=[64], help="payload sizes in KB")
+    parser.add_argument("--sps", type=int, nargs="+", default=[2], help="samples per symbol")
+    parser.add_argument("--payload-len", type=int, nargs="+", default=[10], help="frame payload lengths in bytes")
+    parser.add_argument("--fec", nargs="+", default=["hamming74"], help="FEC codes (none, hamming74, conv_k7)")
+    parser.add_argument("--soft", action="store_true", help="soft-decision RX path in the loopback")
+    parser.add_argument("--arq", choices=("direct", "udp"),
+                        help="closed-loop ARQ in the loopback, NACKs over a message connection or UDP")
+    parser.add_argument("--min-time", type=float, default=0.5, help="seconds per micro-benchmark")
+    parser.add_argument("--timeout", type=float, default=600.0, help="seconds per loopback run")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--compare", help="previous JSON results to compare against")
+    parser.add_argument("--profile", metavar="DIR",
+                        help="profile the loopback blocks (stage tables, Chrome traces written to DIR)")
+    args = parser.parse_args(argv)
+
+    results = {"meta": metadata()}
+    if not args.loopback_only:
+        print("Micro-benchmarks:")
+        results["micro"] = micro_benchmarks(min_time=args.min_time)
+    if not args.micro_only:
+        if args.profile:
+            os.environ[PROFILE_ENV] = args.profile
+        print("Loopback:")
+        results["loopback"] = [
+            loopback(int(kb * 1024), noise, sps, args.timeout, plen, fec, args.soft, args.arq)
+            for kb in args.payload_kb for noise in args.noise for sps in args.sps
+            for plen in args.payload_len for fec in args.fec
+        ]
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.json}")
+    if args.compare:
+        compare(results, args.compare)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
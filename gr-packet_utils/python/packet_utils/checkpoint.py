@@ -0,0 +1,149 @@
+"""
+Resume checkpoints of interrupted or incomplete transfers.
+
+The Smart Sink records which erasure groups of a transfer reached the output
+file in a per-group bitmap, keyed by the content ID that the Smart Source puts
+into the START packets (see transcode_cache.content_id()). The checkpoint is
+a small JSON file next to the output (<filename>.resume). Given to the Smart
+Source as resume=<path>, it makes the source send only the groups still
+missing, each at its byte offset; the sink writes them into the same file and
+deletes the checkpoint once the file is complete.
+
+Group g covers transfer bytes [g * group_bytes, (g + 1) * group_bytes), with
+group_bytes = data_slots * payload_len, the signature included.
+
+Show what a checkpoint still misses:
+    python -m gnuradio.packet_utils.checkpoint show received.resume
+"""
+import os
+import sys
+import json
+import zlib
+import base64
+import argparse
+import numpy as np
+
+SUFFIX = ".resume"
+VERSION = 1
+
+class Checkpoint:
+    """Receive bitmap of one transfer (bit g set: group g is in the output file)."""
+    def __init__(self, content_id, group_bytes, bitmap, length=None, signature=b"", filename=""):
+        self.content_id = content_id
+        self.group_bytes = group_bytes
+        self.bitmap = np.asarray(bitmap, dtype=bool)
+        self.length = length # Transfer length, None until the END packets were seen
+        self.signature = signature
+        self.filename = filename
+
+    @classmethod
+    def from_ranges(cls, content_id, group_bytes, starts, ends, length=None, **kwargs):
+        """
+        Checkpoint of the groups completely covered by the received [start, end)
+        transfer byte ranges (sorted, not overlapping). The last group of a
+        transfer of known length may be short.
+        """
+        G = group_bytes
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        end = length if length is not None else int(ends[-1]) if len(ends) else 0
+        n = -(-end // G)
+        first = -(-starts // G)
+        last = ends // G
+        if length is not None:
+            last[ends >= length] = n
+        ok = first < last
+        delta = np.zeros(n + 1, dtype=np.int8)
+        np.add.at(delta, first[ok], 1)
+        np.add.at(delta, last[ok], -1)
+        bitmap = np.cumsum(delta[:n], dtype=np.int8) > 0
+        return cls(content_id, group_bytes, bitmap, length, **kwargs)
+
+    def ranges(self, length=None, missing=False):
+        """
+        [start, end) byte ranges of the groups received (missing=True: not
+        received) of a transfer of 'length' bytes (default: the checkpoint's);
+        groups past the bitmap count as missing.
+        """
+        G = self.group_bytes
+        length = self.length if length is None else length
+        if length is None:
+            length = len(self.bitmap) * G
+        n = -(-length // G)
+        bits = np.zeros(n, dtype=bool)
+        bits[:len(self.bitmap)] = self.bitmap[:n]
+        if missing:
+            bits = ~bits
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], bits.view(np.int8), [0]))))
+        return [(int(s) * G, min(int(e) * G, length)) for s, e in zip(edges[0::2], edges[1::2])]
+
+    def missing(self, length=None):
+        return self.ranges(length, missing=True)
+
+    def to_dict(self):
+        packed = np.packbits(self.bitmap).tobytes()
+        return {
+            "version": VERSION,
+            "content_id": f"{self.content_id:016x}",
+            "group_bytes": self.group_bytes,
+            "length": self.length,
+            "signature": self.signature.hex(),
+            "filename": self.filename,
+            "groups": len(self.bitmap),
+            "received_groups": int(np.count_nonzero(self.bitmap)),
+            "bitmap": base64.b64encode(zlib.compress(packed)).decode(),
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        if d.get("version") != VERSION:
+            raise ValueError(f"unsupported checkpoint version {d.get('version')}")
+        packed = np.frombuffer(zlib.decompress(base64.b64decode(d["bitmap"])), dtype=np.uint8)
+        bitmap = np.unpackbits(packed, count=d["groups"]).astype(bool)
+        return cls(int(d["content_id"], 16), d["group_bytes"], bitmap, d["length"],
+                   bytes.fromhex(d["signature"]), d["filename"])
+
+    def save(self, path):
+        """Writes the checkpoint atomically (a crash leaves the previous one)."""
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.to_dict(), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        """Reads a checkpoint; None if there is none or it is unreadable."""
+        try:
+            with open(path) as f:
+                return cls.from_dict(json.load(f))
+        except (OSError, ValueError, KeyError, zlib.error) as e:
+            if os.path.exists(path):
+                print(f"[Checkpoint] Ignoring {path}: {e}")
+            return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Smart Sink resume checkpoints")
+    sub = parser.add_subparsers(dest="command", required=True)
+    show = sub.add_parser("show", help="print the received and missing byte ranges")
+    show.add_argument("checkpoints", nargs="+")
+    args = parser.parse_args(argv)
+
+    for path in args.checkpoints:
+        cp = Checkpoint.load(path)
+        if cp is None:
+            print(f"{path}: no checkpoint")
+            continue
+        missing = cp.missing()
+        length = "unknown" if cp.length is None else f"{cp.length} bytes"
+        print(f"{path}: content {cp.content_id:016x}, {cp.filename}, {length}, "
+              f"{int(np.count_nonzero(cp.bitmap))}/{len(cp.bitmap)} groups of {cp.group_bytes} bytes")
+        for start, end in missing[:20]:
+            print(f"  missing {start}-{end} ({end - start} bytes)")
+        if len(missing) > 20:
+            print(f"  ... {len(missing) - 20} more ranges")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
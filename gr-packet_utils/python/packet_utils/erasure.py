@@ -0,0 +1,124 @@
+"""
+Systematic Reed-Solomon style erasure code over GF(256).
+
+A group has k data slots followed by m parity slots. Parity row i is
+sum_j C[i][j] * data[j] (GF(256) arithmetic), where C is an m x k Cauchy
+matrix scaled so that its first row is all ones: with m = 1 the parity is the
+plain XOR of the data slots. Every k x k submatrix of [I; C] is invertible,
+so any k received slots of a group recover all k data slots.
+
+The last group of a stream may carry fewer than k data slots; the missing
+ones count as zeros and the shortfall is carried in the parity slot IDs
+(see parity_slot_ids), so the receiver never outputs the padding.
+
+All arithmetic is table driven: a 256 x 256 multiplication table applied with
+NumPy fancy indexing over whole payload rows.
+"""
+import numpy as np
+
+GF_POLY = 0x11D
+
+def _build_tables():
+    exp = np.zeros(512, dtype=np.int32)
+    log = np.zeros(256, dtype=np.int32)
+    x = 1
+    for i in range(255):
+        exp[i] = x
+        log[x] = i
+        x <<= 1
+        if x & 0x100:
+            x ^= GF_POLY
+    exp[255:510] = exp[:255]
+    mul = exp[(log[:, None] + log[None, :]) % 255].astype(np.uint8)
+    mul[0, :] = 0
+    mul[:, 0] = 0
+    return exp, log, mul
+
+GF_EXP, GF_LOG, GF_MUL = _build_tables()
+
+def gf_inv(a):
+    return int(GF_EXP[255 - GF_LOG[a]])
+
+def gf_mul(a, b):
+    return int(GF_MUL[a, b])
+
+def gf_matrix_inverse(m):
+    """Inverts a square GF(256) matrix (list of lists) by Gauss-Jordan elimination."""
+    n = len(m)
+    a = [list(row) + [1 if i == j else 0 for j in range(n)] for i, row in enumerate(m)]
+    for col in range(n):
+        pivot = next((r for r in range(col, n) if a[r][col]), None)
+        if pivot is None:
+            raise ValueError("singular matrix")
+        a[col], a[pivot] = a[pivot], a[col]
+        inv = gf_inv(a[col][col])
+        a[col] = [gf_mul(v, inv) for v in a[col]]
+        for r in range(n):
+            if r != col and a[r][col]:
+                f = a[r][col]
+                a[r] = [v ^ gf_mul(f, p) for v, p in zip(a[r], a[col])]
+    return [row[n:] for row in a]
+
+class ErasureCode:
+    """(k data + m parity) systematic erasure code over GF(256)."""
+    def __init__(self, k=4, m=1):
+        # Slot IDs (incl. the partial-group parity IDs) must fit in one byte
+        if k < 1 or m < 0 or k * (m + 1) > 256:
+            raise ValueError(f"invalid erasure code ({k}, {m})")
+        self.k = k
+        self.m = m
+        # Cauchy matrix C[i][j] = 1 / (x_i + y_j), x_i = k + i, y_j = j,
+        # with every column scaled so that row 0 is all ones (XOR parity)
+        cauchy = [[gf_inv((k + i) ^ j) for j in range(k)] for i in range(m)]
+        if m:
+            scale = [gf_inv(c) for c in cauchy[0]]
+            cauchy = [[gf_mul(c, s) for c, s in zip(row, scale)] for row in cauchy]
+        self.coeffs = np.array(cauchy, dtype=np.uint8).reshape(m, k)
+        # Generator matrix rows: identity for data slots, then parity slots
+        self.generator = np.vstack([np.eye(k, dtype=np.uint8), self.coeffs])
+        self._decoders = {}
+
+    def parity_slot_ids(self, n_data=None):
+        """Slot IDs of the m parity packets of a group with n_data (<= k) data slots."""
+        n_data = self.k if n_data is None else n_data
+        return self.k + (self.k - n_data) * self.m + np.arange(self.m)
+
+    def parse_slot_id(self, slot_id):
+        """Maps a received slot ID to (slot, n_data); parity slots become k..k+m-1."""
+        if slot_id < self.k or not self.m:
+            return slot_id, None
+        offset = slot_id - self.k
+        return self.k + offset % self.m, self.k - offset // self.m
+
+    def _combine(self, matrix, rows):
+        """GF(256) product matrix (r x n) . rows (..., n, L) -> (..., r, L)."""
+        out = np.zeros(rows.shape[:-2] + (len(matrix), rows.shape[-1]), dtype=np.uint8)
+        for i, coeffs in enumerate(matrix):
+            for j, c in enumerate(coeffs):
+                if c == 1:
+                    out[..., i, :] ^= rows[..., j, :]
+                elif c:
+                    out[..., i, :] ^= GF_MUL[c][rows[..., j, :]]
+        return out
+
+    def encode(self, data):
+        """Parity slots for data of shape (..., k, L). Returns (..., m, L)."""
+        return self._combine(self.coeffs, np.asarray(data, dtype=np.uint8))
+
+    def decode(self, slots):
+        """
+        Recovers the k data slots of one group from a {slot_id: payload} dict.
+        Returns a (k, L) array, or None when fewer than k slots are present.
+        """
+        present = sorted(s for s in slots if s < self.k + self.m)
+        if all(s in slots for s in range(self.k)):
+            return np.array([slots[s] for s in range(self.k)], dtype=np.uint8)
+        if len(present) < self.k:
+            return None
+        use = tuple(present[:self.k])
+        inverse = self._decoders.get(use)
+        if inverse is None:
+            inverse = np.array(gf_matrix_inverse(self.generator[list(use)].tolist()), dtype=np.uint8)
+            self._decoders[use] = inverse
+        received = np.array([slots[s] for s in use], dtype=np.uint8)
+        return self._combine(inverse, received)
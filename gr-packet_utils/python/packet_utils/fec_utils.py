@@ -3,31 +3,73 @@ import numpy as np
 import binascii
 
 class Scrambler:
-    """Additive Scrambler using an LFSR P(x) = x^7 + x^4 + 1"""
+    """Additive Scrambler using an LFSR P(x) = x^7 + x^4 + 1
+
+    The 7-bit LFSR has a period of 127 bits, and since 8 and 127 are coprime
+    the byte keystream repeats every 127 bytes. The keystream is generated
+    once per seed and applied with a NumPy XOR, either to a single buffer
+    (process) or to every row of an N x L batch of frames (process_batch).
+    """
+    PERIOD = 127
+    _keystreams = {}  # seed -> one period of keystream bytes
+
     def __init__(self, seed=0x7F):
         self.seed = seed
+        self.keystream = self._period(seed)
+        self._masks = {}  # length -> keystream[0:length] (wrapped)
         self.reset()
-        
+
+    @classmethod
+    def _period(cls, seed):
+        ks = cls._keystreams.get(seed)
+        if ks is None:
+            state = seed
+            ks = np.empty(cls.PERIOD, dtype=np.uint8)
+            for n in range(cls.PERIOD):
+                out = 0
+                for i in range(8):
+                    feedback = ((state >> 6) ^ (state >> 3)) & 1
+                    out = (out << 1) | (state & 1)
+                    state = ((state << 1) & 0x7F) | feedback
+                ks[n] = out
+            ks.flags.writeable = False
+            cls._keystreams[seed] = ks
+        return ks
+
     def reset(self):
-        self.state = self.seed
-        
+        self.pos = 0
+
+    def mask(self, length):
+        """Keystream bytes 0..length-1 (i.e. right after reset())."""
+        m = self._masks.get(length)
+        if m is None:
+            m = np.resize(self.keystream, length)
+            m.flags.writeable = False
+            self._masks[length] = m
+        return m
+
     def next_byte(self):
-        out = 0
-        for i in range(8):
-            feedback = ((self.state >> 6) ^ (self.state >> 3)) & 1
-            out = (out << 1) | (self.state & 1)
-            self.state = ((self.state << 1) & 0x7F) | feedback
+        out = int(self.keystream[self.pos])
+        self.pos = (self.pos + 1) % self.PERIOD
         return out
 
     def process(self, data):
-        data_bytes = bytes(data)
-        out = bytearray()
-        for b in data_bytes:
-            out.append(b ^ self.next_byte())
-        return bytes(out)
+        arr = np.frombuffer(bytes(data), dtype=np.uint8)
+        n = len(arr)
+        ks = np.roll(self.keystream, -self.pos) if self.pos else self.keystream
+        out = arr ^ np.resize(ks, n)
+        self.pos = (self.pos + n) % self.PERIOD
+        return out.tobytes()
+
+    def process_batch(self, frames):
+        """Scrambles every row of an N x L uint8 array as if reset() preceded it."""
+        frames = np.asarray(frames, dtype=np.uint8)
+        return frames ^ self.mask(frames.shape[-1])
 
 class Hamming74:
     """Standard Hamming (7,4) implementation with single bit error correction"""
+    name = "hamming74"
+
     def __init__(self):
         # Encoding table for 4 bits -> 8 bits (using 7 bits actually, 8th is 0)
         # Generator matrix G = [I | P]
@@ -43,15 +85,352 @@ class Hamming74:
             for bit in range(7):
                 self.dec_table[codeword ^ (1 << bit)] = nibble
 
+        # Batch lookup arrays (NumPy fancy indexing)
+        # enc_lut: byte -> [codeword(high nibble), codeword(low nibble)]
+        enc = np.array(self.enc_table, dtype=np.uint8)
+        values = np.arange(256)
+        self.enc_lut = np.stack([enc[values >> 4], enc[values & 0x0F]], axis=1)
+
+        # dec_lut: 7-bit codeword -> nibble (unknown words decode to 0, as in decode())
+        self.dec_lut = np.zeros(128, dtype=np.uint8)
+        for codeword, nibble in self.dec_table.items():
+            self.dec_lut[codeword] = nibble
+
+        # err_lut: 7-bit codeword -> bits flipped to reach the decoded codeword
+        popcount = np.array([bin(v).count("1") for v in range(128)], dtype=np.uint8)
+        self.err_lut = popcount[np.arange(128) ^ enc[self.dec_lut]]
+
+        # Soft decoding: codewords as +-1 columns (8 x 16) and as bytes
+        self.codewords = enc
+        self.soft_codebook = (2.0 * np.unpackbits(enc[:, None], axis=1) - 1.0).astype(np.float32).T
+
     def encode(self, nibble):
         return self.enc_table[nibble & 0x0F]
 
     def decode(self, codeword):
         return self.dec_table.get(codeword & 0x7F, 0)
 
+    def coded_len(self, length):
+        return 2 * length
+
+    def encode_bytes(self, data):
+        """Encodes an (..., L) uint8 array into (..., 2L) codewords, high nibble first."""
+        data = np.asarray(data, dtype=np.uint8)
+        return self.enc_lut[data].reshape(data.shape[:-1] + (2 * data.shape[-1],))
+
+    def decode_bytes(self, codewords):
+        """
+        Decodes an (..., 2L) codeword array back to (..., L) bytes.
+        Returns (data, corrected) where corrected holds the number of bit
+        errors corrected in each row.
+        """
+        cw = np.asarray(codewords, dtype=np.uint8) & 0x7F
+        nibbles = self.dec_lut[cw]
+        data = (nibbles[..., 0::2] << 4) | nibbles[..., 1::2]
+        corrected = self.err_lut[cw].sum(axis=-1, dtype=np.int64)
+        return data, corrected
+
+    def decode_soft(self, soft):
+        """
+        Maximum-likelihood decoding of soft bits (..., 16L) floats, MSB first
+        per codeword byte, positive = 1. Every codeword is correlated with the
+        16 +-1 code words (one matrix product) and the best one wins.
+        Returns (data, corrected) like decode_bytes.
+        """
+        soft = np.asarray(soft, dtype=np.float32)
+        words = soft.reshape(soft.shape[:-1] + (soft.shape[-1] // 8, 8))
+        scores = words.reshape(-1, 8) @ self.soft_codebook # One 2-D product (BLAS)
+        nibbles = np.argmax(scores, axis=-1).astype(np.uint8).reshape(words.shape[:-1])
+        data = (nibbles[..., 0::2] << 4) | nibbles[..., 1::2]
+        # Corrected = hard decisions (7 code bits) that differ from the chosen code word
+        hard = np.packbits(words > 0, axis=-1)[..., 0] & 0x7F
+        corrected = POPCOUNT8[hard ^ self.codewords[nibbles]].sum(axis=-1, dtype=np.int64)
+        return data, corrected
+
+# Number of set bits in every byte value
+POPCOUNT8 = np.array([bin(v).count("1") for v in range(256)], dtype=np.uint8)
+
+class NoFEC:
+    """No FEC for clean links: the payload goes on air as is (CRC-32 only)."""
+    name = "none"
+
+    def coded_len(self, length):
+        return length
+
+    def encode_bytes(self, data):
+        return np.asarray(data, dtype=np.uint8)
+
+    def decode_bytes(self, codewords):
+        data = np.asarray(codewords, dtype=np.uint8)
+        return data, np.zeros(data.shape[:-1], dtype=np.int64)
+
+    def decode_soft(self, soft):
+        return self.decode_bytes(np.packbits(np.asarray(soft) > 0, axis=-1))
+
+class ConvolutionalCode:
+    """
+    Rate 1/2, constraint length 7 convolutional code (generators 133/171 octal)
+    with hard- or soft-decision Viterbi decoding. Every row is terminated with 6 zero
+    tail bits, so L bytes become 2L + 2 coded bytes. Encoder and Viterbi
+    decoder run over all rows of a batch at once (one NumPy step per bit).
+    """
+    name = "conv_k7"
+    K = 7
+    G0 = 0o133
+    G1 = 0o171
+
+    def __init__(self):
+        # Output bit pair of every 7-bit register value (newest input bit = LSB)
+        regs = np.arange(1 << self.K)
+        self.out_lut = np.stack([POPCOUNT8[regs & self.G0] & 1,
+                                 POPCOUNT8[regs & self.G1] & 1], axis=1).astype(np.uint8)
+        # Branch metric (bit differences) of a received pair 0..3 against every register value
+        pairs = np.array([[0, 0], [0, 1], [1, 0], [1, 1]], dtype=np.uint8)
+        self.branch_lut = (pairs[:, None, :] != self.out_lut[None, :, :]).sum(axis=2).astype(np.int32)
+        # State s (last 6 input bits) is reached from (s >> 1) | (x << 5), register s + 64 * x
+        states = np.arange(1 << (self.K - 1))
+        self.prev0 = states >> 1
+        self.prev1 = (states >> 1) | (1 << (self.K - 2))
+
+    def coded_len(self, length):
+        return (2 * (8 * length + self.K - 1) + 7) // 8
+
+    def encode_bits(self, bits):
+        """(N, T) input bits, tail included -> (N, 2T) coded bits."""
+        n, t = bits.shape
+        padded = np.concatenate([np.zeros((n, self.K - 1), dtype=np.uint8), bits], axis=1)
+        reg = np.zeros((n, t), dtype=np.intp)
+        for i in range(self.K):
+            reg |= padded[:, self.K - 1 - i:self.K - 1 - i + t].astype(np.intp) << i
+        return self.out_lut[reg].reshape(n, 2 * t)
+
+    def encode_bytes(self, data):
+        """Encodes an (..., L) uint8 array into (..., 2L + 2) coded bytes."""
+        data = np.asarray(data, dtype=np.uint8)
+        rows = data.reshape(-1, data.shape[-1])
+        bits = np.unpackbits(rows, axis=1)
+        bits = np.concatenate([bits, np.zeros((len(rows), self.K - 1), dtype=np.uint8)], axis=1)
+        coded = np.packbits(self.encode_bits(bits), axis=1)
+        return coded.reshape(data.shape[:-1] + (coded.shape[-1],))
+
+    def decode_bytes(self, codewords):
+        """
+        Viterbi-decodes an (..., 2L + 2) array back to (..., L) bytes.
+        Returns (data, corrected) where corrected holds the number of coded
+        bits that differ from the re-encoded decision in each row.
+        """
+        cw = np.asarray(codewords, dtype=np.uint8)
+        shape = cw.shape[:-1]
+        length = (cw.shape[-1] - 2) // 2
+        cw = cw.reshape(-1, cw.shape[-1])
+        t = 8 * length + self.K - 1
+        bits = np.unpackbits(cw, axis=1)[:, :2 * t]
+        pairs = bits[:, 0::2] * 2 + bits[:, 1::2]
+        out = self._viterbi(len(cw), t, lambda k: self.branch_lut[pairs[:, k]], np.int32)
+        data = np.packbits(out[:, :8 * length], axis=1)
+        corrected = np.count_nonzero(self.encode_bits(out) != bits, axis=1).astype(np.int64)
+        return data.reshape(shape + (length,)), corrected.reshape(shape)
+
+    def decode_soft(self, soft):
+        """
+        Soft-decision Viterbi decoding of (..., 8 * (2L + 2)) floats
+        (positive = 1): the branch metric is minus the correlation of the
+        received pair with the +-1 code bits. Returns (data, corrected).
+        """
+        soft = np.asarray(soft, dtype=np.float32)
+        shape = soft.shape[:-1]
+        length = (soft.shape[-1] // 8 - 2) // 2
+        soft = soft.reshape(-1, soft.shape[-1])
+        t = 8 * length + self.K - 1
+        y0, y1 = soft[:, 0:2 * t:2], soft[:, 1:2 * t:2]
+        s0, s1 = 2.0 * self.out_lut[:, 0] - 1.0, 2.0 * self.out_lut[:, 1] - 1.0
+        out = self._viterbi(len(soft), t, lambda k: -(y0[:, k, None] * s0 + y1[:, k, None] * s1),
+                            np.float32)
+        data = np.packbits(out[:, :8 * length], axis=1)
+        corrected = np.count_nonzero(self.encode_bits(out) != (soft[:, :2 * t] > 0), axis=1).astype(np.int64)
+        return data.reshape(shape + (length,)), corrected.reshape(shape)
+
+    def _viterbi(self, n, t, branch_at, dtype):
+        """
+        Add-compare-select over n rows and all states for t input bits;
+        branch_at(k) gives the (n, 128) branch metrics of step k per register
+        value. Returns the decided (n, t) input bits (tail included).
+        """
+        metric = np.full((n, 1 << (self.K - 1)), 1 << 24, dtype=dtype)
+        metric[:, 0] = 0
+        decisions = np.empty((t, n, 1 << (self.K - 1)), dtype=bool)
+        half = 1 << (self.K - 1)
+        for k in range(t):
+            branch = branch_at(k)
+            c0 = metric[:, self.prev0] + branch[:, :half]
+            c1 = metric[:, self.prev1] + branch[:, half:]
+            decisions[k] = c1 < c0
+            metric = np.minimum(c0, c1)
+
+        # Traceback from the all-zero state the tail bits force
+        state = np.zeros(n, dtype=np.intp)
+        rows = np.arange(n)
+        out = np.empty((n, t), dtype=np.uint8)
+        for k in range(t - 1, -1, -1):
+            out[:, k] = state & 1
+            state = (state >> 1) | (decisions[k, rows, state].astype(np.intp) << (self.K - 2))
+        return out
+
+# FEC registry. The code ID travels in the upper nibble of the frame type byte,
+# so the receiver picks the decoder per packet (ID 0, Hamming(7,4), is the default).
+# Every code codes the whole header, payload and CRC as one block.
+FEC_CODES = {0: Hamming74, 1: NoFEC, 2: ConvolutionalCode}
+FEC_IDS = {cls.name: code_id for code_id, cls in FEC_CODES.items()}
+
+class SyncDetector:
+    """
+    Vectorized soft sync search.
+    Computes the Hamming distance between a 32-bit sync word and the 32 bits
+    starting at every bit offset of a byte buffer in a single NumPy pass.
+    When the absolute stream offset of the buffer is given, distances already
+    computed for the overlapping (unconsumed) part of the previous buffer are
+    reused instead of being recomputed.
+    """
+    NO_MATCH = 0xFF
+
+    def __init__(self, sync_word=0xDEADBEEF):
+        self.sync_word = sync_word & 0xFFFFFFFF
+        self._cache_start = 0
+        self._cache = np.zeros((0, 8), dtype=np.uint8)
+
+    def _compute(self, data):
+        # dist[i, s] covers bits [8*i + s, 8*i + s + 32), i.e. bytes i..i+4
+        n = len(data) - 3
+        if n <= 0:
+            return np.zeros((0, 8), dtype=np.uint8)
+        b = np.zeros(len(data) + 1, dtype=np.uint64)
+        b[:-1] = data
+        words = (b[:n] << 32) | (b[1:n + 1] << 24) | (b[2:n + 2] << 16) | \
+                (b[3:n + 3] << 8) | b[4:n + 4]
+        shifts = np.arange(8, 0, -1, dtype=np.uint64)
+        windows = ((words[:, None] >> shifts) & 0xFFFFFFFF).astype(np.uint32)
+        windows ^= np.uint32(self.sync_word)
+        dist = POPCOUNT8[windows.view(np.uint8)].reshape(n, 8, 4).sum(axis=2, dtype=np.uint8)
+        # The last row only has a full window at shift 0
+        dist[-1, 1:] = self.NO_MATCH
+        return dist
+
+    def distances(self, data, offset=None):
+        """
+        Returns an (len(data) - 3, 8) array of Hamming distances indexed by
+        [byte_index, bit_shift]. offset is the absolute stream position of
+        data[0]; pass it to enable reuse across calls.
+        """
+        data = np.frombuffer(data, dtype=np.uint8) if isinstance(data, (bytes, bytearray)) else data
+        if offset is None:
+            return self._compute(data)
+
+        cached = self._cache
+        reuse = 0
+        rel = offset - self._cache_start
+        if 0 <= rel < len(cached):
+            reuse = min(len(cached) - rel, max(len(data) - 4, 0))
+        if reuse > 0:
+            dist = np.concatenate([cached[rel:rel + reuse], self._compute(data[reuse:])])
+        else:
+            dist = self._compute(data)
+
+        # Cache only rows whose 5 bytes were all available
+        self._cache_start = offset
+        self._cache = dist[:max(len(data) - 4, 0)]
+        return dist
+
+    def search(self, data, threshold=2, offset=None):
+        """
+        Returns every candidate as (byte_index, bit_shift, distance) arrays,
+        ordered by bit position.
+        """
+        dist = self.distances(data, offset)
+        byte_idx, bit_shift = np.nonzero(dist <= threshold)
+        return byte_idx, bit_shift, dist[byte_idx, bit_shift]
+
+class SoftSyncDetector:
+    """
+    Sync search over soft bits (one float per bit, positive = 1).
+    The metric at every bit offset is the normalized correlation
+    sum(y * s) / sum(|y|) with the +-1 sync pattern s: 1.0 is a perfect
+    match, and bits the demodulator was unsure of weigh less than confident
+    ones (a hard search counts both alike).
+    """
+    def __init__(self, sync_word=0xDEADBEEF):
+        bits = (np.uint64(sync_word & 0xFFFFFFFF) >> np.arange(31, -1, -1, dtype=np.uint64)) & np.uint64(1)
+        self.pattern = (2.0 * bits - 1.0).astype(np.float32)
+
+    def metrics(self, soft):
+        """Normalized correlation at every offset, (len(soft) - 31,) floats."""
+        soft = np.asarray(soft, dtype=np.float32)
+        if len(soft) < 32:
+            return np.zeros(0, dtype=np.float32)
+        corr = np.correlate(soft, self.pattern, mode="valid")
+        mag = np.convolve(np.abs(soft), np.ones(32, dtype=np.float32), mode="valid")
+        return corr / np.maximum(mag, 1e-12)
+
+    def search(self, soft, threshold=0.8):
+        """Returns every candidate as (bit_position, metric) arrays, in order."""
+        metric = self.metrics(soft)
+        pos = np.flatnonzero(metric >= threshold)
+        return pos, metric[pos]
+
 def get_crc32(data):
     return binascii.crc32(data) & 0xFFFFFFFF
 
-# 10-byte sentinel the source appends after the flush tail.
-# The encoder watches for this pattern to trigger END packets.
-EOF_SENTINEL = bytes([0xDE, 0xAD, 0xBE, 0xEF, 0xCA, 0xFE, 0xBA, 0xBE, 0xF0, 0x0D])
+def _crc32_byte_table():
+    t = np.arange(256, dtype=np.uint32)
+    for _ in range(8):
+        t = np.where(t & 1, (t >> 1) ^ np.uint32(0xEDB88320), t >> 1)
+    return t.astype(np.uint32)
+
+# Byte-wise table of the reflected CRC-32 (polynomial 0xEDB88320, as binascii/zlib)
+CRC32_TABLE = _crc32_byte_table()
+# Longest rows that go through the position tables; beyond that the per-row
+# C loop of binascii is faster than the N x L table gather
+CRC32_TABLE_MAX_LEN = 128
+_crc32_tables = {} # row length -> (flat length*256 position tables, offsets, CRC-32 of 'length' zero bytes)
+
+def crc32_tables(length):
+    """
+    Slice-by-L tables for rows of 'length' bytes. CRC-32 is affine over GF(2),
+    so crc(row) = crc(zeros) ^ XOR_i T[i, row[i]], where T[i, b] is the
+    register contribution of byte b at position i (the byte table advanced
+    over the length - 1 - i zero bytes that follow it). Built once per
+    length; T is returned flattened with the row offsets 256 * i.
+    """
+    cached = _crc32_tables.get(length)
+    if cached is None:
+        tables = np.empty((length, 256), dtype=np.uint32)
+        t = CRC32_TABLE
+        for i in range(length - 1, -1, -1):
+            tables[i] = t
+            t = CRC32_TABLE[t & 0xFF] ^ (t >> 8)
+        tables.flags.writeable = False
+        offsets = np.arange(length, dtype=np.intp) * 256
+        cached = _crc32_tables[length] = (tables.reshape(-1), offsets, np.uint32(get_crc32(bytes(length))))
+    return cached
+
+def crc32_batch(rows):
+    """
+    CRC-32 of every row of an N x L uint8 array, bit-exact with
+    binascii.crc32. Rows up to CRC32_TABLE_MAX_LEN bytes take one table
+    gather and one XOR reduction for the whole batch.
+    """
+    rows = np.asarray(rows, dtype=np.uint8)
+    if rows.shape[-1] > CRC32_TABLE_MAX_LEN:
+        return np.array([binascii.crc32(row) & 0xFFFFFFFF for row in rows.reshape(-1, rows.shape[-1])],
+                        dtype=np.uint32).reshape(rows.shape[:-1])
+    tables, offsets, zero_crc = crc32_tables(rows.shape[-1])
+    return np.bitwise_xor.reduce(tables[rows + offsets], axis=-1) ^ zero_crc
+
+def crc32_verify(rows, crc):
+    """
+    True for every row of 'rows' whose CRC-32 equals 'crc' (N uint32 values,
+    or N x 4 big-endian bytes as carried in the frames).
+    """
+    crc = np.asarray(crc)
+    if crc.dtype == np.uint8:
+        crc = np.ascontiguousarray(crc).view(">u4")[..., 0]
+    return crc32_batch(rows) == crc
@@ -0,0 +1,134 @@
+"""
+Block-parallel LZMA framing for large general files.
+
+The file is split into fixed-size chunks that are compressed independently on
+a thread pool (lzma releases the GIL), so compression scales with cores.
+Stream layout after the 'FLP\x00' signature:
+
+    [chunk index u32][raw offset u64][compressed length u32][LZMA data] ...
+
+A header with compressed length 0 (e.g. the zero padding after the last
+chunk) ends the chunk list. The sink decompresses chunks concurrently and
+writes each one at its raw offset; a chunk cut by lost data is dropped and
+the chunks after it still decode.
+"""
+import os
+import lzma
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+CHUNK_SIGNATURE = b"FLP\x00"
+CHUNK_HEADER = struct.Struct(">IQI")
+XZ_MAGIC = b"\xfd7zXZ\x00" # Start of every lzma.compress() chunk (FORMAT_XZ)
+
+def compress_chunks(f, chunk_size, threads=None):
+    """
+    Reads file object 'f' chunk by chunk and yields framed, compressed chunks
+    (header, data) in order. At most 2 * threads chunks are in flight.
+    """
+    threads = threads or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        pending = deque()
+        index = 0
+        offset = 0
+        while True:
+            raw = f.read(chunk_size)
+            if raw:
+                pending.append((index, offset, pool.submit(lzma.compress, raw)))
+                index += 1
+                offset += len(raw)
+            while pending and (not raw or len(pending) >= 2 * threads):
+                i, off, fut = pending.popleft()
+                data = fut.result()
+                yield CHUNK_HEADER.pack(i, off, len(data)), data
+            if not raw:
+                break
+
+class ChunkParser:
+    """
+    Incremental parser for the chunked stream. feed() returns the list of
+    completed (index, offset, compressed data) chunks.
+
+    The stream may have gaps (groups lost on the air): feed() takes the stream
+    offset of its data. A chunk hit by a gap is dropped and parsing resumes
+    at the next chunk, found from the length in the dropped chunk's header or,
+    when that header was lost too, by scanning for a header followed by the
+    XZ magic that starts every compressed chunk.
+    """
+    def __init__(self):
+        self.buf = bytearray()
+        self.buf_start = 0 # Stream offset of buf[0]
+        self.next_chunk = 0 # Stream offset of the next chunk header, None while scanning
+        self.last_index = -1
+        self.dropped = 0 # Chunks cut by a gap (that a header was seen of)
+        self.done = False
+
+    def drop(self, n):
+        del self.buf[:n]
+        self.buf_start += n
+
+    def gap(self, offset):
+        """Data resumes at stream offset 'offset', after a gap."""
+        next_chunk = None
+        if len(self.buf) >= CHUNK_HEADER.size and self.next_chunk == self.buf_start:
+            # The chunk in progress is cut; the next one starts after it
+            next_chunk = self.buf_start + CHUNK_HEADER.size + CHUNK_HEADER.unpack_from(self.buf)[2]
+            self.dropped += 1
+        self.buf.clear()
+        self.buf_start = offset
+        self.next_chunk = next_chunk if next_chunk is not None and next_chunk >= offset else None
+
+    def resync(self):
+        """Scans for the next chunk header; False until one is found."""
+        pos = self.buf.find(XZ_MAGIC, CHUNK_HEADER.size)
+        while pos >= 0:
+            index, _, length = CHUNK_HEADER.unpack_from(self.buf, pos - CHUNK_HEADER.size)
+            if index > self.last_index and length >= len(XZ_MAGIC):
+                self.drop(pos - CHUNK_HEADER.size)
+                self.next_chunk = self.buf_start
+                return True
+            pos = self.buf.find(XZ_MAGIC, pos + 1)
+        # Keep what could be the start of a header straddling the next data
+        self.drop(max(len(self.buf) - CHUNK_HEADER.size - len(XZ_MAGIC) + 1, 0))
+        return False
+
+    def feed(self, data, offset=None):
+        chunks = []
+        if self.done:
+            return chunks
+        end = self.buf_start + len(self.buf)
+        if offset is None:
+            offset = end
+        if offset < end:
+            # Already seen
+            data = data[end - offset:]
+            offset = end
+        if offset > end:
+            self.gap(offset)
+        self.buf += data
+
+        if self.next_chunk is None and not self.resync():
+            return chunks
+        if self.buf_start < self.next_chunk:
+            # Rest of a chunk cut by a gap
+            self.drop(min(self.next_chunk - self.buf_start, len(self.buf)))
+            if self.buf_start < self.next_chunk:
+                return chunks
+        pos = 0
+        while len(self.buf) - pos >= CHUNK_HEADER.size:
+            index, offset, length = CHUNK_HEADER.unpack_from(self.buf, pos)
+            if length == 0:
+                self.done = True
+                break
+            end = pos + CHUNK_HEADER.size + length
+            if end > len(self.buf):
+                break
+            chunks.append((index, offset, bytes(self.buf[pos + CHUNK_HEADER.size:end])))
+            self.last_index = index
+            pos = end
+        self.drop(pos)
+        self.next_chunk = self.buf_start
+        if self.done:
+            self.buf.clear()
+        return chunks
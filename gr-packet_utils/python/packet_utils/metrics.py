@@ -0,0 +1,215 @@
+"""
+Runtime metrics for the packet_utils blocks.
+
+Every block owns a BlockMetrics registered in the process-wide REGISTRY:
+- counters are plain integer attributes of the block, read only when metrics
+  are collected (the hot path just increments ints, no formatting)
+- gauges are attributes read the same way (queue depth, blocked time, ...)
+- rates are per-second gauges derived from counters on every publish tick
+- histograms are fixed-bucket latency histograms, fed once per work call
+
+tick() is called once per work call; every 'interval' seconds it updates the
+rates and hands a snapshot to the block (posted as a PMT dict on its "metrics"
+message port). start_http_server() serves every registered block in the
+Prometheus text format on /metrics.
+"""
+import bisect
+import threading
+import time
+import weakref
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Latency buckets in seconds (upper bounds; +Inf is implied)
+LATENCY_BUCKETS = (1e-5, 3e-5, 1e-4, 3e-4, 1e-3, 3e-3, 1e-2, 3e-2, 0.1, 0.3, 1.0)
+
+class Histogram:
+    """Fixed-bucket histogram (counts per bucket, sum and count)."""
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class BlockMetrics:
+    """
+    Metrics of one block instance. 'counters', 'gauges' and 'rates' are
+    attribute names of 'owner'; rates are taken over counters.
+    """
+    def __init__(self, owner, kind, counters, gauges=(), rates=(), interval=2.0, on_publish=None):
+        self.kind = kind
+        self.counters = tuple(counters)
+        self.gauges = tuple(gauges)
+        self.rates = tuple(rates)
+        self.histograms = {}
+        self.interval = interval
+        # Bound methods are held weakly so the registry never keeps a block alive
+        self._on_publish = weakref.WeakMethod(on_publish) if hasattr(on_publish, "__self__") else \
+            (lambda: on_publish)
+        self.rate_values = {name: 0.0 for name in self.rates}
+        self._owner = weakref.ref(owner)
+        self._last_time = time.monotonic()
+        self._last_counts = {name: getattr(owner, name) for name in self.rates}
+        self.name = REGISTRY.register(self)
+
+    def histogram(self, name, buckets=LATENCY_BUCKETS):
+        """Creates (or returns) the histogram 'name' of this block."""
+        return self.histograms.setdefault(name, Histogram(buckets))
+
+    def collect(self):
+        """Current values as a nested dict, or None when the block is gone."""
+        owner = self._owner()
+        if owner is None:
+            return None
+        return {
+            "block": self.name,
+            "counters": {name: int(getattr(owner, name)) for name in self.counters},
+            "gauges": {name: float(getattr(owner, name)) for name in self.gauges},
+            "rates": dict(self.rate_values),
+            "histograms": {name: h for name, h in self.histograms.items()},
+        }
+
+    def tick(self, force=False):
+        """
+        Cheap periodic hook (one clock read when not due). Every 'interval'
+        seconds, or with force, updates the rates and publishes a snapshot.
+        Returns True when it published.
+        """
+        now = time.monotonic()
+        dt = now - self._last_time
+        if not force and dt < self.interval:
+            return False
+        owner = self._owner()
+        if owner is None:
+            return False
+        counts = {name: getattr(owner, name) for name in self.rates}
+        if dt > 0:
+            self.rate_values = {name: (counts[name] - self._last_counts[name]) / dt for name in self.rates}
+        self._last_time = now
+        self._last_counts = counts
+        on_publish = self._on_publish()
+        if on_publish:
+            on_publish(self.collect())
+        return True
+
+def flatten(snapshot):
+    """
+    Flattens a collect() snapshot into {name: number} (for message ports):
+    counters and gauges keep their names, rates get '_per_s', histograms
+    give '<name>_count', '<name>_sum' and '<name>_max_bucket'.
+    """
+    flat = {"block": snapshot["block"]}
+    flat.update(snapshot["counters"])
+    flat.update(snapshot["gauges"])
+    flat.update({f"{name}_per_s": v for name, v in snapshot["rates"].items()})
+    for name, h in snapshot["histograms"].items():
+        flat[f"{name}_count"] = h.count
+        flat[f"{name}_sum"] = h.sum
+        # Upper bound of the highest non-empty bucket (inf when past the last one)
+        top = max((i for i, c in enumerate(h.counts) if c), default=None)
+        flat[f"{name}_max_bucket"] = 0.0 if top is None else \
+            h.buckets[top] if top < len(h.buckets) else float("inf")
+    return flat
+
+class MetricsRegistry:
+    """Process-wide set of BlockMetrics, named '<kind><n>' (rx0, tx0, sink0, ...)."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._blocks = {}
+        self._next_index = {}
+
+    def register(self, metrics):
+        with self._lock:
+            index = self._next_index.get(metrics.kind, 0)
+            self._next_index[metrics.kind] = index + 1
+            name = f"{metrics.kind}{index}"
+            self._blocks[name] = metrics
+            return name
+
+    def unregister(self, name):
+        with self._lock:
+            self._blocks.pop(name, None)
+
+    def collect(self):
+        """Snapshots of every live block (blocks that were deleted are dropped)."""
+        with self._lock:
+            blocks = list(self._blocks.values())
+        snapshots = []
+        for metrics in blocks:
+            snapshot = metrics.collect()
+            if snapshot is None:
+                self.unregister(metrics.name)
+            else:
+                snapshots.append((metrics.kind, snapshot))
+        return snapshots
+
+REGISTRY = MetricsRegistry()
+
+def prometheus_text(registry=REGISTRY):
+    """Renders every registered block in the Prometheus text exposition format."""
+    families = {} # metric name -> (type, sample lines)
+
+    def add(name, kind, line):
+        families.setdefault(name, (kind, []))[1].append(line)
+
+    for kind, snap in registry.collect():
+        prefix = f"packet_utils_{kind}_"
+        label = f'block="{snap["block"]}"'
+        for name, v in snap["counters"].items():
+            add(prefix + name + "_total", "counter", f"{prefix}{name}_total{{{label}}} {v}")
+        for name, v in snap["gauges"].items():
+            add(prefix + name, "gauge", f"{prefix}{name}{{{label}}} {v}")
+        for name, v in snap["rates"].items():
+            add(prefix + name + "_rate", "gauge", f"{prefix}{name}_rate{{{label}}} {v}")
+        for name, h in snap["histograms"].items():
+            base = f"{prefix}{name}_seconds"
+            cumulative = 0
+            for bound, c in zip(h.buckets + (float("inf"),), h.counts):
+                cumulative += c
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                add(base, "histogram", f'{base}_bucket{{{label},le="{le}"}} {cumulative}')
+            add(base, "histogram", f"{base}_sum{{{label}}} {h.sum}")
+            add(base, "histogram", f"{base}_count{{{label}}} {h.count}")
+
+    lines = []
+    for name, (kind, samples) in families.items():
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = prometheus_text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass # No per-scrape logging
+
+_servers = {}
+_servers_lock = threading.Lock()
+
+def start_http_server(port, host="127.0.0.1"):
+    """
+    Serves /metrics on (host, port) from a daemon thread. Blocks that ask for
+    the same port share one server. Returns the server.
+    """
+    with _servers_lock:
+        server = _servers.get(port)
+        if server is None:
+            server = ThreadingHTTPServer((host, port), _MetricsHandler)
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, name=f"packet_utils_metrics_{port}",
+                             daemon=True).start()
+            _servers[port] = server
+        return server
@@ -0,0 +1,422 @@
+"""
+Pure-NumPy, bit-exact model of the packet_utils frame format.
+
+packet_encoder_continuous and packet_decoder_continuous are thin GNU Radio
+wrappers around FrameCodec, so the same code can be driven offline without a
+flowgraph: encode a batch of frames, inject bit errors, decode, and count
+frame errors (see fer_curve()).
+"""
+import math
+import numpy as np
+from .fec_utils import Scrambler, SyncDetector, SoftSyncDetector, FEC_CODES, FEC_IDS, crc32_batch, crc32_verify
+
+# Frame types
+TYPE_TRAINING = 0x00
+TYPE_DATA = 0x01
+TYPE_START = 0x02
+TYPE_END = 0x03
+TYPE_SKIP = 0x04 # ARQ: group IDs a resumed transfer skips on purpose (not lost)
+TYPE_PARITY = 0x05
+
+# Group IDs are 24 bits wide and run 1..GROUP_IDS (0 = control frames), so
+# they only wrap after 16.7M groups; with data_slots k and payload_len L the
+# data of group g (counted from 0 since START) starts at byte (g * k) * L.
+GROUP_IDS = (1 << 24) - 1
+
+# End of stream is signalled out of band: the source tags the last input
+# vector of a transfer with this stream tag key (value: the exact byte count),
+# the END packets carry the count, and the decoder tags the last output byte
+# with it again for the sink.
+EOF_TAG = "eof"
+# Decoder output tag on the first byte after lost data: its byte offset in the transfer
+# (the source tags the first byte after data it skips the same way)
+OFFSET_TAG = "offset"
+# Content ID of a transfer (64 bits, see transcode_cache.content_id()): the
+# source tags the first byte of every pass, the START packets carry it, and
+# the decoder tags its first output byte with (content ID, group size in bytes)
+CONTENT_TAG = "content_id"
+
+# START, END and SKIP packets carry one 64-bit value (content ID / byte count /
+# first skipped group ID)
+CONTROL_VALUE_BYTES = 8 # Big-endian value at the start of the control payloads
+UNKNOWN_VALUE = (1 << 64) - 1
+
+def control_parts(payload_len):
+    """Number of START / END / SKIP packets (slot IDs 0..) a value is split over: ceil(8 / L)."""
+    return -(-CONTROL_VALUE_BYTES // payload_len)
+
+def control_payloads(value, payload_len):
+    """
+    Payloads of the START (content ID) or END (byte count) packets carrying
+    'value' (None when unknown), one row per part; row i is sent with slot ID i.
+    """
+    n = control_parts(payload_len)
+    payloads = np.full(n * payload_len, 0x55, dtype=np.uint8)
+    value = UNKNOWN_VALUE if value is None else value
+    payloads[:CONTROL_VALUE_BYTES] = np.frombuffer(value.to_bytes(CONTROL_VALUE_BYTES, "big"), dtype=np.uint8)
+    return payloads.reshape(n, payload_len)
+
+def control_value(chunks, payload_len):
+    """
+    Value from the START / END payloads received so far ({slot ID: payload}).
+    None until every part is in, or when the sender did not know it.
+    """
+    n = control_parts(payload_len)
+    if any(i not in chunks for i in range(n)):
+        return None
+    raw = np.concatenate([chunks[i] for i in range(n)])[:CONTROL_VALUE_BYTES]
+    value = int.from_bytes(raw.tobytes(), "big")
+    return None if value == UNKNOWN_VALUE else value
+
+class FrameCodec:
+    """
+    Encoder/decoder for frames carrying L payload bytes (default L = 10, 60-byte frames):
+    [0:P]              Preamble (0xAA..., P = preamble_len, default 16)
+    [P:P+4]            Sync Word
+    [P+4]              FEC code ID (high nibble) + Type (low nibble) (Scrambled) - 1B
+    [P+5:P+5+B]        Encoded Type + GroupID (24-bit big-endian) + SlotID + Payload
+                       + CRC-32 of the first four (B bytes, Scrambled; B = 2(9 + L)
+                       for Hamming(7,4))
+    [P+5+B]            Padding (1 byte)
+    The plain type byte names the code; the coded copy is what the CRC checks.
+    Frames are encoded with the 'fec' code; decode() accepts every registered code.
+    """
+    SYNC_LEN = 4
+    HEADER_LEN = 5 # Type + GroupID (3) + SlotID
+    CRC_LEN = 4
+    MAX_PAYLOAD_LEN = 1024
+
+    def __init__(self, sync_word=0xDEADBEEF, seed=0x7F, payload_len=10, preamble_len=16, fec="hamming74"):
+        if not 1 <= payload_len <= self.MAX_PAYLOAD_LEN:
+            raise ValueError(f"payload_len must be between 1 and {self.MAX_PAYLOAD_LEN} bytes")
+        if fec not in FEC_IDS:
+            raise ValueError(f"unknown FEC code '{fec}' (one of: {', '.join(FEC_IDS)})")
+        self.sync_word = sync_word
+        self.payload_len = payload_len
+        self.preamble_len = preamble_len
+        self.codes = {code_id: cls() for code_id, cls in FEC_CODES.items()}
+        self.fec_id = FEC_IDS[fec]
+        self.fec = self.codes[self.fec_id]
+        # Bytes from the start of the sync word to the end of the scrambled part
+        # (Type + Group + Slot + coded payload + CRC) for every code
+        self.spans = {code_id: self.SYNC_LEN + self.body_len(code) + 1
+                      for code_id, code in self.codes.items()}
+        self.max_span = max(self.spans.values())
+        self.span = self.spans[self.fec_id]
+        self.scrambled_len = self.span - self.SYNC_LEN
+        self.frame_len = preamble_len + self.span + 1
+        self.sync_bytes = np.array([(sync_word >> 24) & 0xFF, (sync_word >> 16) & 0xFF,
+                                    (sync_word >> 8) & 0xFF, sync_word & 0xFF], dtype=np.uint8)
+        self.prefix = np.concatenate([np.full(preamble_len, 0xAA, dtype=np.uint8), self.sync_bytes])
+        self.scrambler = Scrambler(seed=seed)
+
+    @staticmethod
+    def group_id_of(header):
+        """24-bit GroupIDs of N headers (N x HEADER_LEN bytes, or the 3 GroupID bytes at [1:4])."""
+        return (header[:, 1].astype(np.uint32) << 16) | (header[:, 2].astype(np.uint32) << 8) | header[:, 3]
+
+    def encode(self, types, group_ids, slot_ids, payloads, out=None):
+        """
+        Frames N packets. payloads is N x L; the header fields are scalars or
+        length-N arrays. Writes into 'out' (N x frame_len) when given.
+        """
+        payloads = np.asarray(payloads, dtype=np.uint8)
+        if out is None:
+            out = np.empty((len(payloads), self.frame_len), dtype=np.uint8)
+        n, L = payloads.shape
+        H = self.HEADER_LEN
+        s = self.preamble_len + self.SYNC_LEN
+        e = s + self.scrambled_len
+        out[:, 0:s] = self.prefix
+
+        # Type + GroupID + SlotID + Payload + CRC-32 of all four
+        block = np.empty((n, H + L + self.CRC_LEN), dtype=np.uint8)
+        block[:, 0] = np.asarray(types, dtype=np.uint8) | (self.fec_id << 4)
+        group_ids = np.asarray(group_ids, dtype=np.uint32)
+        block[:, 1] = group_ids >> 16
+        block[:, 2] = (group_ids >> 8) & 0xFF
+        block[:, 3] = group_ids & 0xFF
+        block[:, 4] = slot_ids
+        block[:, H:H + L] = payloads
+        block[:, H + L:] = crc32_batch(block[:, :H + L]).astype('>u4')[:, None].view(np.uint8)
+        out[:, s] = block[:, 0]
+        # Coded as one block (after the plain type byte)
+        out[:, s + 1:e] = self.fec.encode_bytes(block)
+
+        # Scramble: Type + Group + Slot + Payload + CRC
+        out[:, s:e] = self.scrambler.process_batch(out[:, s:e])
+        out[:, e:] = 0x00
+        return out
+
+    def body_len(self, code):
+        """Scrambled bytes after the type byte for frames of 'code'."""
+        return code.coded_len(self.HEADER_LEN + self.payload_len + self.CRC_LEN)
+
+    def align(self, buf, sync_idx, bit_shift, span=None):
+        """
+        Cuts 'span' bytes (default: this codec's span) starting at each (sync
+        byte index, bit shift) out of 'buf' and undoes the bit shift.
+        Returns an N x span array.
+        """
+        idx = sync_idx[:, None] + np.arange((span or self.span) + 1)
+        window = buf[np.minimum(idx, len(buf) - 1)].astype(np.uint16)
+        shift = bit_shift[:, None].astype(np.uint16)
+        return ((window[:, :-1] << shift) | (window[:, 1:] >> (8 - shift))).astype(np.uint8)
+
+    def decode(self, aligned):
+        """
+        Decodes byte-aligned frames that start at the sync word (N x span, or
+        N x max_span when frames of several codes may be present). Each frame
+        is decoded with the code named in its header.
+        Returns (types, group_ids, slot_ids, payloads N x L, crc_ok, corrected bits,
+        frame spans).
+        """
+        # Descramble
+        d = self.scrambler.process_batch(aligned[:, self.SYNC_LEN:])
+        fec_ids = d[:, 0] >> 4
+
+        n = len(d)
+        types = d[:, 0] & 0x0F
+        groups = self.group_id_of(d)
+        slots = d[:, 4].copy()
+        payloads = np.zeros((n, self.payload_len), dtype=np.uint8)
+        crc_ok = np.zeros(n, dtype=bool)
+        corrected = np.zeros(n, dtype=np.int64)
+        spans = np.full(n, self.span, dtype=np.int64)
+        fields = (types, groups, slots, payloads, crc_ok, corrected)
+        for code_id in np.unique(fec_ids).tolist():
+            if code_id in self.codes and self.spans[code_id] <= aligned.shape[1]:
+                # Unknown code (corrupt header): counts as CRC failure
+                self._decode_rows(code_id, d, fec_ids == code_id, fields, spans)
+
+        # CRC-aided retry: a bit error in the code ID nibble sends a frame to the
+        # wrong decoder, so failed frames are tried once with every other code
+        failed = ~crc_ok
+        if failed.any():
+            for code_id in self.codes:
+                rows = failed & (fec_ids != code_id)
+                if rows.any() and self.spans[code_id] <= aligned.shape[1]:
+                    self._decode_rows(code_id, d, rows, fields, spans, only_valid=True)
+                    failed &= ~crc_ok
+        return types, groups, slots, payloads, crc_ok, corrected, spans
+
+    def _decode_rows(self, code_id, d, rows, fields, spans, only_valid=False):
+        """
+        Decodes the descrambled frames d[rows] with one code into 'fields'
+        (types, groups, slots, payloads, crc_ok, corrected). With only_valid,
+        just the frames that pass the CRC are written.
+        """
+        code = self.codes[code_id]
+        L = self.payload_len
+        H = self.HEADER_LEN
+        # FEC Decode
+        block, c = code.decode_bytes(d[rows, 1:1 + self.body_len(code)])
+        t, g, s, p = block[:, 0] & 0x0F, self.group_id_of(block), block[:, 4], block[:, H:H + L]
+
+        # CRC-32 Check
+        ok = crc32_verify(block[:, :H + L], block[:, H + L:])
+        self._store_rows(code_id, np.nonzero(rows)[0], (t, g, s, p, c, ok), fields, spans, only_valid)
+
+    def _store_rows(self, code_id, idx, result, fields, spans, only_valid):
+        """Writes decoded (t, g, s, p, corrected, crc_ok) of frames 'idx' into 'fields'."""
+        types, groups, slots, payloads, crc_ok, corrected = fields
+        t, g, s, p, c, ok = result
+        if only_valid:
+            idx, t, g, s, p, c, ok = idx[ok], t[ok], g[ok], s[ok], p[ok], c[ok], ok[ok]
+        types[idx] = t
+        groups[idx] = g
+        slots[idx] = s
+        payloads[idx] = p
+        corrected[idx] = c
+        crc_ok[idx] = ok
+        spans[idx] = self.spans[code_id]
+
+    def decode_soft(self, soft, chase_bits=4):
+        """
+        Soft-decision decode(): 'soft' holds N frames of 8 * max_span (or
+        8 * span) bit reliabilities starting at the sync word, one float per
+        bit, positive = 1, larger = more confident (e.g. GFSK soft symbols).
+        The payload is decoded by the code's decode_soft (maximum-likelihood for
+        Hamming(7,4), soft Viterbi for conv_k7). Frames that still fail the CRC
+        get a Chase-style retry: the 'chase_bits' least reliable bits under the
+        CRC are flipped in all 2^chase_bits - 1 combinations and the first
+        pattern that passes the CRC wins.
+        Returns the decode() tuple plus a mask of the frames the retry rescued.
+        """
+        soft = np.asarray(soft, dtype=np.float32)[:, 8 * self.SYNC_LEN:]
+        # Descramble: flip the sign of every bit the keystream would invert
+        keystream = np.unpackbits(self.scrambler.mask(soft.shape[1] // 8))
+        soft = soft[:, :len(keystream)] * (1.0 - 2.0 * keystream).astype(np.float32)
+        d = np.packbits(soft > 0, axis=1)
+        fec_ids = d[:, 0] >> 4
+
+        n = len(d)
+        types = d[:, 0] & 0x0F
+        groups = self.group_id_of(d)
+        slots = d[:, 4].copy()
+        payloads = np.zeros((n, self.payload_len), dtype=np.uint8)
+        crc_ok = np.zeros(n, dtype=bool)
+        corrected = np.zeros(n, dtype=np.int64)
+        spans = np.full(n, self.span, dtype=np.int64)
+        rescued = np.zeros(n, dtype=bool)
+        fields = (types, groups, slots, payloads, crc_ok, corrected)
+        width = self.SYNC_LEN + d.shape[1]
+        for code_id in np.unique(fec_ids).tolist():
+            if code_id in self.codes and self.spans[code_id] <= width:
+                self._decode_soft_rows(code_id, soft, fec_ids == code_id, fields, spans)
+
+        # Same CRC-aided retry over the other codes as decode()
+        failed = ~crc_ok
+        if failed.any():
+            for code_id in self.codes:
+                rows = failed & (fec_ids != code_id)
+                if rows.any() and self.spans[code_id] <= width:
+                    self._decode_soft_rows(code_id, soft, rows, fields, spans, only_valid=True)
+                    failed &= ~crc_ok
+
+        # Chase retry on the weakest bits, with the code named in the header
+        if chase_bits and failed.any():
+            for code_id in np.unique(fec_ids[failed]).tolist():
+                rows = failed & (fec_ids == code_id)
+                if code_id in self.codes and self.spans[code_id] <= width:
+                    self._chase_rows(code_id, soft, rows, fields, spans, chase_bits)
+            rescued = failed & crc_ok
+        return types, groups, slots, payloads, crc_ok, corrected, spans, rescued
+
+    def _soft_region(self, code):
+        """Bit range of the descrambled soft frame covered by the CRC check (all but the type byte)."""
+        return 8, 8 * (1 + self.body_len(code))
+
+    def _decode_soft_block(self, code_id, region):
+        """Decodes soft CRC regions (one row per frame) -> (t, g, s, p, corrected, crc_ok)."""
+        code = self.codes[code_id]
+        L = self.payload_len
+        H = self.HEADER_LEN
+        block, c = code.decode_soft(region)
+        t, g, s, p = block[:, 0] & 0x0F, self.group_id_of(block), block[:, 4], block[:, H:H + L]
+        return t, g, s, p, c, crc32_verify(block[:, :H + L], block[:, H + L:])
+
+    def _decode_soft_rows(self, code_id, soft, rows, fields, spans, only_valid=False):
+        """Soft counterpart of _decode_rows()."""
+        code = self.codes[code_id]
+        b0, b1 = self._soft_region(code)
+        result = self._decode_soft_block(code_id, soft[rows, b0:b1])
+        self._store_rows(code_id, np.nonzero(rows)[0], result, fields, spans, only_valid)
+
+    def _chase_rows(self, code_id, soft, rows, fields, spans, chase_bits):
+        """
+        Flips the chase_bits least reliable bits of the CRC region of the
+        failed frames soft[rows] in every combination (all frames and patterns in
+        one batch) and keeps the first combination per frame that passes the CRC.
+        A flipped bit is set to the opposite sign at the frame's mean reliability.
+        """
+        code = self.codes[code_id]
+        b0, b1 = self._soft_region(code)
+        region = soft[rows, b0:b1]
+        f, w = len(region), min(chase_bits, region.shape[1])
+        weak = np.argpartition(np.abs(region), w - 1, axis=1)[:, :w]
+        vals = np.take_along_axis(region, weak, axis=1)
+        flipped = np.where(vals > 0, -1.0, 1.0) * np.abs(region).mean(axis=1, keepdims=True)
+        patterns = ((np.arange(1, 1 << w)[:, None] >> np.arange(w)) & 1).astype(bool)
+        tests = np.repeat(region[None], len(patterns), axis=0)
+        tests[:, np.arange(f)[:, None], weak] = np.where(patterns[:, None, :], flipped, vals)
+        t, g, s, p, c, ok = self._decode_soft_block(
+            code_id, tests.reshape(-1, region.shape[1]))
+
+        ok = ok.reshape(len(patterns), f)
+        found = ok.any(axis=0)
+        pick = np.argmax(ok, axis=0)[found] * f + np.nonzero(found)[0]
+        result = (t[pick], g[pick], s[pick], p[pick], c[pick], np.ones(len(pick), dtype=bool))
+        self._store_rows(code_id, np.nonzero(rows)[0][found], result, fields, spans, only_valid=False)
+
+    def decode_stream(self, buf, threshold=2, detector=None, offset=None):
+        """
+        Finds and decodes every complete frame in a byte buffer.
+        Returns (sync_idx, bit_shift, fields) where fields is the decode() tuple;
+        hits whose frame (of the longest code) runs past the buffer end are left out.
+        """
+        detector = detector or SyncDetector(self.sync_word)
+        sync_idx, bit_shift, _ = detector.search(buf, threshold, offset)
+        complete = sync_idx + self.max_span + (bit_shift > 0) <= len(buf)
+        sync_idx, bit_shift = sync_idx[complete], bit_shift[complete]
+        return sync_idx, bit_shift, self.decode(self.align(buf, sync_idx, bit_shift, self.max_span))
+
+    def decode_stream_soft(self, soft, threshold=0.8, detector=None, chase_bits=4):
+        """
+        decode_stream() over soft bits (one float per bit, positive = 1).
+        Returns (bit_pos, fields) where fields is the decode_soft() tuple.
+        """
+        detector = detector or SoftSyncDetector(self.sync_word)
+        pos, _ = detector.search(soft, threshold)
+        pos = pos[pos + 8 * self.max_span <= len(soft)]
+        windows = np.asarray(soft, dtype=np.float32)[pos[:, None] + np.arange(8 * self.max_span)]
+        return pos, self.decode_soft(windows, chase_bits)
+
+def noise_sigma(ber):
+    """Noise std. dev. of +-1 soft bits whose hard decisions have bit error rate 'ber'."""
+    lo, hi = 0.0, 40.0 # Bisection on Q(x) = ber, sigma = 1 / x
+    for _ in range(100):
+        x = (lo + hi) / 2
+        lo, hi = (x, hi) if 0.5 * math.erfc(x / math.sqrt(2)) > ber else (lo, x)
+    return 1.0 / max(lo, 1e-12)
+
+def soft_channel(frames, ber, rng):
+    """Maps the bits of 'frames' to +-1 plus Gaussian noise at hard bit error rate 'ber'."""
+    bits = np.unpackbits(frames, axis=-1).astype(np.float32) * 2.0 - 1.0
+    return bits + rng.normal(0.0, noise_sigma(ber), bits.shape).astype(np.float32)
+
+def inject_bit_errors(frames, ber, rng):
+    """Flips every bit of 'frames' independently with probability ber (in place)."""
+    flat = frames.reshape(-1)
+    n_bits = flat.size * 8
+    n_err = rng.binomial(n_bits, ber)
+    if n_err:
+        pos = rng.choice(n_bits, n_err, replace=False)
+        np.bitwise_xor.at(flat, pos // 8, (0x80 >> (pos % 8)).astype(np.uint8))
+    return frames
+
+def fer_curve(bers, n_frames=100000, sync_search=False, seed=0, payload_len=10, fec="hamming74", soft=False):
+    """
+    Frame error rate of the frame format for each bit error rate in 'bers'.
+    With sync_search=False frames are decoded at their known position (FEC +
+    CRC only); with sync_search=True the frames are concatenated and found by
+    soft sync search like on air. With soft=True the channel is Gaussian noise
+    on +-1 soft bits (at the same hard bit error rate) and the soft decoder is
+    used. Returns a list of dicts.
+    """
+    rng = np.random.default_rng(seed)
+    codec = FrameCodec(payload_len=payload_len, fec=fec)
+    results = []
+    for ber in bers:
+        payloads = rng.integers(0, 256, (n_frames, codec.payload_len), dtype=np.uint8)
+        slots = np.arange(n_frames) % 256
+        frames = codec.encode(TYPE_DATA, 1, slots, payloads)
+        if soft:
+            rx = soft_channel(frames, ber, rng)
+        else:
+            inject_bit_errors(frames, ber, rng)
+        start = codec.preamble_len
+        if sync_search:
+            # Trailing zeros so the last frame is complete for every code
+            if soft:
+                stream = np.concatenate([rx.reshape(-1), np.zeros(8 * codec.max_span, dtype=np.float32)])
+                _, fields = codec.decode_stream_soft(stream)
+            else:
+                stream = np.concatenate([frames.reshape(-1), np.zeros(codec.max_span, dtype=np.uint8)])
+                _, _, fields = codec.decode_stream(stream)
+            types, _, got_slots, got_payloads, crc_ok, corrected = fields[:6]
+            # Count each sent frame at most once (match on slot + payload)
+            ok = crc_ok & (types == TYPE_DATA)
+            delivered = len({(int(s), p.tobytes()) for s, p in zip(got_slots[ok], got_payloads[ok])})
+            errors = n_frames - delivered
+        else:
+            if soft:
+                fields = codec.decode_soft(rx[:, 8 * start:8 * (start + codec.span)])
+            else:
+                fields = codec.decode(frames[:, start:start + codec.span])
+            _, _, _, got_payloads, crc_ok, corrected = fields[:6]
+            good = crc_ok & np.all(got_payloads == payloads, axis=1)
+            errors = n_frames - int(np.count_nonzero(good))
+        results.append({"ber": ber, "fec": fec, "frames": n_frames, "frame_errors": int(errors),
+                        "fer": errors / n_frames, "corrected_bits": int(corrected.sum())})
+    return results
@@ -1,40 +1,113 @@
 
 import numpy as np
 from gnuradio import gr
+import pmt
 import sys
 import time
-import binascii
-from .fec_utils import Scrambler, Hamming74
+from collections import deque
+from .fec_utils import SyncDetector
+from .modem import (FrameCodec, EOF_TAG, OFFSET_TAG, CONTENT_TAG, GROUP_IDS, TYPE_START, TYPE_END, TYPE_SKIP,
+                    control_parts, control_value)
+from .erasure import ErasureCode
+from .arq import NACK_PORT, NACK_MAX_ENTRIES, PendingGroup, nack_pdu
+from .metrics import BlockMetrics, flatten, start_http_server
+from .profiling import instrument
 
 class packet_decoder_continuous(gr.basic_block):
     """
     V4.0 Really Robust Continuous Decoder.
     Supports Descrambling and CRC-32 verification.
     """
-    def __init__(self, sync_word=0xDEADBEEF):
+    # Input: one packed byte per item (packet_decoder_soft takes one soft bit per item)
+    IN_TYPE = np.uint8
+    ITEM_BITS = 8
+    # Unconsumed items kept so a sync word straddling the buffer end is found next time
+    SYNC_OVERLAP = 4
+    COUNTERS = ("training_rx", "start_rx", "data_rx", "parity_rx", "recovered_rx", "duplicate_rx",
+                "late_rx", "crc_fail", "corrected_bits", "bytes_out", "nack_tx", "repair_rx", "repaired_rx",
+                "arq_lost")
+    PROFILE_STAGES = ("find_sync_soft", "decode_frames", "codec.align", "codec.decode",
+                      "codec.scrambler.process_batch", "codec.fec.decode_bytes",
+                      "handle_packet", "store_packet", "flush_group")
+
+    def __init__(self, sync_word=0xDEADBEEF, data_slots=4, parity_slots=1, reorder_window=4,
+                 interleave_depth=1, payload_len=10, metrics_port=0, profile=False,
+                 arq=False, arq_retry=1000, arq_tries=4, arq_groups=1024):
         gr.basic_block.__init__(
             self,
-            name="packet_decoder_continuous",
-            in_sig=[np.uint8],
+            name=type(self).__name__,
+            in_sig=[self.IN_TYPE],
             out_sig=[np.uint8]
         )
-        self.sync_bytes = bytes([
-            (sync_word >> 24) & 0xFF, (sync_word >> 16) & 0xFF,
-            (sync_word >> 8) & 0xFF, sync_word & 0xFF
-        ])
-        
-        self.fec = Hamming74()
-        self.descrambler = Scrambler(seed=0x7F)
+        # Descrambling, FEC and CRC live in the NumPy FrameCodec
+        # (the preamble length does not matter to the receiver)
+        self.codec = FrameCodec(sync_word, seed=0x7F, payload_len=payload_len)
+        self.payload_len = payload_len
             
         self.active = False
-        self.current_shift = 0
 
-        # Erasure Coding Buffer
-        self.current_group_id = -1
-        self.group_buffer = {} # SlotID -> 10-byte Payload
-        self.parity_group_size = 4
+        # Erasure Coding Buffer: reorder window of up to reorder_window groups
+        if not 1 <= max(reorder_window, interleave_depth) <= 127:
+            raise ValueError("reorder_window and interleave_depth must be between 1 and 127 groups")
+        self.group_buffer = {} # GroupID -> {SlotID -> payload_len-byte Payload}
+        self.group_data = {} # GroupID -> data slots of a partial (last) group
+        self.next_group_id = 1 # Oldest group still in the window (IDs 1..GROUP_IDS wrap)
+        # Stream position: groups counted from START never wrap, so every output
+        # byte has a byte offset in the transfer; where the output skips lost
+        # data, its first byte gets an OFFSET_TAG tag with the new offset
+        self.head_seq = 0 # Groups since START before next_group_id
+        self.out_offset = 0 # Transfer offset of the next output byte
+        self.offset_key = pmt.intern(OFFSET_TAG)
+        # De-interleaving: the groups of one interleaver block must fit in the window
+        self.reorder_window = max(reorder_window, interleave_depth)
+        self.parity_group_size = data_slots
+        self.parity_count = parity_slots
+        self.erasure = ErasureCode(data_slots, parity_slots)
+        # Largest output of a single packet (the whole window flushed)
+        self.max_flush = self.reorder_window * self.parity_group_size * payload_len
+        # End of stream: the END packets carry the exact byte count, and the
+        # last payload_len output bytes are held back until the next call so
+        # the alignment padding can still be cut (see end_stream())
+        self.end_parts = {} # END slot ID -> payload
+        self.end_rx = 0
+        self.end_part_count = control_parts(payload_len)
+        # The START packets carry the content ID of the transfer; the first
+        # output byte is tagged with it and the group size (for resume checkpoints)
+        self.start_parts = {} # START slot ID -> payload
+        self.content_id = None
+        self.tag_content = False
+        self.content_key = pmt.intern(CONTENT_TAG)
+        self.held = np.zeros(0, dtype=np.uint8)
+        self.eof_key = pmt.intern(EOF_TAG)
+        # One packet can flush the whole window after the held-back bytes; the
+        # default output buffer (32 KB) is too small for large windows, and the
+        # scheduler would then never offer enough space to call work
+        self.set_min_noutput_items(self.max_flush + payload_len)
+        self.set_min_output_buffer(2 * (self.max_flush + payload_len))
 
         self.finished = False
+        self.ending = False # END seen, repairs still pending (ARQ)
+
+        # Closed-loop ARQ (see arq.py): unrecoverable groups are NACKed on the
+        # "nack" port and wait for repairs; a NACK is repeated every arq_retry
+        # frames, arq_tries times at most, for up to arq_groups groups
+        self.arq = arq
+        self.arq_retry = arq_retry
+        self.arq_tries = arq_tries
+        self.arq_groups = arq_groups
+        self.pending = {} # GroupID -> PendingGroup
+        self.nacks = [] # (GroupID, SlotID) NACKed in this call
+        self.frames_seen = 0
+        self.nack_port = pmt.intern(NACK_PORT)
+        # Packets this many groups behind the window head are late, not a jump
+        # ahead: with ARQ, repairs come from the last arq_groups groups sent
+        self.late_groups = self.reorder_window + (arq_groups if arq else 0)
+        # Group ID ranges [first, end) a resumed transfer skipped (SKIP packets):
+        # not lost, so not NACKed. Only ranges ahead of the window head matter.
+        self.skipped = deque(maxlen=self.reorder_window + 1)
+        self.skip_parts = {} # SlotID -> payload of the SKIP packets ending at skip_end
+        self.skip_end = None
+        self.message_port_register_out(self.nack_port)
 
         # Status counters
         self.training_rx = 0
@@ -42,179 +115,361 @@ class packet_decoder_continuous(gr.basic_block):
         self.data_rx = 0
         self.parity_rx = 0
         self.recovered_rx = 0
+        self.duplicate_rx = 0
+        self.late_rx = 0
         self.crc_fail = 0
-        self._last_print = 0
-
-        # Pre-compute bit representations of sync bytes for faster bit-flip matching
-        self.sync_bits = np.unpackbits(np.frombuffer(self.sync_bytes, dtype=np.uint8))
-
-    def get_shifted_data(self, data_bytes, shift):
-        if shift == 0: return data_bytes
-        bits = np.unpackbits(np.frombuffer(data_bytes, dtype=np.uint8))
-        shifted_bits = bits[shift:]
-        rem = len(shifted_bits) % 8
-        if rem != 0: shifted_bits = shifted_bits[:-rem]
-        return np.packbits(shifted_bits).tobytes()
-
-    def _print_status(self, force=False):
-        now = time.monotonic()
-        if not force and (now - self._last_print) < 2.0:
-            return
-        self._last_print = now
-        state = "RECEIVING" if self.active else "TRAINING"
+        self.corrected_bits = 0
+        self.bytes_out = 0
+        self.nack_tx = 0 # Slots NACKed (repeats included)
+        self.repair_rx = 0 # Resent packets of pending groups
+        self.repaired_rx = 0 # Slots output after a repair
+        self.arq_lost = 0 # Pending groups given up
+
+        # Vectorized sync search; keeps distances of unconsumed input between calls
+        self.sync_detector = SyncDetector(sync_word)
+
+        # Runtime metrics: the counters above are read when metrics are collected;
+        # a snapshot goes out on the "metrics" port (and the status line) every 2 s
+        self.message_port_register_out(pmt.intern("metrics"))
+        self.metrics = BlockMetrics(
+            self, "rx", counters=self.COUNTERS,
+            rates=("data_rx", "crc_fail", "bytes_out"),
+            on_publish=self.publish_metrics)
+        self.sync_latency = self.metrics.histogram("sync")
+        self.decode_latency = self.metrics.histogram("decode")
+        self.work_latency = self.metrics.histogram("work")
+        if metrics_port:
+            start_http_server(metrics_port)
+
+        # Opt-in stage profiling (profile=True or PACKET_UTILS_PROFILE), reported at stop()
+        self.profiler = instrument(self, "rx", self.PROFILE_STAGES, profile)
+
+    def stop(self):
+        if self.profiler:
+            self.profiler.report()
+        return True
+
+    def publish_metrics(self, snapshot):
+        """Posts a metrics snapshot on the "metrics" port and prints the status line."""
+        self.message_port_pub(pmt.intern("metrics"), pmt.to_pmt(flatten(snapshot)))
+        c = snapshot["counters"]
+        state = "FINISHED" if self.finished else "RECEIVING" if self.active else "TRAINING"
         sys.stderr.write(
-            f"[RX] {state} | train: {self.training_rx}  start: {self.start_rx}  "
-            f"data: {self.data_rx}  parity: {self.parity_rx}  "
-            f"recovered: {self.recovered_rx}  crc_fail: {self.crc_fail}\n"
+            f"[RX] {state} | train: {c['training_rx']}  start: {c['start_rx']}  "
+            f"data: {c['data_rx']}  parity: {c['parity_rx']}  "
+            f"recovered: {c['recovered_rx']}  dup: {c['duplicate_rx']}  late: {c['late_rx']}  "
+            f"crc_fail: {c['crc_fail']}  "
+            f"fec_fixed: {c['corrected_bits']}"
+            + (f"  nack: {c['nack_tx']}  repaired: {c['repaired_rx']}  arq_lost: {c['arq_lost']}"
+               if self.arq else "") + "\n"
         )
 
-    def flush_group(self, output_items, produced):
-        """Reconstructs missing packet if possible and flushes buffer."""
+    def flush_group(self, group_id, output_items, produced):
+        """Reconstructs missing packets of a group if possible and flushes it."""
+        slots = self.group_buffer.pop(group_id, None)
+        n_data = self.group_data.pop(group_id, self.parity_group_size)
+        if not slots:
+            if self.arq and not self.was_skipped(group_id):
+                self.request_repair(group_id, self.head_seq, {}, n_data)
+            return 0
+        missing_slots = [i for i in range(n_data) if i not in slots]
+
+        if missing_slots:
+            # Any k of the k + m slots recover the whole group
+            recovered = self.erasure.decode(slots)
+            if recovered is not None:
+                for i in missing_slots:
+                    slots[i] = recovered[i]
+                self.recovered_rx += len(missing_slots)
+
+        if self.arq:
+            self.request_repair(group_id, self.head_seq, slots, n_data)
+        # Too many missing: output what we have to keep flow moving; the
+        # offset tag keeps the bytes after a gap at their place
+        return self.output_slots(self.head_seq, slots, [i for i in range(n_data) if i in slots],
+                                 output_items, produced)
+
+    def output_slots(self, seq, slots, indices, output_items, produced):
+        """
+        Outputs the data slots 'indices' of the group seq groups after START;
+        a byte that does not follow the previous one gets an OFFSET_TAG tag.
+        """
         added = 0
-        missing_slots = []
-        
-        # Check slots 0..N-1 (Data slots)
-        for i in range(self.parity_group_size):
-            if i not in self.group_buffer:
-                missing_slots.append(i)
-        
-        if len(missing_slots) == 0:
-            # All data present. Flush.
-            for i in range(self.parity_group_size):
-                output_items[produced + added : produced + added + 10] = self.group_buffer[i]
-                added += 10 # 10 bytes per packet
-        
-        elif len(missing_slots) == 1 and self.parity_group_size in self.group_buffer:
-            # One missing, Parity (Slot N) present. Reconstruct!
-            missing_idx = missing_slots[0]
-            
-            # Start with Parity
-            recovered = bytearray(self.group_buffer[self.parity_group_size])
-            
-            # XOR with all present data slots
-            for i in range(self.parity_group_size):
-                if i != missing_idx and i in self.group_buffer:
-                    data = self.group_buffer[i]
-                    for b in range(10):
-                        recovered[b] ^= data[b]
-            
-            # Store recovered
-            self.group_buffer[missing_idx] = recovered
-            self.recovered_rx += 1
-            
-            # Flush all
-            for i in range(self.parity_group_size):
-                output_items[produced + added : produced + added + 10] = self.group_buffer[i]
-                added += 10
-        else:
-            # Too many missing or no parity. Output what we have? 
-            # For strict stream integrity, we should output zeros for missing?
-            # Or just output gaps? 
-            # User request: "Reconstruction". If failed, maybe drop or output whatever.
-            # Let's output what we have to keep flow moving, but it will be gaps.
-             for i in range(self.parity_group_size):
-                if i in self.group_buffer:
-                    output_items[produced + added : produced + added + 10] = self.group_buffer[i]
-                    added += 10
-        
-        self.group_buffer.clear()
+        L = self.payload_len
+        base = seq * self.parity_group_size * L
+        for i in indices:
+            if self.tag_content:
+                self.add_item_tag(0, self.nitems_written(0) + produced + added, self.content_key,
+                                  pmt.cons(pmt.from_uint64(self.content_id),
+                                           pmt.from_uint64(self.parity_group_size * L)))
+                self.tag_content = False
+            offset = base + i * L
+            if offset != self.out_offset:
+                self.add_item_tag(0, self.nitems_written(0) + produced + added, self.offset_key,
+                                  pmt.from_uint64(offset))
+            output_items[produced + added : produced + added + L] = slots[i]
+            added += L # payload_len bytes per packet
+            self.out_offset = offset + L
         return added
 
-    def process_packet(self, data, sync_idx, output_items, produced):
-        # Layout: [Sync(4)] [Scrambled(27)] [Padding(1)]
-        # Scrambled: Type(1) + Group(1) + Slot(1) + Payload(20) + CRC(4) = 27 bytes
-        required = sync_idx + 4 + 27
-        
-        if len(data) >= required:
-            scrambled_part = data[sync_idx + 4 : sync_idx + 31]
-            
-            # Descramble
-            self.descrambler.reset()
-            descrambled = self.descrambler.process(scrambled_part)
-            
-            type_byte = descrambled[0]
-            group_id = descrambled[1]
-            slot_id = descrambled[2]
-            
-            payload_fec = descrambled[3:23]
-            recv_crc = (descrambled[23] << 24) | (descrambled[24] << 16) | \
-                       (descrambled[25] << 8) | descrambled[26]
-            
-            # FEC Decode
-            decoded = bytearray()
-            for i in range(10):
-                n1 = self.fec.decode(payload_fec[i*2])
-                n2 = self.fec.decode(payload_fec[i*2+1])
-                decoded.append((n1 << 4) | n2)
-            
-            # CRC-32 Check
-            calc_crc = binascii.crc32(decoded) & 0xFFFFFFFF
-            
-            if calc_crc == recv_crc:
-                total_produced = 0
-                
-                # Handle Signals
-                if type_byte == 0x00: # TRAINING
-                    self.training_rx += 1
-                    self._print_status()
-                    return required, 0
-                if type_byte == 0x02: # START
-                    self.start_rx += 1
-                    self.active = True
-                    self.current_group_id = -1
-                    self.group_buffer.clear()
-                    self._print_status(force=True)
-                    return required, 0
-                if type_byte == 0x03: # END
-                    self._print_status(force=True)
-                    sys.stderr.write("\n[RX] Stream ended.\n")
-                    self.active = False
-                    self.finished = True
-                    # Flush pending
-                    total_produced += self.flush_group(output_items, produced)
-                    return required, total_produced
-                
-                # Handle Data/Parity
-                if self.active and (type_byte == 0x01 or type_byte == 0x05):
-                    if type_byte == 0x01:
-                        self.data_rx += 1
-                    else:
-                        self.parity_rx += 1
-                    # Check for group change
-                    if group_id != self.current_group_id:
-                        if self.current_group_id != -1:
-                            total_produced += self.flush_group(output_items, produced)
-                        self.current_group_id = group_id
-
-                    # Store in buffer
-                    # Payload for Parity (Type 5) IS the decoded bytes (XOR sum)
-                    # Payload for Data (Type 1) IS the decoded bytes
-                    self.group_buffer[slot_id] = decoded
-                    self._print_status()
-
-                return required, total_produced
+    def request_repair(self, group_id, seq, slots, n_data):
+        """
+        NACKs the data slots a flushed group is missing (ARQ) and keeps the
+        group pending. Slots past the END byte count are not NACKed; a group
+        with no packet at all only while the transfer is running or its
+        length is known.
+        """
+        L = self.payload_len
+        length = control_value(self.end_parts, L) if not self.active else None
+        if not slots and not self.active and length is None:
+            return
+        base = seq * self.parity_group_size * L
+        needed = [i for i in range(n_data) if i not in slots and (length is None or base + i * L < length)]
+        if not needed:
+            return
+        if len(self.pending) >= self.arq_groups:
+            # Give up the oldest pending group
+            del self.pending[next(iter(self.pending))]
+            self.arq_lost += 1
+        self.pending[group_id] = PendingGroup(seq, slots, needed, self.frames_seen)
+        self.nacks.extend((group_id, i) for i in needed)
+
+    def repair_packet(self, group_id, slot_id, payload, output_items, produced):
+        """
+        Adds a resent packet to a pending group; once the group is whole (or
+        recoverable) its missing data slots are output at their offsets.
+        Returns the bytes produced.
+        """
+        group = self.pending[group_id]
+        slot_id, _ = self.erasure.parse_slot_id(slot_id)
+        if slot_id in group.slots:
+            self.duplicate_rx += 1
+            return 0
+        group.slots[slot_id] = payload
+        self.repair_rx += 1
+        missing = group.missing()
+        if missing:
+            recovered = self.erasure.decode(group.slots)
+            if recovered is None:
+                return 0
+            for i in missing:
+                group.slots[i] = recovered[i]
+        del self.pending[group_id]
+        self.repaired_rx += len(group.needed)
+        return self.output_slots(group.seq, group.slots, group.needed, output_items, produced)
+
+    def retry_nacks(self):
+        """Repeats the NACKs unanswered for arq_retry frames; gives up after arq_tries."""
+        for group_id, group in list(self.pending.items()):
+            if self.frames_seen - group.nack_at < self.arq_retry:
+                continue
+            if group.tries >= self.arq_tries:
+                del self.pending[group_id]
+                self.arq_lost += 1
+                continue
+            group.tries += 1
+            group.nack_at = self.frames_seen
+            self.nacks.extend((group_id, i) for i in group.missing())
+
+    def send_nacks(self):
+        """Posts the NACKs collected in this call as PDUs on the "nack" port."""
+        for i in range(0, len(self.nacks), NACK_MAX_ENTRIES):
+            group_ids, slot_ids = zip(*self.nacks[i:i + NACK_MAX_ENTRIES])
+            self.message_port_pub(self.nack_port, nack_pdu(group_ids, slot_ids))
+        self.nack_tx += len(self.nacks)
+        self.nacks = []
+
+    def note_skip(self, group_id, slot_id, payload):
+        """SKIP packet (ARQ): the group IDs from its value up to group_id were skipped."""
+        if group_id != self.skip_end:
+            self.skip_end = group_id
+            self.skip_parts = {}
+        self.skip_parts[slot_id] = payload
+        first = control_value(self.skip_parts, self.payload_len)
+        if first is not None and (first, group_id) not in self.skipped:
+            self.skipped.append((first, group_id))
+
+    def was_skipped(self, group_id):
+        """True if a resumed transfer skipped group_id on purpose (no NACK)."""
+        return any((group_id - first) % GROUP_IDS < (end - first) % GROUP_IDS
+                   for first, end in self.skipped)
+
+    def flush_head(self, output_items, produced):
+        """Flushes the oldest group of the window and moves the window on."""
+        added = self.flush_group(self.next_group_id, output_items, produced)
+        self.skip_groups(1)
+        return added
+
+    def skip_groups(self, n):
+        """Moves the window head on by n groups."""
+        self.next_group_id = (self.next_group_id - 1 + n) % GROUP_IDS + 1
+        self.head_seq += n
+
+    def flush_window(self, output_items, produced):
+        """Flushes every group still in the window, in order."""
+        added = 0
+        for _ in range(self.reorder_window):
+            added += self.flush_head(output_items, produced + added)
+        return added
+
+    def store_packet(self, group_id, slot_id, payload, output_items, produced):
+        """
+        Adds a DATA/PARITY packet to the reorder window. Groups leave the window
+        in order: when all k + m slots are in, or when a packet arrives for a
+        group reorder_window groups ahead (ageing). Returns the bytes produced.
+        """
+        added = 0
+        dist = (group_id - self.next_group_id) % GROUP_IDS
+        if dist >= GROUP_IDS - self.late_groups:
+            # Group already flushed (late packet)
+            self.late_rx += 1
+            return 0
+        if dist >= self.reorder_window:
+            # Age out the groups before it; past the window they were lost entirely
+            steps = dist - self.reorder_window + 1
+            for _ in range(min(steps, self.reorder_window)):
+                added += self.flush_head(output_items, produced + added)
+            self.skip_groups(steps - min(steps, self.reorder_window))
+
+        slots = self.group_buffer.setdefault(group_id, {})
+        slot_id, n_data = self.erasure.parse_slot_id(slot_id)
+        if slot_id in slots:
+            self.duplicate_rx += 1
+            return added
+        slots[slot_id] = payload
+        if n_data is not None and 0 < n_data < self.parity_group_size:
+            # Last (partial) group: the data slots never sent are known zeros
+            self.group_data[group_id] = n_data
+            for i in range(n_data, self.parity_group_size):
+                slots[i] = np.zeros(self.payload_len, dtype=np.uint8)
+
+        # Flush complete groups at the head of the window
+        group_len = self.parity_group_size + self.parity_count
+        while len(self.group_buffer.get(self.next_group_id, ())) >= group_len:
+            added += self.flush_head(output_items, produced + added)
+        return added
+
+    def find_sync_soft(self, data, threshold=2, offset=None):
+        """
+        Finds every sync word candidate allowing 'threshold' bit flips.
+        Returns (byte_index, bit_shift, distance) arrays ordered by bit position.
+        'offset' is the absolute stream position of data[0] (enables reuse).
+        """
+        return self.sync_detector.search(data, threshold, offset)
+
+    def find_frames(self, in_buf):
+        """
+        Sync candidates in the input buffer as (bit positions, number of
+        candidates whose frame is complete); complete ones come first.
+        """
+        hits, shifts, _ = self.find_sync_soft(in_buf, threshold=2, offset=self.nitems_read(0))
+        # A frame needs sync + scrambled bytes (27 for 10-byte payloads, +1 byte when not byte-aligned);
+        # the FEC code is only known after decoding, so wait for the longest one
+        complete = hits + self.codec.max_span + (shifts > 0) <= len(in_buf)
+        return hits.astype(np.int64) * 8 + shifts, int(np.count_nonzero(complete))
+
+    def decode_frames(self, in_buf, bit_pos):
+        """
+        Batch-decodes the frames that start at the given sync bit positions (any FEC code).
+        Returns (types, group_ids, slot_ids, payloads NxL, crc_ok mask, corrected bits, spans).
+        """
+        return self.codec.decode(self.codec.align(in_buf, bit_pos >> 3, bit_pos & 7, self.codec.max_span))
+
+    def count_frame(self, fields, k):
+        """Updates the counters for CRC-valid frame k of a decode_frames() result."""
+        self.corrected_bits += int(fields[5][k])
+
+    def handle_packet(self, type_byte, group_id, slot_id, decoded, output_items, produced):
+        """Routes one CRC-valid packet. Returns the number of bytes produced."""
+        total_produced = 0
+
+        # Handle Signals
+        if type_byte == 0x00: # TRAINING
+            self.training_rx += 1
+            return 0
+        if type_byte == 0x02: # START
+            self.start_rx += 1
+            self.active = True
+            self.next_group_id = 1 # Data always starts from Group 1
+            self.head_seq = 0
+            self.out_offset = 0
+            self.group_buffer.clear()
+            self.group_data.clear()
+            self.pending.clear()
+            self.skipped.clear()
+            self.skip_end = None
+            self.ending = False
+            self.content_id = control_value(self.start_parts, self.payload_len)
+            self.tag_content = self.content_id is not None
+            self.metrics.tick(force=True)
+            return 0
+        if type_byte == 0x03: # END
+            if self.ending:
+                return 0
+            self.active = False
+            self.end_rx += 1
+            # With short payloads the byte count spans several END packets: wait
+            # for all of them, or give up on the missing ones after one more round
+            self.ending = (all(i in self.end_parts for i in range(self.end_part_count))
+                           or self.end_rx > 2 * self.end_part_count)
+            # Flush pending
+            total_produced = self.flush_window(output_items, produced)
+            length = control_value(self.end_parts, self.payload_len)
+            if self.arq and length is not None:
+                # Groups past the window lost entirely, up to the byte count, are NACKed too
+                last = -(-length // (self.parity_group_size * self.payload_len))
+                for _ in range(min(last - self.head_seq, self.arq_groups)):
+                    self.flush_head(output_items, produced + total_produced)
+            if self.ending and self.pending:
+                sys.stderr.write(f"\n[RX] Stream ended, waiting for repairs of {len(self.pending)} groups.\n")
+            return total_produced
+
+        if type_byte == TYPE_SKIP:
+            if self.active and self.arq:
+                self.note_skip(group_id, slot_id, decoded)
+            return 0
+
+        # Resent packets of groups waiting for repairs (ARQ), also after END
+        if group_id in self.pending and (type_byte == 0x01 or type_byte == 0x05):
+            return self.repair_packet(group_id, slot_id, decoded, output_items, produced)
+
+        # Handle Data/Parity
+        if self.active and (type_byte == 0x01 or type_byte == 0x05):
+            if type_byte == 0x01:
+                self.data_rx += 1
             else:
-                self.crc_fail += 1
-                self._print_status()
-                return 0, 0
-        return 0, 0
-
-    def find_sync_soft(self, data_bytes, threshold=2):
-        """Finds sync word allowing 'threshold' bit flips."""
-        if len(data_bytes) < 4: return -1, 0 # Return tuple
-        
-        # Convert data to bits
-        data_bits = np.unpackbits(np.frombuffer(data_bytes, dtype=np.uint8))
-        sync_len = len(self.sync_bits)
-        
-        # Simple sliding window bit-comparison (could be optimized with correlation)
-        # We check every bit position (not just byte-aligned)
-        for i in range(len(data_bits) - sync_len):
-            diff = np.sum(data_bits[i : i + sync_len] != self.sync_bits)
-            if diff <= threshold:
-                # Found it! Return (byte_index, bit_shift)
-                return i // 8, i % 8
-        return -1, 0
+                self.parity_rx += 1
+            # Store in the reorder window (out-of-order groups are held, not flushed)
+            # Payload for Parity (Type 5) IS the decoded bytes (GF(256) parity row)
+            # Payload for Data (Type 1) IS the decoded bytes
+            total_produced += self.store_packet(group_id, slot_id, decoded, output_items, produced)
+
+        return total_produced
+
+    def check_end(self):
+        """The stream has ended once END was seen and no group waits for repairs."""
+        if self.ending and not self.pending and not self.finished:
+            sys.stderr.write("\n[RX] Stream ended.\n")
+            self.finished = True
+
+    def end_stream(self, out_buf, produced):
+        """
+        Called at END: cuts the alignment padding off the last slot of the
+        transfer (when it arrived) and tags the last output byte with the byte count (EOF_TAG), for the
+        sink. Returns the bytes produced.
+        """
+        length = control_value(self.end_parts, self.payload_len)
+        if length is None:
+            return produced
+        padded = -(-length // self.payload_len) * self.payload_len
+        if self.out_offset > padded:
+            return produced # More data than the count: a corrupted END packet
+        # The output ends in the last slot (and its padding) when that arrived
+        if self.out_offset == padded:
+            produced -= padded - length
+        if produced > 0:
+            self.add_item_tag(0, self.nitems_written(0) + produced - 1, self.eof_key, pmt.from_uint64(length))
+        return produced
 
     def general_work(self, input_items, output_items):
         if self.finished:
@@ -225,45 +480,77 @@ class packet_decoder_continuous(gr.basic_block):
         out_buf = output_items[0]
         produced = 0
 
-        # CRITICAL FIX: Always consume input to prevent hanging
-        # If we don't have enough data, consume what we have and wait for more
-        if len(in_buf) < 48:
-            # Consume all available bytes to prevent deadlock
-            self.consume(0, len(in_buf))
+        # CRITICAL FIX: Always consume input to prevent hanging.
+        # Everything is consumed except the last few items (sync overlap)
+        # or a frame whose tail has not arrived yet.
+        if len(in_buf) < self.SYNC_OVERLAP:
             return 0
-        
-        in_bytes = in_buf.tobytes()
-        
-        # Find sync with soft-matching
-        sync_byte_idx, bit_shift = self.find_sync_soft(in_bytes, threshold=2)
-        
-        if sync_byte_idx != -1:
-            # Shift data based on bit_shift
-            shifted_data = self.get_shifted_data(in_bytes[sync_byte_idx : ], bit_shift)
-            
-            # Now process_packet but sync_idx is 0 because we started shifting FROM the sync word
-            consumed, prod = self.process_packet(shifted_data, 0, out_buf, produced)
-            
-            if consumed > 0:
-                # Total bytes to consume from original in_buf: 
-                # Re-calculate carefully for 16-byte preamble:
-                # sync_byte_idx is the START of the sync word.
-                # The preamble of 16 bytes is BEFORE this.
-                # So we consume (sync_byte_idx - 16) bytes + preamble + sync + packet
-                # Simplest: consume until the end of the packet we just processed.
-                total_bits = (sync_byte_idx * 8) + bit_shift + (consumed * 8)
-                bytes_to_consume = total_bits // 8
-                
-                self.consume(0, bytes_to_consume)
-                return prod
-            else:
-                # Sync found but packet failed (e.g. CRC)
-                # Move forward 1 byte to avoid getting stuck
-                self.consume(0, sync_byte_idx + 1)
-                return 0
-        
-        # No sync found, consume some data to avoid buffer buildup
-        # Consume enough to move forward but keep some for sync detection overlap
-        bytes_to_consume = max(1, len(in_buf) - 48)
-        self.consume(0, bytes_to_consume)
-        return 0
+
+        # Bytes held back by the previous call go out first
+        produced = len(self.held)
+        out_buf[:produced] = self.held
+
+        # Find every sync candidate in the buffer with soft-matching
+        t0 = time.perf_counter()
+        bit_pos, n_complete = self.find_frames(in_buf)
+        t1 = time.perf_counter()
+        self.sync_latency.observe(t1 - t0)
+
+        if n_complete:
+            fields = self.decode_frames(in_buf, bit_pos[:n_complete])
+            types, groups, slots, payloads, crc_ok, _, spans = fields[:7]
+            self.decode_latency.observe(time.perf_counter() - t1)
+            # Collect the content ID / byte count from every START / END packet in the batch
+            for k in np.flatnonzero(crc_ok & (types == TYPE_START)):
+                self.start_parts[int(slots[k])] = payloads[k].copy()
+            for k in np.flatnonzero(crc_ok & (types == TYPE_END)):
+                self.end_parts[int(slots[k])] = payloads[k].copy()
+
+        # Walk the hits in order. Hits inside an already decoded frame are skipped;
+        # a CRC failure just moves on to the next candidate.
+        cursor_bits = 0
+        to_consume = None
+        for k in range(len(bit_pos)):
+            pos = int(bit_pos[k])
+            if pos < cursor_bits:
+                continue
+            if k >= n_complete or produced + self.max_flush > len(out_buf):
+                # Keep this frame for the next call
+                to_consume = pos // self.ITEM_BITS
+                break
+            if not crc_ok[k]:
+                self.crc_fail += 1
+                continue
+
+            self.count_frame(fields, k)
+            self.frames_seen += 1
+            produced += self.handle_packet(int(types[k]), int(groups[k]), int(slots[k]),
+                                           payloads[k].copy(), out_buf, produced)
+            cursor_bits = pos + int(spans[k]) * 8
+            self.check_end()
+            if self.finished:
+                to_consume = len(in_buf)
+                break
+
+        if to_consume is None:
+            # Consume through the last decoded frame, but keep the last few items
+            # so a sync word straddling the buffer end is found next time
+            to_consume = max(cursor_bits // self.ITEM_BITS, len(in_buf) - self.SYNC_OVERLAP)
+        if self.pending:
+            self.retry_nacks()
+            self.check_end()
+        if self.nacks:
+            self.send_nacks()
+        if self.finished:
+            produced = self.end_stream(out_buf, produced)
+        else:
+            # The last bytes may end in padding: keep them until more follow or END
+            keep = max(produced - self.payload_len, 0)
+            self.held = out_buf[keep:produced].copy()
+            produced = keep
+        self.consume(0, to_consume)
+        self.bytes_out += produced
+        self.work_latency.observe(time.perf_counter() - t0)
+        # Final snapshot (with the flushed window) once the stream has ended
+        self.metrics.tick(force=self.finished)
+        return produced
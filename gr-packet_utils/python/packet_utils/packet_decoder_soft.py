@@ -0,0 +1,57 @@
+import numpy as np
+from .fec_utils import SoftSyncDetector
+from .packet_decoder_continuous import packet_decoder_continuous
+
+class packet_decoder_soft(packet_decoder_continuous):
+    """
+    Soft-decision variant of packet_decoder_continuous.
+    Takes one float per bit (positive = 1, magnitude = confidence), e.g. the
+    output of the GFSK clock recovery before the slicer, instead of packed
+    hard bytes. The sync word is found by normalized soft correlation, the
+    payload is decoded maximum-likelihood (Hamming(7,4)) or by soft Viterbi
+    (conv_k7), and frames that fail the CRC are retried with their
+    chase_bits least reliable bits flipped. Reassembly, erasure recovery,
+    metrics and profiling are those of the hard decoder.
+    """
+    IN_TYPE = np.float32
+    ITEM_BITS = 1
+    SYNC_OVERLAP = 31
+    COUNTERS = packet_decoder_continuous.COUNTERS + ("chase_rx",)
+    PROFILE_STAGES = ("find_sync_soft", "decode_frames", "codec.decode_soft", "codec.fec.decode_soft",
+                      "handle_packet", "store_packet", "flush_group")
+
+    def __init__(self, sync_word=0xDEADBEEF, data_slots=4, parity_slots=1, reorder_window=4,
+                 interleave_depth=1, payload_len=10, metrics_port=0, profile=False,
+                 sync_threshold=0.8, chase_bits=4, arq=False, arq_retry=1000, arq_tries=4, arq_groups=1024):
+        self.chase_rx = 0 # Frames rescued by the weakest-bit retry
+        packet_decoder_continuous.__init__(self, sync_word, data_slots, parity_slots, reorder_window,
+                                           interleave_depth, payload_len, metrics_port, profile,
+                                           arq, arq_retry, arq_tries, arq_groups)
+        self.sync_detector = SoftSyncDetector(sync_word)
+        self.sync_threshold = sync_threshold
+        self.chase_bits = chase_bits
+        # One frame of the longest code must fit in the input buffer
+        self.frame_bits = 8 * self.codec.max_span
+
+    def find_sync_soft(self, data, threshold=0.8, offset=None):
+        """
+        Finds every sync word candidate with a normalized soft correlation of
+        at least 'threshold'. Returns (bit_position, metric) arrays in order.
+        """
+        return self.sync_detector.search(data, threshold)
+
+    def find_frames(self, in_buf):
+        bit_pos, _ = self.find_sync_soft(in_buf, self.sync_threshold)
+        return bit_pos, int(np.count_nonzero(bit_pos + self.frame_bits <= len(in_buf)))
+
+    def decode_frames(self, in_buf, bit_pos):
+        """
+        Batch soft-decodes the frames that start at the given sync bit positions.
+        Returns the decode_soft() tuple (the decode() fields plus the rescued mask).
+        """
+        windows = in_buf[bit_pos[:, None] + np.arange(self.frame_bits)]
+        return self.codec.decode_soft(windows, self.chase_bits)
+
+    def count_frame(self, fields, k):
+        packet_decoder_continuous.count_frame(self, fields, k)
+        self.chase_rx += int(fields[7][k])
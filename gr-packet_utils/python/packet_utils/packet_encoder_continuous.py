@@ -1,168 +1,490 @@
-
 import numpy as np
 from gnuradio import gr
+import pmt
 import sys
-import binascii
-from .fec_utils import Scrambler, Hamming74, EOF_SENTINEL
+import time
+from collections import deque
+from .modem import FrameCodec, EOF_TAG, OFFSET_TAG, CONTENT_TAG, GROUP_IDS, TYPE_START, TYPE_END, TYPE_SKIP, control_payloads
+from .erasure import ErasureCode
+from .arq import NACK_PORT, SKIP_COPIES, RetransmitBuffer, nack_entries
+from .metrics import BlockMetrics, flatten, start_http_server
+from .profiling import instrument
 
 class packet_encoder_continuous(gr.basic_block):
     """
     V4.1 HW-Optimized Continuous Encoder.
     Tailored for B210/Pluto SDRs with longer preambles and optimal timing patterns.
     """
-    def __init__(self, preamble=0xAAAAAAAA, sync_word=0xDEADBEEF):
-        # We increase vector size to 48 to allow for a much longer hardware preamble
-        # 48 bytes gives us plenty of "lead time" for SDR AGC and timing sync
-        gr.basic_block.__init__(self, name="packet_encoder_continuous", in_sig=[(np.uint8, 10)], out_sig=[(np.uint8, 48)])
-        
+    def __init__(self, preamble=0xAAAAAAAA, sync_word=0xDEADBEEF, data_slots=4, parity_slots=1,
+                 interleave_depth=1, payload_len=10, short_preamble=0, fec="hamming74", metrics_port=0,
+                 profile=False, arq=False, arq_groups=1024, arq_linger=5000):
         # Preamble: 16 bytes of 0xAA (10101010...) for B210/Pluto
-        self.preamble_bytes = [0xAA] * 16
-        self.sync_bytes = [(sync_word >> 24) & 0xFF, (sync_word >> 16) & 0xFF, (sync_word >> 8) & 0xFF, sync_word & 0xFF]
-        
-        self.fec = Hamming74()
-        self.scrambler = Scrambler(seed=0x7F)
-        
+        # With short_preamble > 0 the frames use that many preamble bytes instead and
+        # the training sequence becomes pure 0xAA vectors (one long preamble for AGC
+        # and timing lock)
+        # Framing, FEC, CRC and scrambling live in the NumPy FrameCodec
+        # fec selects the payload code for this stream (see fec_utils.FEC_CODES)
+        codec = FrameCodec(sync_word, seed=0x7F, payload_len=payload_len, preamble_len=short_preamble or 16,
+                           fec=fec)
+
+        # Vector sizes follow the payload length and code: 10 -> 60 bytes per frame
+        # with Hamming(7,4) and the long preamble, which gives us plenty of "lead time" for SDR AGC and timing sync
+        gr.basic_block.__init__(self, name="packet_encoder_continuous", in_sig=[(np.uint8, payload_len)],
+                                out_sig=[(np.uint8, codec.frame_len)])
+        self.codec = codec
+        self.payload_len = payload_len
+        self.frame_len = codec.frame_len
+
         self.state = "TRAINING"
         self.training_count = 400
         self.end_count = 50
-        self.eof_sentinel = list(EOF_SENTINEL)
+        # End of stream comes as an EOF_TAG stream tag on the last input vector
+        # (see find_eof()); nothing in the payload is reserved
+        self.eof_key = pmt.intern(EOF_TAG)
+        self.eof = False
+        # A resumed transfer skips data: an OFFSET_TAG tag (value: byte offset in
+        # the transfer, at a group boundary) moves the group ID on to that offset
+        self.offset_key = pmt.intern(OFFSET_TAG)
+        self.jump = None # Group ID the next data vector starts
+        # The START packets carry the CONTENT_TAG value of the first input vector
+        self.content_key = pmt.intern(CONTENT_TAG)
+        # Input tags would land on the wrong frames: the encoder adds none
+        self.set_tag_propagation_policy(gr.TPP_DONT)
+
+        # Control frames are byte-identical every time: build them once
+        L = payload_len
+        if short_preamble:
+            self.training_frame = np.full(self.frame_len, 0xAA, dtype=np.uint8)
+        else:
+            self.training_frame = np.frombuffer(self.make_packet([0]*L, 0x00), dtype=np.uint8)
+        self.start_frames = None # Built with the content ID once the first input is in
+        self.end_frames = self.make_control_frames(TYPE_END, None) # Rebuilt with the byte count at EOF
 
-        # Erasure Coding State
+        # Erasure Coding State: groups of k data + m parity packets
         self.group_id = 0
-        self.parity_group_size = 4
-        self.data_buffer = [] # Holds payloads for XOR calc
-        self.parity_buffer = bytearray(10) # 10 bytes for parity calculation (matches input size)
+        self.parity_group_size = data_slots
+        self.parity_count = parity_slots
+        self.erasure = ErasureCode(data_slots, parity_slots)
+        self.group_rows = np.zeros((data_slots, payload_len), dtype=np.uint8) # Data of the open group (zero padded)
         self.slot_counter = 0
+        # A closed group's parity frames are written in one go
+        self.set_min_noutput_items(max(parity_slots, 1))
+
+        # Block interleaver: slots of interleave_depth groups are sent slot by slot
+        # (1 = off). Adds at most one block of latency.
+        if not 1 <= interleave_depth <= 127:
+            raise ValueError("interleave_depth must be between 1 and 127 groups")
+        self.interleave_depth = interleave_depth
+        self.block = np.zeros((interleave_depth * (data_slots + parity_slots), self.frame_len), dtype=np.uint8)
+        self.block_fill = 0
+        self.ready = self.block[:0] # Interleaved frames waiting for output space
+        self.ready_pos = 0
+
+        # Closed-loop ARQ (see arq.py): the data frames of the last arq_groups
+        # groups are kept; slots NACKed on the "nack" port are resent between
+        # new data (at most half the output), and after END until arq_linger
+        # frames went by without a NACK
+        self.retransmit = RetransmitBuffer(arq_groups, data_slots, self.frame_len) if arq else None
+        self.repairs = deque() # (GroupIDs, SlotIDs) of received NACKs; filled by the message thread
+        self.arq_linger = arq_linger
+        self.idle = 0
+        self.message_port_register_in(pmt.intern(NACK_PORT))
+        self.set_msg_handler(pmt.intern(NACK_PORT), self.handle_nack)
+
+        # Runtime metrics (see metrics.py), published on the "metrics" port every 2 s
+        self.frames_tx = 0
+        self.data_tx = 0
+        self.parity_tx = 0
+        self.nack_rx = 0
+        self.repair_tx = 0
+        self.repair_miss = 0 # NACKed slots no longer (or never) in the retransmit buffer
+        self.message_port_register_out(pmt.intern("metrics"))
+        self.metrics = BlockMetrics(self, "tx", counters=("frames_tx", "data_tx", "parity_tx", "nack_rx",
+                                                          "repair_tx", "repair_miss"),
+                                    rates=("frames_tx", "data_tx"), on_publish=self.publish_metrics)
+        self.work_latency = self.metrics.histogram("work")
+        if metrics_port:
+            start_http_server(metrics_port)
+
+        # Opt-in stage profiling (profile=True or PACKET_UTILS_PROFILE), reported at stop()
+        self.profiler = instrument(self, "tx", (
+            "frame_data", "emit_parity", "interleave", "codec.encode", "codec.scrambler.process_batch",
+            "codec.fec.encode_bytes", "erasure.encode"), profile)
+
+    def publish_metrics(self, snapshot):
+        self.message_port_pub(pmt.intern("metrics"), pmt.to_pmt(flatten(snapshot)))
+
+    def stop(self):
+        if self.profiler:
+            self.profiler.report()
+        return True
+
+    def build_frames(self, out, types, group_ids, slot_ids, payloads):
+        """Frames N packets straight into 'out' (an N x frame_len uint8 view)."""
+        self.codec.encode(types, group_ids, slot_ids, payloads, out=out)
 
     def make_packet(self, payload, type_byte=0x01, group_id=0, slot_id=0):
-        # Layout (48 bytes):
-        # [0:16]  Long Preamble (0xAA...)
-        # [16:20] Sync Word
-        # [20]    Type (Scrambled) - 1B
-        # [21]    GroupID (Scrambled) - 1B
-        # [22]    SlotID (Scrambled) - 1B
-        # [23:43] Encoded Payload (20 bytes, Scrambled)
-        # [43:47] CRC-32 (4 bytes, Scrambled)
-        # [47:48] Padding (1 byte)
-        
-        payload_fec = bytearray()
-        for b in payload:
-            payload_fec.append(self.fec.encode((b >> 4) & 0x0F))
-            payload_fec.append(self.fec.encode(b & 0x0F))
-        
-        # Calculate CRC-32 of raw payload
-        payload_bytes = bytes(payload)
-        crc = binascii.crc32(payload_bytes) & 0xFFFFFFFF
-        crc_bytes = [(crc >> 24) & 0xFF, (crc >> 16) & 0xFF, (crc >> 8) & 0xFF, crc & 0xFF]
-        
-        # Scramble: Type + Group + Slot + Payload + CRC
-        to_scramble = bytearray([type_byte, group_id, slot_id])
-        to_scramble.extend(payload_fec)
-        to_scramble.extend(crc_bytes)
-        
-        self.scrambler.reset()
-        scrambled = self.scrambler.process(to_scramble)
-        
-        frame = bytearray(self.preamble_bytes)
-        frame.extend(self.sync_bytes)
-        frame.extend(scrambled)
-        
-        # Padding to reach 48 bytes
-        while len(frame) < 48:
-            frame.append(0x00)
-        
-        return bytes(frame)
+        frame = np.empty((1, self.frame_len), dtype=np.uint8)
+        payload = np.frombuffer(bytes(payload), dtype=np.uint8)[None, :]
+        self.build_frames(frame, type_byte, group_id, slot_id, payload)
+        return frame.tobytes()
+
+    def make_control_frames(self, type_byte, value, group_id=0):
+        """
+        START (content ID), END (transfer length) or SKIP (first skipped group
+        ID) packets carrying 'value' (see modem.control_payloads()), one per
+        slot ID.
+        """
+        payloads = control_payloads(value, self.payload_len)
+        frames = np.empty((len(payloads), self.frame_len), dtype=np.uint8)
+        self.build_frames(frames, type_byte, group_id, np.arange(len(payloads)), payloads)
+        return frames
+
+    def find_content_id(self):
+        """Content ID tagged on the first input vector, None without one."""
+        tags = self.get_tags_in_window(0, 0, 1, self.content_key)
+        return pmt.to_uint64(tags[0].value) if tags else None
+
+    def find_eof(self, n):
+        """
+        Number of the n input vectors that are data: up to and including the
+        vector tagged EOF_TAG, none once that vector has been consumed, all
+        of them otherwise. The tag value (exact byte count) goes into the END
+        packets.
+        """
+        tags = self.get_tags_in_window(0, 0, n, self.eof_key)
+        if not tags:
+            return 0 if self.eof else n
+        tag = min(tags, key=lambda t: t.offset)
+        self.eof = True
+        self.end_frames = self.make_control_frames(TYPE_END, pmt.to_uint64(tag.value))
+        return int(tag.offset - self.nitems_read(0)) + 1
+
+    def find_jump(self, n):
+        """
+        Number of the n input vectors before the next OFFSET_TAG jump. A jump
+        on the first vector is armed (self.jump) and applied by apply_jump().
+        Raises ValueError for an offset off a group boundary: the receiver
+        places data by group ID, so it would land at the wrong offset.
+        """
+        group_bytes = self.parity_group_size * self.payload_len
+        for tag in sorted(self.get_tags_in_window(0, 0, n, self.offset_key), key=lambda t: t.offset):
+            i = int(tag.offset - self.nitems_read(0))
+            if i > 0:
+                return i
+            offset = pmt.to_uint64(tag.value)
+            if offset % group_bytes:
+                raise ValueError(f"offset {offset} is not at a group boundary ({group_bytes} bytes): "
+                                 "the Smart Source must use the same data_slots and payload_len as the TX")
+            self.jump = (offset // group_bytes) % GROUP_IDS + 1
+        return n
+
+    def next_group_id(self, steps=1):
+        # Group IDs run 1..GROUP_IDS (24 bits) and wrap (0 is reserved/training)
+        return ((self.group_id - 1 + steps) % GROUP_IDS) + 1
+
+    def frame_data(self, data, out):
+        """
+        Frames input vectors 'data' (D x L) plus the parity packets that fall
+        between them into 'out' in a single vectorized pass. The caller must
+        size 'out' with frames_needed(D). Updates the erasure coding state.
+        """
+        G = self.parity_group_size
+        m = self.parity_count
+        c0 = self.slot_counter # < G here
+        d = len(data)
+
+        # Group offset q and slot of every data vector
+        pos = c0 + np.arange(d)
+        q = pos // G
+        n_groups = int(q[-1]) + 1
+
+        # Data of every group touched (the first one continues group_rows)
+        L = self.payload_len
+        rows = np.zeros((n_groups * G, L), dtype=np.uint8)
+        rows[:c0] = self.group_rows[:c0]
+        rows[c0:c0 + d] = data
+        parity = self.erasure.encode(rows.reshape(n_groups, G, L))
+
+        # A group's m parity frames go out right before the next group's first data
+        n_par = n_groups - 1
+        data_rows = np.arange(d) + m * q
+        par_group = np.repeat(np.arange(n_par), m)
+        par_index = np.tile(np.arange(m), n_par)
+        par_rows = (par_group + 1) * G - c0 + m * par_group + par_index
+
+        n = d + m * n_par
+        types = np.empty(n, dtype=np.uint8)
+        groups = np.empty(n, dtype=np.uint32)
+        slots = np.empty(n, dtype=np.uint8)
+        payloads = np.empty((n, L), dtype=np.uint8)
+        group_of = ((self.group_id - 1 + np.arange(n_groups)) % GROUP_IDS) + 1
+
+        types[data_rows] = 0x01
+        groups[data_rows] = group_of[q]
+        slots[data_rows] = pos % G
+        payloads[data_rows] = data
+
+        types[par_rows] = 0x05
+        groups[par_rows] = group_of[par_group]
+        slots[par_rows] = G + par_index
+        payloads[par_rows] = parity[:n_par].reshape(-1, L)
+
+        self.build_frames(out[:n], types, groups, slots, payloads)
+        if self.retransmit is not None:
+            self.retransmit.store(groups[data_rows], slots[data_rows], out[data_rows])
+        self.data_tx += d
+        self.parity_tx += m * n_par
+
+        # The last group stays open (its parity is sent lazily)
+        self.group_id = int(group_of[-1])
+        self.slot_counter = int(pos[-1] % G) + 1
+        self.group_rows = rows[-G:]
+        return n
+
+    def frames_needed(self, d):
+        # Data frames plus the parity frames inserted between them
+        return d + self.parity_count * ((self.slot_counter + d - 1) // self.parity_group_size)
+
+    def vectors_fitting(self, space):
+        """Largest D with frames_needed(D) <= space."""
+        G = self.parity_group_size
+        # Schedule position of data slot t (counted from the open group's slot 0)
+        # is (t // G) * (G + m) + t % G; the first slot_counter slots are already out
+        v = space + self.slot_counter - 1
+        if v < self.slot_counter:
+            return 0
+        q, r = divmod(v, G + self.parity_count)
+        return q * G + min(r, G - 1) - self.slot_counter + 1
+
+    def emit_parity(self, out_buf, produced):
+        # Parity of the open group; missing data slots count as zeros and the
+        # number of data slots sent goes into the parity slot IDs
+        m = self.parity_count
+        self.build_frames(out_buf[produced:produced + m], 0x05, self.group_id,
+                          self.erasure.parity_slot_ids(self.slot_counter),
+                          self.erasure.encode(self.group_rows))
+        self.parity_tx += m
+        return produced + m
+
+    def close_group(self, out_buf, produced):
+        """Sends the open group's parity and opens the next group."""
+        produced = self.emit_parity(out_buf, produced)
+        self.slot_counter = 0
+        self.group_id = self.next_group_id()
+        self.group_rows[:] = 0
+        return produced
+
+    def data_work(self, in_buf, out_buf, produced):
+        """
+        Frames input vectors into out_buf (natural group order); after EOF
+        in_buf ends with the last data vector. Returns (produced, input
+        vectors used).
+        """
+        input_idx = 0
+        if len(out_buf) - produced < max(self.parity_count, 1):
+            return produced, input_idx
+        n_data = len(in_buf)
+
+        # A full group still waiting for its parity
+        if self.slot_counter == self.parity_group_size and (n_data > 0 or self.eof):
+            produced = self.close_group(out_buf, produced)
+
+        # Largest number of vectors whose frames fit in the output
+        d = min(n_data, self.vectors_fitting(len(out_buf) - produced))
+        if d > 0:
+            produced += self.frame_data(in_buf[:d], out_buf[produced:])
+            input_idx = d
+
+        pending = self.parity_count if self.slot_counter > 0 else 0
+        if self.eof and input_idx == n_data and len(out_buf) - produced >= max(pending, 1):
+            # Flush remaining parity for the current group
+            if self.slot_counter > 0:
+                produced = self.emit_parity(out_buf, produced)
+            self.state = "END"
+        return produced, input_idx
+
+    def apply_jump(self, out_buf, produced):
+        """
+        Skipped data: closes the open group (sending the partial interleaver
+        block: groups on either side of a jump are not interleaved together)
+        and makes the next vector start the group at the tagged offset. With
+        ARQ the skipped group IDs are announced in SKIP packets first, so the
+        decoder does not NACK them. Returns the new produced; the jump stays
+        armed while the parity does not fit.
+        """
+        if self.interleave_depth > 1:
+            if self.slot_counter > 0:
+                self.block_fill = self.close_group(self.block, self.block_fill)
+            frames = self.interleave(self.block[:self.block_fill])
+            self.block_fill = 0
+        else:
+            if self.slot_counter > 0:
+                if len(out_buf) - produced < self.parity_count:
+                    return produced
+                produced = self.close_group(out_buf, produced)
+            frames = self.block[:0]
+        if self.retransmit is not None and self.group_id != self.jump:
+            skip = self.make_control_frames(TYPE_SKIP, self.group_id, self.jump)
+            frames = np.concatenate([frames, np.tile(skip, (SKIP_COPIES, 1))])
+        self.ready = frames
+        self.ready_pos = 0
+        self.group_id = self.jump
+        self.jump = None
+        return self.drain_ready(out_buf, produced)
+
+    def handle_nack(self, msg):
+        """Queues the slots of a NACK PDU for resending (message thread)."""
+        if self.retransmit is None:
+            return
+        try:
+            group_ids, slot_ids = nack_entries(msg)
+        except ValueError as e:
+            sys.stderr.write(f"\n[TX] Ignoring NACK: {e}\n")
+            return
+        self.nack_rx += len(group_ids)
+        self.repairs.append((group_ids, slot_ids))
+
+    def send_repairs(self, out_buf, produced, space):
+        """Resends queued NACKed frames, at most 'space'. Returns the new produced."""
+        while self.repairs and space > 0:
+            group_ids, slot_ids = self.repairs.popleft()
+            if len(group_ids) > space:
+                self.repairs.appendleft((group_ids[space:], slot_ids[space:]))
+                group_ids, slot_ids = group_ids[:space], slot_ids[:space]
+            frames = self.retransmit.lookup(group_ids, slot_ids)
+            out_buf[produced:produced + len(frames)] = frames
+            produced += len(frames)
+            space -= len(frames)
+            self.repair_tx += len(frames)
+            self.repair_miss += len(group_ids) - len(frames)
+        return produced
+
+    def interleave(self, frames):
+        """
+        Reorders the frames of up to interleave_depth consecutive groups
+        (natural order) slot by slot: slot 0 of every group, then slot 1, ...
+        """
+        span = self.parity_group_size + self.parity_count
+        rows = np.arange(len(frames))
+        return frames[np.lexsort((rows // span, rows % span))]
+
+    def drain_ready(self, out_buf, produced):
+        n = min(len(self.ready) - self.ready_pos, len(out_buf) - produced)
+        out_buf[produced:produced + n] = self.ready[self.ready_pos:self.ready_pos + n]
+        self.ready_pos += n
+        return produced + n
+
+    def interleaved_work(self, in_buf, out_buf, produced):
+        """
+        Frames input into the interleaver block; every full block of
+        interleave_depth groups (or the partial block at EOF) is interleaved and
+        sent. Returns (produced, input vectors used).
+        """
+        input_idx = 0
+        while self.ready_pos == len(self.ready) and produced < len(out_buf):
+            self.block_fill, used = self.data_work(in_buf[input_idx:], self.block, self.block_fill)
+            input_idx += used
+            if self.block_fill < len(self.block) and self.state == "DATA":
+                break # Block not full yet: wait for more input
+            self.ready = self.interleave(self.block[:self.block_fill])
+            self.ready_pos = 0
+            self.block_fill = 0
+            produced = self.drain_ready(out_buf, produced)
+            if self.state != "DATA":
+                break
+        return produced, input_idx
 
     def general_work(self, input_items, output_items):
         if self.state == "FINISHED":
             self.consume(0, len(input_items[0]))
             return -1
 
+        t0 = time.perf_counter()
         in_buf = input_items[0]
         out_buf = output_items[0]
         produced = 0
         input_idx = 0
-        
+
         if self.state == "TRAINING":
-            while self.training_count > 0 and produced < len(out_buf):
-                out_buf[produced, :] = np.frombuffer(self.make_packet([0]*10, 0x00), dtype=np.uint8)
-                produced += 1
-                self.training_count -= 1
-            if self.training_count == 0: 
+            n = min(self.training_count, len(out_buf) - produced)
+            out_buf[produced:produced + n] = self.training_frame
+            produced += n
+            self.training_count -= n
+            if self.training_count == 0:
                 self.state = "START"
                 self.start_count = 50 # Send multiple START packets for reliability
-                
-        if self.state == "START" and produced < len(out_buf):
-            while self.start_count > 0 and produced < len(out_buf):
-                # Start uses GroupID=0, SlotID=0
-                out_buf[produced, :] = np.frombuffer(self.make_packet([0xAA]*10, 0x02, 0, 0), dtype=np.uint8)
-                produced += 1
-                self.start_count -= 1
+
+        if self.state == "START" and self.start_frames is None and len(in_buf):
+            # Start uses GroupID=0; the content ID parts take turns like END
+            self.start_frames = self.make_control_frames(TYPE_START, self.find_content_id())
+
+        if self.state == "START" and self.start_frames is not None and produced < len(out_buf):
+            n = min(self.start_count, len(out_buf) - produced)
+            out_buf[produced:produced + n] = self.start_frames[(self.start_count - np.arange(n)) % len(self.start_frames)]
+            produced += n
+            self.start_count -= n
             if self.start_count == 0:
                 self.state = "DATA"
                 sys.stderr.write("\n[TX] Training/Start finished. Transmitting data...\n")
                 self.group_id = 1 # Start data from Group 1
                 self.slot_counter = 0
-                self.parity_buffer = bytearray(10) # Input is 10 bytes
-            
-        if self.state == "DATA":
-            while input_idx < len(in_buf) and produced < len(out_buf):
-                # Check if this input vector is the EOF sentinel
-                if in_buf[input_idx].tolist() == self.eof_sentinel:
-                    # Flush remaining parity for the current group
-                    if self.slot_counter > 0 and produced < len(out_buf):
-                        parity_payload = list(self.parity_buffer)
-                        out_buf[produced, :] = np.frombuffer(
-                            self.make_packet(parity_payload, 0x05, self.group_id, self.slot_counter),
-                            dtype=np.uint8
-                        )
-                        produced += 1
-                    self.state = "END"
-                    input_idx += 1
-                    break
-
-                # We need to potentially output PARITY packet if slot_counter == N
-                if self.slot_counter == self.parity_group_size:
-                    # Time to send PARITY
-                    parity_payload = list(self.parity_buffer)
-                    out_buf[produced, :] = np.frombuffer(
-                        self.make_packet(parity_payload, 0x05, self.group_id, self.slot_counter),
-                        dtype=np.uint8
-                    )
-                    produced += 1
-                    # Reset for next group
-                    self.slot_counter = 0
-                    self.group_id = (self.group_id + 1) % 255 # Wrap around
-                    if self.group_id == 0: self.group_id = 1 # Avoid 0 (reserved/training)
-                    self.parity_buffer = bytearray(10)
-                else:
-                    # Send DATA packet
-                    data = in_buf[input_idx].tolist()
+                self.group_rows[:] = 0
 
-                    # Update Parity
-                    for i in range(10):
-                        self.parity_buffer[i] ^= data[i]
+        if self.repairs and self.state in ("DATA", "END"):
+            # NACKed frames go out between new data
+            produced = self.send_repairs(out_buf, produced, (len(out_buf) - produced + 1) // 2)
 
-                    out_buf[produced, :] = np.frombuffer(
-                        self.make_packet(data, 0x01, self.group_id, self.slot_counter),
-                        dtype=np.uint8
-                    )
-                    produced += 1
-                    input_idx += 1
-                    self.slot_counter += 1
+        if self.ready_pos < len(self.ready):
+            # Interleaved frames still waiting for output space
+            produced = self.drain_ready(out_buf, produced)
+
+        if self.state == "DATA" and produced < len(out_buf):
+            # Data runs up to the next jump, and at most through the EOF vector
+            data = in_buf[:self.find_jump(len(in_buf))]
+            data = data[:self.find_eof(len(data))]
+            if self.jump is not None and len(data) and self.ready_pos == len(self.ready):
+                produced = self.apply_jump(out_buf, produced)
+            if self.jump is None: # Else the parity before the jump waits for output space
+                if self.interleave_depth > 1:
+                    produced, input_idx = self.interleaved_work(data, out_buf, produced)
+                else:
+                    produced, input_idx = self.data_work(data, out_buf, produced)
 
         if self.state == "END":
-            while self.end_count > 0 and produced < len(out_buf):
-                out_buf[produced, :] = np.frombuffer(self.make_packet([0x55]*10, 0x03), dtype=np.uint8)
-                produced += 1
-                self.end_count -= 1
-            if self.end_count == 0:
+            # The END packets (one per part of the byte count) take turns
+            n = min(self.end_count, len(out_buf) - produced)
+            out_buf[produced:produced + n] = self.end_frames[(self.end_count - np.arange(n)) % len(self.end_frames)]
+            produced += n
+            self.end_count -= n
+            if self.end_count == 0 and self.retransmit is not None:
+                sys.stderr.write("\n[TX] End signal sent. Answering NACKs...\n")
+                self.state = "LINGER"
+                self.idle = 0
+            elif self.end_count == 0:
                 sys.stderr.write("\n[TX] End signal sent. Transmission complete.\n")
                 self.state = "FINISHED"
 
-        if self.state == "FINISHED":
-            # Consume remaining sentinel vectors, produce nothing
+        if self.state == "LINGER":
+            # Repairs, or idle training frames while NACKs may still come
+            sent = produced
+            produced = self.send_repairs(out_buf, produced, len(out_buf) - produced)
+            if produced > sent:
+                self.idle = 0
+            n = min(self.arq_linger - self.idle, len(out_buf) - produced)
+            out_buf[produced:produced + n] = self.training_frame
+            produced += n
+            self.idle += n
+            if self.idle >= self.arq_linger:
+                sys.stderr.write("\n[TX] No more NACKs. Transmission complete.\n")
+                self.state = "FINISHED"
+
+        if self.state in ("LINGER", "FINISHED"):
+            # Consume whatever follows the transfer
             input_idx = len(in_buf)
-        
+
         self.consume(0, input_idx)
+        self.frames_tx += produced
+        self.work_latency.observe(time.perf_counter() - t0)
+        self.metrics.tick(force=self.state == "FINISHED")
         return produced
@@ -1,35 +1,70 @@
 
 import numpy as np
-from gnuradio import gr, digital, blocks
+from gnuradio import gr, digital, blocks, analog
 from .packet_decoder_continuous import packet_decoder_continuous
+from .packet_decoder_soft import packet_decoder_soft
 
 class packet_rx_continuous(gr.hier_block2):
     """
     Continuous Packet Receiver.
     Does not terminate flowgraph.
+    With soft=True the slicer is skipped: the soft symbols of the GFSK clock
+    recovery go to packet_decoder_soft (soft sync, soft FEC decoding and a
+    CRC-aided retry on the weakest bits).
+    With arq=True, groups the erasure code cannot recover are NACKed on the
+    "nack" message port, to be connected to the transmitter (see arq.py).
     """
-    def __init__(self, sync_word=0xDEADBEEF, samples_per_symbol=2, sensitivity=1.0):
+    def __init__(self, sync_word=0xDEADBEEF, samples_per_symbol=2, sensitivity=1.0,
+                 data_slots=4, parity_slots=1, reorder_window=4, interleave_depth=1,
+                 payload_len=10, metrics_port=0, profile=False, soft=False, arq=False, arq_groups=1024,
+                 arq_retry=1000, arq_tries=4):
         gr.hier_block2.__init__(
             self, "Packet RX (Continuous)",
             gr.io_signature(1, 1, np.dtype(np.complex64).itemsize), # Input: Complex
             gr.io_signature(1, 1, np.dtype(np.uint8).itemsize),     # Output: Bytes
         )
 
-        self.demod = digital.gfsk_demod(
-            samples_per_symbol=samples_per_symbol,
-            sensitivity=sensitivity,
-            gain_mu=0.175,
-            mu=0.5,
-            omega_relative_limit=0.005,
-            freq_error=0.0,
-            verbose=False,
-            log=False
-        )
-        
-        self.packer = blocks.pack_k_bits_bb(8)
-        self.decoder = packet_decoder_continuous(sync_word)
-        
-        self.connect(self, self.demod)
-        self.connect(self.demod, self.packer)
-        self.connect(self.packer, self.decoder)
+        if soft:
+            # gfsk_demod without its slicer: FM discriminator + M&M clock recovery
+            gain_mu = 0.175
+            self.fmdemod = analog.quadrature_demod_cf(1.0 / sensitivity)
+            self.clock_recovery = digital.clock_recovery_mm_ff(
+                samples_per_symbol, 0.25 * gain_mu * gain_mu, 0.5, gain_mu, 0.005)
+            self.decoder = packet_decoder_soft(sync_word, data_slots, parity_slots,
+                                               reorder_window, interleave_depth, payload_len, metrics_port,
+                                               profile, arq=arq, arq_retry=arq_retry, arq_tries=arq_tries,
+                                               arq_groups=arq_groups)
+            # The decoder needs one whole frame (one float per bit) in its input buffer
+            self.clock_recovery.set_min_output_buffer(2 * self.decoder.frame_bits)
+
+            self.connect(self, self.fmdemod)
+            self.connect(self.fmdemod, self.clock_recovery)
+            self.connect(self.clock_recovery, self.decoder)
+        else:
+            self.demod = digital.gfsk_demod(
+                samples_per_symbol=samples_per_symbol,
+                sensitivity=sensitivity,
+                gain_mu=0.175,
+                mu=0.5,
+                omega_relative_limit=0.005,
+                freq_error=0.0,
+                verbose=False,
+                log=False
+            )
+
+            self.packer = blocks.pack_k_bits_bb(8)
+            self.decoder = packet_decoder_continuous(sync_word, data_slots, parity_slots,
+                                                     reorder_window, interleave_depth, payload_len, metrics_port,
+                                                     profile, arq, arq_retry, arq_tries, arq_groups)
+
+            self.connect(self, self.demod)
+            self.connect(self.demod, self.packer)
+            self.connect(self.packer, self.decoder)
         self.connect(self.decoder, self)
+
+        # Decoder metrics snapshots (see metrics.py)
+        self.message_port_register_hier_out("metrics")
+        self.msg_connect(self.decoder, "metrics", self, "metrics")
+        # NACKs for the transmitter (closed-loop ARQ)
+        self.message_port_register_hier_out("nack")
+        self.msg_connect(self.decoder, "nack", self, "nack")
@@ -7,17 +7,23 @@ class packet_tx_continuous(gr.hier_block2):
     """
     Continuous Packet Transmitter.
     Does not terminate flowgraph.
+    With arq=True, NACKs on the "nack" message port (from packet_rx_continuous)
+    make the encoder resend lost data frames (see arq.py).
     """
-    def __init__(self, preamble=0xAAAAAAAA, sync_word=0xDEADBEEF, samples_per_symbol=2, sensitivity=1.0, bt=0.35):
+    def __init__(self, preamble=0xAAAAAAAA, sync_word=0xDEADBEEF, samples_per_symbol=2, sensitivity=1.0, bt=0.35,
+                 data_slots=4, parity_slots=1, interleave_depth=1, payload_len=10, short_preamble=0,
+                 fec="hamming74", metrics_port=0, profile=False, arq=False, arq_groups=1024, arq_linger=5000):
         gr.hier_block2.__init__(
             self, "Packet TX (Continuous)",
             gr.io_signature(1, 1, np.dtype(np.uint8).itemsize), # Input: Bytes
             gr.io_signature(1, 1, np.dtype(np.complex64).itemsize), # Output: Complex
         )
 
-        self.encoder = packet_encoder_continuous(preamble, sync_word)
-        self.s2v = blocks.stream_to_vector(np.dtype(np.uint8).itemsize, 10)
-        self.v2s = blocks.vector_to_stream(np.dtype(np.uint8).itemsize, 48)
+        self.encoder = packet_encoder_continuous(preamble, sync_word, data_slots, parity_slots,
+                                                 interleave_depth, payload_len, short_preamble, fec,
+                                                 metrics_port, profile, arq, arq_groups, arq_linger)
+        self.s2v = blocks.stream_to_vector(np.dtype(np.uint8).itemsize, payload_len)
+        self.v2s = blocks.vector_to_stream(np.dtype(np.uint8).itemsize, self.encoder.frame_len)
         
         self.mod = digital.gfsk_mod(
             samples_per_symbol=samples_per_symbol,
@@ -32,3 +38,10 @@ class packet_tx_continuous(gr.hier_block2):
         self.connect(self.encoder, self.v2s)
         self.connect(self.v2s, self.mod)
         self.connect(self.mod, self)
+
+        # Encoder metrics snapshots (see metrics.py)
+        self.message_port_register_hier_out("metrics")
+        self.msg_connect(self.encoder, "metrics", self, "metrics")
+        # NACKs of the receiver (closed-loop ARQ)
+        self.message_port_register_hier_in("nack")
+        self.msg_connect(self, "nack", self.encoder, "nack")
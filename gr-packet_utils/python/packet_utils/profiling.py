@@ -0,0 +1,173 @@
+"""
+Opt-in per-stage profiling of the packet_utils blocks.
+
+Profiling is enabled per block with profile=True, or for every block with the
+environment variable PACKET_UTILS_PROFILE (1 = on; any other value is the
+directory for the trace files). When enabled, instrument() replaces
+general_work and the named internal stages of one block instance with timed
+wrappers; when it is off nothing is wrapped and the hot path is untouched.
+
+Per stage it records calls, total and max time. Per general_work call it also
+records the items available on the input (buffer occupancy), the output
+space, and the items consumed and produced. At stop() the block prints a
+summary table and writes <dir>/packet_utils_<block>.trace.json in the Chrome
+trace event format (open in chrome://tracing or https://ui.perfetto.dev).
+"""
+import json
+import os
+import sys
+import threading
+import time
+
+PROFILE_ENV = "PACKET_UTILS_PROFILE"
+MAX_TRACE_EVENTS = 200000 # Per block; later events only go into the summary
+
+def profile_dir(profile=False):
+    """Trace directory when profiling is on for a block, None when it is off."""
+    env = os.environ.get(PROFILE_ENV, "")
+    if env.lower() in ("", "0", "false", "no", "off"):
+        return "." if profile else None
+    return "." if env.lower() in ("1", "true", "yes", "on") else env
+
+class Profiler:
+    """Per-stage timers and trace events of one block instance."""
+    def __init__(self, name, trace_dir="."):
+        self.name = name
+        self.trace_dir = trace_dir
+        self.stats = {} # stage -> [calls, total s, max s, items]
+        self.io = [0, 0, 0, 0, 0, 0] # work calls, input, max input, output space, consumed, produced
+        self.events = []
+        self.dropped_events = 0
+        self.t0 = time.perf_counter()
+
+    def record(self, stage, start, items=None):
+        """Records one call of 'stage' that began at perf_counter() 'start'."""
+        end = time.perf_counter()
+        dur = end - start
+        s = self.stats.get(stage)
+        if s is None:
+            s = self.stats[stage] = [0, 0.0, 0.0, 0]
+        s[0] += 1
+        s[1] += dur
+        if dur > s[2]:
+            s[2] = dur
+        if items is not None:
+            s[3] += items
+        if len(self.events) < MAX_TRACE_EVENTS:
+            self.events.append((stage, start, dur, threading.get_ident(), items))
+        else:
+            self.dropped_events += 1
+
+    def wrap(self, fn, stage):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.record(stage, start)
+        return timed
+
+    def wrap_work(self, block):
+        """Times block.general_work and counts the items it sees, consumes and produces."""
+        work = block.general_work
+        consume = block.consume
+        consumed = [0]
+
+        def counting_consume(port, n):
+            if port == 0:
+                consumed[0] += n
+            return consume(port, n)
+
+        def timed_work(input_items, output_items):
+            consumed[0] = 0
+            start = time.perf_counter()
+            produced = work(input_items, output_items)
+            n_in = len(input_items[0]) if len(input_items) else 0
+            io = self.io
+            io[0] += 1
+            io[1] += n_in
+            io[2] = max(io[2], n_in)
+            io[3] += len(output_items[0]) if len(output_items) else 0
+            io[4] += consumed[0]
+            io[5] += max(produced, 0)
+            self.record("general_work", start, max(produced, 0))
+            return produced
+
+        block.consume = counting_consume
+        block.general_work = timed_work
+
+    def summary(self):
+        """
+        Summary table as a string (stages sorted by total time). '% wall' is
+        the share of the block's lifetime spent in a stage (its thread's load).
+        """
+        wall = max(time.perf_counter() - self.t0, 1e-12)
+        lines = [f"[Profile] {self.name}: {wall:.2f} s wall",
+                 f"  {'stage':<32} {'calls':>9} {'total ms':>10} {'mean us':>9} {'max us':>9} {'% wall':>7}"]
+        for stage, (calls, total, peak, _) in sorted(self.stats.items(), key=lambda kv: -kv[1][1]):
+            lines.append(f"  {stage:<32} {calls:>9} {total * 1e3:>10.1f} {total / calls * 1e6:>9.1f} "
+                         f"{peak * 1e6:>9.1f} {100 * total / wall:>6.1f}%")
+        calls, n_in, max_in, space, consumed, produced = self.io
+        if calls:
+            lines.append(f"  per work call: input {n_in / calls:.0f} items (max {max_in}), "
+                         f"output space {space / calls:.0f}, consumed {consumed / calls:.1f}, "
+                         f"produced {produced / calls:.1f}")
+        if self.dropped_events:
+            lines.append(f"  ({self.dropped_events} trace events over the {MAX_TRACE_EVENTS} limit not traced)")
+        return "\n".join(lines)
+
+    def trace(self):
+        """Chrome trace event dict (complete events, microseconds)."""
+        pid = os.getpid()
+        events = []
+        for stage, start, dur, tid, items in self.events:
+            event = {"name": stage, "cat": self.name, "ph": "X", "pid": pid, "tid": tid,
+                     "ts": (start - self.t0) * 1e6, "dur": dur * 1e6}
+            if items is not None:
+                event["args"] = {"items": items}
+            events.append(event)
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def report(self):
+        """Prints the summary and writes the trace file (called from the block's stop())."""
+        sys.stderr.write(self.summary() + "\n")
+        if self.trace_dir is None:
+            return None
+        path = os.path.join(self.trace_dir, f"packet_utils_{self.name}.trace.json")
+        try:
+            os.makedirs(self.trace_dir, exist_ok=True)
+            with open(path, "w") as f:
+                json.dump(self.trace(), f)
+        except OSError as e:
+            sys.stderr.write(f"[Profile] Could not write {path}: {e}\n")
+            return None
+        sys.stderr.write(f"[Profile] Trace written to {path}\n")
+        return path
+
+def _resolve(obj, path):
+    *parents, attr = path.split(".")
+    for p in parents:
+        obj = getattr(obj, p)
+    return obj, attr
+
+_next_index = {}
+_index_lock = threading.Lock()
+
+def instrument(block, kind, stages=(), profile=False):
+    """
+    Wraps block.general_work and the (dotted) attribute paths in 'stages'
+    with timers when profiling is on for this block. Returns the Profiler
+    (named '<kind><n>'), or None when profiling is off.
+    """
+    trace_dir = profile_dir(profile)
+    if trace_dir is None:
+        return None
+    with _index_lock:
+        index = _next_index.get(kind, 0)
+        _next_index[kind] = index + 1
+    profiler = Profiler(f"{kind}{index}", trace_dir)
+    for path in stages:
+        obj, attr = _resolve(block, path)
+        setattr(obj, attr, profiler.wrap(getattr(obj, attr), path))
+    profiler.wrap_work(block)
+    return profiler
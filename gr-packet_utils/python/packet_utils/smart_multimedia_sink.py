@@ -1,7 +1,61 @@
 import numpy as np
 from gnuradio import gr
+import pmt
 import os
 import lzma
+import mmap
+import time
+import queue
+import bisect
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .lzma_chunks import CHUNK_SIGNATURE, ChunkParser
+from .modem import EOF_TAG, OFFSET_TAG, CONTENT_TAG
+from .checkpoint import Checkpoint, SUFFIX as CHECKPOINT_SUFFIX
+from .metrics import BlockMetrics, flatten, start_http_server
+from .profiling import instrument
+
+PREALLOC_STEP = 64 * 1024 * 1024 # Random-access output files grow in steps of this size
+CHECKPOINT_INTERVAL = 10.0 # Seconds between resume checkpoints while data arrives
+
+class ReceivedRanges:
+    """
+    Received byte ranges of a transfer, kept as sorted, merged [start, end)
+    intervals: one entry per contiguous run instead of one bit per byte.
+    """
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+
+    def add(self, start, end):
+        """Marks [start, end) as received (merged with touching ranges)."""
+        if end <= start:
+            return
+        i = bisect.bisect_left(self.ends, start)
+        j = bisect.bisect_right(self.starts, end)
+        if i < j:
+            start = min(start, self.starts[i])
+            end = max(end, self.ends[j - 1])
+        self.starts[i:j] = [start]
+        self.ends[i:j] = [end]
+
+    def total(self):
+        return sum(e - s for s, e in zip(self.starts, self.ends))
+
+    def gaps(self, length=None):
+        """Missing [start, end) ranges before 'length' (default: the end of the last range)."""
+        length = self.ends[-1] if length is None and self.ends else length or 0
+        gaps = []
+        pos = 0
+        for s, e in zip(self.starts, self.ends):
+            if s >= length:
+                break
+            if s > pos:
+                gaps.append((pos, s))
+            pos = e
+        if pos < length:
+            gaps.append((pos, length))
+        return gaps
 
 class smart_multimedia_sink(gr.basic_block):
     """
@@ -10,8 +64,37 @@ class smart_multimedia_sink(gr.basic_block):
     - VID\x00 -> Save as .ts (Video)
     - IMG\x00 -> Save as .jpg (Image)
     - FIL\x00 -> Decompress LZMA and Save (General File)
+    - FLP\x00 -> Decompress LZMA chunks in parallel, each written at its offset
+
+    Writing and decompression run on a dedicated writer thread fed through a
+    bounded queue, so slow storage never stalls the scheduler thread. Queued
+    chunks are coalesced into large writes; the file is flushed every
+    flush_interval seconds and fsync'd per fsync_policy ("none", "interval"
+    or "close").
+
+    The decoder tags the last byte of a transfer with its exact length
+    (EOF_TAG): anything after it is dropped, and stop() reports whether the
+    whole transfer arrived. Where data was lost the decoder tags the next byte
+    with its offset (OFFSET_TAG); with random_access=True video and images are
+    written at their offsets into an output file that is grown in 64 MB steps
+    (memory-mapped with use_mmap=True) and cut to size at stop, so a lost group
+    leaves a hole of the same size instead of shifting the rest of the file.
+    Received ranges are tracked in a ReceivedRanges map. Compressed files are
+    written in order either way (they cannot be decoded past a gap).
+
+    With resume=True, random-access transfers are checkpointed to
+    <filename>.resume (which groups are on disk, keyed by the content ID of
+    the START packets; see checkpoint.py) every 10 s and at stop. Handing that
+    file to the Smart Source (resume=...) resends only the missing groups;
+    when their content ID matches, they are written into the existing file,
+    and the checkpoint is deleted once the file is complete.
+
+    Progress and writer statistics are published as metrics (see metrics.py)
+    on the "metrics" message port and, with metrics_port, over HTTP.
     """
-    def __init__(self, filename):
+    def __init__(self, filename, decompress_threads=0, queue_size=256, flush_interval=1.0,
+                 fsync_policy="close", metrics_port=0, profile=False, random_access=True, use_mmap=False,
+                 resume=True):
         gr.basic_block.__init__(
             self,
             name="smart_multimedia_sink",
@@ -24,8 +107,73 @@ class smart_multimedia_sink(gr.basic_block):
         self.header_buf = b""
         self.lzma_decompressor = None
         self.bytes_written = 0
+        self.decompress_threads = decompress_threads or os.cpu_count() or 1
+        self.chunk_parser = None
+        self.chunk_pool = None
+        self.pending_chunks = []
+        self.eof_key = pmt.intern(EOF_TAG)
+        self.offset_key = pmt.intern(OFFSET_TAG)
+        self.bytes_in = 0 # Stream bytes received, signature included
+        self.expected_len = None # From the EOF tag
+        self.stream_pos = 0 # Transfer offset of the next input byte
+        self.received = ReceivedRanges()
 
-    def setup_sink(self, sig):
+        # Random-access output (raw streams only)
+        self.random_access = random_access
+        self.use_mmap = use_mmap
+        self.file_size = 0 # Preallocated size (0 = written sequentially)
+        self.data_end = 0
+        self.map = None
+
+        # Resume checkpoints (raw streams written at their offsets only)
+        self.resume = resume
+        self.checkpoint_path = filename + CHECKPOINT_SUFFIX
+        self.content_key = pmt.intern(CONTENT_TAG)
+        self.content_id = None # From the decoder's content tag
+        self.group_bytes = 0
+        self.actual_name = None
+        self.written = ReceivedRanges() # Transfer ranges handed to the file (writer thread)
+        self.last_checkpoint = 0.0
+
+        # Writer thread
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.flush_interval = flush_interval
+        self.fsync_policy = fsync_policy
+        self.coalesce_bytes = 1024 * 1024
+        self.writer = None
+        self.writer_error = None
+
+        # Backpressure statistics
+        self.queue_full_events = 0
+        self.blocked_time = 0.0
+        self.max_queue_depth = 0
+
+        # Runtime metrics, published every 2 s while data arrives
+        self.lost_chunks = 0
+        self.message_port_register_out(pmt.intern("metrics"))
+        self.metrics = BlockMetrics(
+            self, "sink", counters=("bytes_written", "queue_full_events", "lost_chunks"),
+            gauges=("queue_depth", "max_queue_depth", "blocked_time"), rates=("bytes_written",),
+            on_publish=self.publish_metrics)
+        self.write_latency = self.metrics.histogram("write")
+        if metrics_port:
+            start_http_server(metrics_port)
+
+        # Opt-in stage profiling (profile=True or PACKET_UTILS_PROFILE), reported at stop()
+        self.profiler = instrument(self, "sink", ("enqueue", "process_payload", "write_chunk", "reap_chunks"),
+                                   profile)
+
+    @property
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def publish_metrics(self, snapshot):
+        self.message_port_pub(pmt.intern("metrics"), pmt.to_pmt(flatten(snapshot)))
+        if self.file:
+            print(f"[Smart Sink] Progress: {self.bytes_written/1024:.1f} KB "
+                  f"({snapshot['rates']['bytes_written']/1024:.1f} KB/s)")
+
+    def setup_sink(self, sig, checkpoint=None):
         # Determine actual filename extension
         base, ext = os.path.splitext(self.filename)
         actual_name = self.filename
@@ -42,49 +190,279 @@ class smart_multimedia_sink(gr.basic_block):
             self.mode = "LZMA"
             self.lzma_decompressor = lzma.LZMADecompressor()
             print(f"[Smart Sink] Mode: COMPRESSED FILE. Decompressing to {actual_name}")
+        elif sig == CHUNK_SIGNATURE:
+            self.mode = "LZMA_CHUNKED"
+            self.chunk_parser = ChunkParser()
+            self.chunk_pool = ThreadPoolExecutor(max_workers=self.decompress_threads)
+            print(f"[Smart Sink] Mode: CHUNKED COMPRESSED FILE. Decompressing to {actual_name} "
+                  f"({self.decompress_threads} threads)")
         else:
             print(f"[Smart Sink] Unknown Signature: {sig}. Defaulting to Raw.")
             self.mode = "STREAM"
-        
-        self.file = open(actual_name, 'wb')
+        self.actual_name = actual_name
+        self.written.add(0, len(sig))
+
+        if checkpoint and checkpoint.filename == actual_name and os.path.exists(actual_name):
+            # Resumed transfer: keep what is on disk and fill in the missing groups
+            self.file = open(actual_name, 'r+b')
+            self.resize(os.fstat(self.file.fileno()).st_size)
+            for start, end in checkpoint.ranges():
+                self.received.add(start, end)
+                self.written.add(start, end)
+                self.data_end = max(self.data_end, end - 4)
+            print(f"[Smart Sink] Resuming {actual_name}: {self.received.total()} bytes already received.")
+            return
+        # A shared mapping needs a file opened for reading too
+        self.file = open(actual_name, 'w+b' if self.use_mmap else 'wb')
 
     def general_work(self, input_items, output_items):
+        n_in = len(input_items[0])
+        if not n_in: return 0
+        # The decoder tags the last byte of the transfer with its exact length
+        for tag in self.get_tags_in_window(0, 0, n_in, self.eof_key):
+            self.expected_len = pmt.to_uint64(tag.value)
+        # ... and its first byte with the content ID and group size
+        for tag in self.get_tags_in_window(0, 0, n_in, self.content_key):
+            self.content_id = pmt.to_uint64(pmt.car(tag.value))
+            self.group_bytes = pmt.to_uint64(pmt.cdr(tag.value))
         in_data = input_items[0].tobytes()
-        if not in_data: return 0
-        
-        ptr = 0
+
+        # Split the input where the decoder skipped lost data
+        start = 0
+        for tag in sorted(self.get_tags_in_window(0, 0, n_in, self.offset_key), key=lambda t: t.offset):
+            cut = int(tag.offset - self.nitems_read(0))
+            self.receive(in_data[start:cut])
+            self.stream_pos = pmt.to_uint64(tag.value)
+            start = cut
+        self.receive(in_data[start:])
+
+        self.consume(0, n_in)
+        self.metrics.tick()
+        return 0
+
+    def receive(self, data):
+        """Handles input bytes that continue the transfer at stream_pos."""
+        offset = self.stream_pos
+        if self.expected_len is not None:
+            # Nothing past the end of the transfer (alignment padding) is written
+            data = data[:max(self.expected_len - offset, 0)]
+        if not data:
+            return
+        self.stream_pos += len(data)
+        self.bytes_in += len(data)
+        self.received.add(offset, offset + len(data))
+
         # 1. Read Header
         if self.mode == "WAITING":
-            needed = 4 - len(self.header_buf)
-            chunk = in_data[:needed]
-            self.header_buf += chunk
-            ptr += len(chunk)
-            if len(self.header_buf) == 4:
-                self.setup_sink(self.header_buf)
-        
-        # 2. Process Data
-        payload = in_data[ptr:]
-        if payload and self.file:
-            if self.mode == "STREAM":
-                self.file.write(payload)
-                self.bytes_written += len(payload)
-            elif self.mode == "LZMA":
+            # A resumed transfer takes the signature from its checkpoint
+            checkpoint = self.find_checkpoint()
+            if checkpoint:
+                self.header_buf = checkpoint.signature
+            elif offset == len(self.header_buf):
+                chunk = data[:4 - offset]
+                self.header_buf += chunk
+                data = data[len(chunk):]
+                offset += len(chunk)
+            # Signature complete, or lost (the stream is then saved raw)
+            if checkpoint or len(self.header_buf) == 4 or offset > len(self.header_buf):
+                self.setup_sink(self.header_buf, checkpoint)
+                self.writer = threading.Thread(target=self.writer_loop, name="smart_sink_writer", daemon=True)
+                self.writer.start()
+
+        # 2. Hand the data to the writer thread (file offsets leave out the signature)
+        data = data[max(4 - offset, 0):]
+        if data and self.file:
+            self.enqueue((max(offset, 4) - 4, data))
+
+    @property
+    def checkpointing(self):
+        """Resume checkpoints are kept for raw streams written at their offsets."""
+        return (self.resume and self.content_id is not None and self.group_bytes > 0
+                and self.mode == "STREAM" and self.random_access and self.header_buf[:3] in (b"VID", b"IMG"))
+
+    def find_checkpoint(self):
+        """The checkpoint of an earlier, incomplete run of this transfer, if any."""
+        if not self.resume or self.content_id is None:
+            return None
+        checkpoint = Checkpoint.load(self.checkpoint_path)
+        if (checkpoint is None or checkpoint.content_id != self.content_id
+                or checkpoint.group_bytes != self.group_bytes or not self.random_access):
+            return None
+        return checkpoint
+
+    def save_checkpoint(self):
+        """Writes the groups on disk to the resume checkpoint (writer thread, or after it stopped)."""
+        try:
+            Checkpoint.from_ranges(self.content_id, self.group_bytes, self.written.starts, self.written.ends,
+                                   self.expected_len, signature=self.header_buf,
+                                   filename=self.actual_name).save(self.checkpoint_path)
+        except OSError as e:
+            print(f"[Smart Sink] Could not write checkpoint {self.checkpoint_path}: {e}")
+        self.last_checkpoint = time.monotonic()
+
+    def enqueue(self, payload):
+        try:
+            self.queue.put_nowait(payload)
+        except queue.Full:
+            # Backpressure: the writer is behind, block the scheduler until it catches up
+            self.queue_full_events += 1
+            t0 = time.monotonic()
+            self.queue.put(payload)
+            self.blocked_time += time.monotonic() - t0
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+
+    def writer_loop(self):
+        """Writer thread: drains the queue, coalescing chunks into large writes."""
+        last_flush = time.monotonic()
+        running = True
+        while running:
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = (0, b"")
+            batch = [] # [offset, chunks] runs of contiguous data
+            size = 0
+            while item is not None:
+                offset, data = item
+                if batch and batch[-1][0] + sum(map(len, batch[-1][1])) == offset:
+                    batch[-1][1].append(data)
+                else:
+                    batch.append((offset, [data]))
+                size += len(data)
+                if size >= self.coalesce_bytes:
+                    break
                 try:
-                    decompressed = self.lzma_decompressor.decompress(payload)
-                    if decompressed:
-                        self.file.write(decompressed)
-                        self.bytes_written += len(decompressed)
-                except lzma.LZMAError: pass
-            
-            self.file.flush()
-            if self.bytes_written % (1024*100) < len(payload):
-                print(f"[Smart Sink] Progress: {self.bytes_written/1024:.1f} KB")
-
-        self.consume(0, len(in_data))
-        return 0
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            if item is None:
+                running = False
+
+            try:
+                if size:
+                    t0 = time.perf_counter()
+                    for offset, chunks in batch:
+                        self.process_payload(offset, b"".join(chunks))
+                    self.write_latency.observe(time.perf_counter() - t0)
+                now = time.monotonic()
+                if not running or now - last_flush >= self.flush_interval:
+                    self.file.flush()
+                    if self.map is not None:
+                        self.map.flush()
+                    if self.fsync_policy == "interval":
+                        os.fsync(self.file.fileno())
+                    last_flush = now
+                    # Only data flushed to the file goes into the checkpoint
+                    if running and size and self.checkpointing and now - self.last_checkpoint >= CHECKPOINT_INTERVAL:
+                        self.save_checkpoint()
+            except Exception as e:
+                # Keep draining so the scheduler never blocks on a dead writer
+                if self.writer_error is None:
+                    print(f"[Smart Sink] Write Error: {e}")
+                self.writer_error = e
+
+    def process_payload(self, offset, payload):
+        if self.mode == "STREAM" and self.random_access:
+            self.write_at(offset, payload)
+            self.bytes_written += len(payload)
+            self.written.add(offset + 4, offset + 4 + len(payload))
+        elif self.mode == "STREAM":
+            self.file.write(payload)
+            self.bytes_written += len(payload)
+        elif self.mode == "LZMA":
+            try:
+                decompressed = self.lzma_decompressor.decompress(payload)
+                if decompressed:
+                    self.file.write(decompressed)
+                    self.bytes_written += len(decompressed)
+            except lzma.LZMAError: pass
+        elif self.mode == "LZMA_CHUNKED":
+            # The parser skips to the next chunk after a gap in the offsets
+            dropped = self.chunk_parser.dropped
+            for index, offset, comp in self.chunk_parser.feed(payload, offset):
+                self.pending_chunks.append(
+                    (index, self.chunk_pool.submit(self.write_chunk, offset, comp)))
+            self.lost_chunks += self.chunk_parser.dropped - dropped
+            self.reap_chunks(block=len(self.pending_chunks) > 4 * self.decompress_threads)
+
+    def write_at(self, offset, data):
+        """Writes raw stream data at its file offset, growing the preallocated file as needed."""
+        end = offset + len(data)
+        if end > self.file_size:
+            self.resize(-(-end // PREALLOC_STEP) * PREALLOC_STEP)
+        if self.map is not None:
+            self.map[offset:end] = data
+        else:
+            os.pwrite(self.file.fileno(), data, offset)
+        self.data_end = max(self.data_end, end)
+
+    def resize(self, size, remap=True):
+        """Sets the output file size (sparse); the mapping, if any, is renewed."""
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+            self.map = None
+        self.file.truncate(size)
+        self.file_size = size
+        if remap and self.use_mmap and size:
+            self.map = mmap.mmap(self.file.fileno(), size)
+
+    def write_chunk(self, offset, comp):
+        # Runs on the pool: lzma releases the GIL, pwrite is positional
+        raw = lzma.decompress(comp)
+        os.pwrite(self.file.fileno(), raw, offset)
+        return len(raw)
+
+    def reap_chunks(self, block=False):
+        """Collects finished chunks; with block=True waits for the oldest one."""
+        still_pending = []
+        for i, (index, fut) in enumerate(self.pending_chunks):
+            if not fut.done() and not (block and i == 0):
+                still_pending.append((index, fut))
+                continue
+            try:
+                self.bytes_written += fut.result()
+            except (lzma.LZMAError, OSError) as e:
+                self.lost_chunks += 1
+                print(f"[Smart Sink] Chunk {index} lost: {e}")
+        self.pending_chunks = still_pending
 
     def stop(self):
+        # Drain the queue and let the writer finish
+        if self.writer:
+            self.queue.put(None)
+            self.writer.join()
+            self.writer = None
+            if self.queue_full_events:
+                print(f"[Smart Sink] Writer backpressure: queue full {self.queue_full_events}x, "
+                      f"scheduler blocked {self.blocked_time:.2f} s, max depth {self.max_queue_depth}")
+        if self.chunk_pool:
+            for _, fut in self.pending_chunks:
+                fut.exception()
+            self.reap_chunks()
+            self.chunk_pool.shutdown()
         if self.file:
+            if self.file_size:
+                # Cut the preallocated file to the transfer length (or the last byte written)
+                size = self.expected_len - 4 if self.expected_len is not None else self.data_end
+                self.resize(max(size, 0), remap=False)
+            if self.fsync_policy in ("close", "interval"):
+                self.file.flush()
+                os.fsync(self.file.fileno())
             self.file.close()
+            self.file = None
             print(f"[Smart Sink] Finished. Total written: {self.bytes_written} bytes.")
+        gaps = self.received.gaps(self.expected_len)
+        if self.expected_len is not None and gaps:
+            print(f"[Smart Sink] Incomplete: received {self.received.total()} of {self.expected_len} bytes "
+                  f"({len(gaps)} gaps).")
+        if self.checkpointing:
+            if self.expected_len is None or gaps:
+                self.save_checkpoint()
+                print(f"[Smart Sink] Checkpoint saved to {self.checkpoint_path}; pass it to the "
+                      f"Smart Source as resume= to send only the missing data.")
+            elif os.path.exists(self.checkpoint_path):
+                os.remove(self.checkpoint_path)
+        if self.profiler:
+            self.profiler.report()
         return True
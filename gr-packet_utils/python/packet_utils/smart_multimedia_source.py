@@ -1,12 +1,121 @@
 import numpy as np
 from gnuradio import gr
+import pmt
 import os
 import subprocess
 import io
 import lzma
 from PIL import Image
 import mimetypes
-from .fec_utils import EOF_SENTINEL
+import threading
+import bisect
+import time
+from .modem import EOF_TAG, OFFSET_TAG, CONTENT_TAG
+from .transcode_cache import TranscodeCache, payload_key, content_id
+from .checkpoint import Checkpoint
+from .lzma_chunks import CHUNK_SIGNATURE, compress_chunks
+from .profiling import instrument
+
+class SegmentedPayload:
+    """
+    Read-only concatenation of byte buffers (bytes, mmap, ...).
+    Segments are never joined; copy_into() copies straight from them into
+    an output buffer.
+    """
+    def __init__(self, segments=()):
+        self.views = []
+        self.starts = []
+        self.length = 0
+        for seg in segments:
+            self.append(seg)
+
+    def append(self, seg):
+        view = np.frombuffer(seg, dtype=np.uint8)
+        if len(view):
+            self.starts.append(self.length)
+            self.views.append(view)
+            self.length += len(view)
+
+    def __len__(self):
+        return self.length
+
+    def copy_into(self, out, pos):
+        """Copies bytes [pos, pos + len(out)) into out. Returns the count copied."""
+        n = max(min(len(out), self.length - pos), 0)
+        i = bisect.bisect_right(self.starts, pos) - 1
+        done = 0
+        while done < n:
+            view = self.views[i]
+            off = pos + done - self.starts[i]
+            k = min(n - done, len(view) - off)
+            out[done:done + k] = view[off:off + k]
+            done += k
+            i += 1
+        return n
+
+class ByteRing:
+    """
+    Bounded single-producer / single-consumer byte ring buffer.
+    The producer blocks while the ring is full; the consumer never blocks
+    longer than its timeout.
+    """
+    def __init__(self, capacity=4 * 1024 * 1024):
+        self.buf = np.zeros(capacity, dtype=np.uint8)
+        self.capacity = capacity
+        self.read_pos = 0   # absolute byte counters
+        self.write_pos = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def write(self, data):
+        """Copies data in, waiting for space. Returns False if the ring was closed."""
+        data = np.frombuffer(data, dtype=np.uint8)
+        done = 0
+        while done < len(data):
+            with self.cond:
+                while not self.closed and self.write_pos - self.read_pos >= self.capacity:
+                    self.cond.wait()
+                if self.closed:
+                    return False
+                free = self.capacity - (self.write_pos - self.read_pos)
+                n = min(free, len(data) - done)
+                self._copy_in(data[done:done + n])
+                self.write_pos += n
+                done += n
+                self.cond.notify_all()
+        return True
+
+    def _copy_in(self, data):
+        start = self.write_pos % self.capacity
+        first = min(len(data), self.capacity - start)
+        self.buf[start:start + first] = data[:first]
+        self.buf[:len(data) - first] = data[first:]
+
+    def read_into(self, out, timeout=0.1, keep=0):
+        """
+        Copies up to len(out) bytes into out, leaving the last 'keep' bytes
+        in the ring until it is closed. Returns the count (0 on timeout).
+        """
+        with self.cond:
+            if self.write_pos - self.read_pos <= keep and not self.closed:
+                self.cond.wait(timeout)
+            n = min(len(out), max(self.write_pos - self.read_pos - (0 if self.closed else keep), 0))
+            start = self.read_pos % self.capacity
+            first = min(n, self.capacity - start)
+            out[:first] = self.buf[start:start + first]
+            out[first:n] = self.buf[:n - first]
+            self.read_pos += n
+            self.cond.notify_all()
+            return n
+
+    def eof(self):
+        with self.cond:
+            return self.closed and self.write_pos == self.read_pos
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
 
 class smart_multimedia_source(gr.basic_block):
     """
@@ -14,9 +123,26 @@ class smart_multimedia_source(gr.basic_block):
     Auto-detects file type and applies the best robust compression:
     - Video -> HEVC (H.265) + AAC
     - Image -> JPEG
-    - File  -> LZMA (XZ)
+    - File  -> LZMA (XZ); files larger than lzma_chunk_mb are split into
+      chunks compressed in parallel on lzma_threads threads (0 = all cores)
+
+    With streaming=True, video is transcoded on the fly: a background thread
+    feeds ffmpeg's output into a bounded ring buffer that general_work drains,
+    so transmission starts as soon as the first TS bytes are available.
+
+    With cache=True, prepared payloads are kept in an on-disk transcode cache
+    (see transcode_cache.py) and memory-mapped on later runs.
+
+    Every pass starts with a content ID tag that the encoder puts into the
+    START packets. With resume set to a Smart Sink checkpoint of the same
+    content (see checkpoint.py), only the groups the receiver is missing are
+    sent, each range starting with an offset tag. data_slots and payload_len
+    must match the Packet TX: the checkpoint is only used when its groups are
+    data_slots * payload_len bytes.
     """
-    def __init__(self, filename, repeat=False, video_bitrate="500k", image_quality=75):
+    def __init__(self, filename, repeat=False, video_bitrate="500k", image_quality=75, streaming=True,
+                 cache=True, cache_dir="", lzma_threads=0, lzma_chunk_mb=4, payload_len=10, profile=False,
+                 resume="", data_slots=4):
         gr.basic_block.__init__(
             self,
             name="smart_multimedia_source",
@@ -25,53 +151,210 @@ class smart_multimedia_source(gr.basic_block):
         )
         self.filename = filename
         self.repeat = repeat
-        self.data = b""
+        self.data = SegmentedPayload()
         self.ptr = 0
+        self.video_bitrate = video_bitrate
+        self.ring = None
+        self.process = None
+        self.stream_thread = None
+        self.cache = None
+        self.cache_key = None
+        self.lzma_threads = lzma_threads
+        self.lzma_chunk_size = int(lzma_chunk_mb * 1024 * 1024)
+        self.payload_len = payload_len # Encoder input vector size
+        self.data_slots = data_slots # Encoder group size k (a group is k * payload_len bytes)
+        self.eof_key = pmt.intern(EOF_TAG)
+        self.offset_key = pmt.intern(OFFSET_TAG)
+        self.content_key = pmt.intern(CONTENT_TAG)
+        self.content_id = None
+        self.ranges = [(0, 0)] # Payload byte ranges sent per pass
+        self.range_idx = 0
+        self.content_len = 0 # Exact payload bytes (EOF tag value)
+        self.stream_len = None # Same for a streamed transcode, set when it ends
+
+        # Opt-in stage profiling (profile=True or PACKET_UTILS_PROFILE), reported at stop();
+        # "ffmpeg read" is the time the streaming thread waits on the transcoder
+        self.profiler = instrument(self, "source", (
+            "process_video", "process_image", "process_general_file", "work_stream"), profile)
         
         if not os.path.exists(filename):
             print(f"[Smart Source] Error: {filename} not found.")
             return
 
         mime, _ = mimetypes.guess_type(filename)
-        
-        # 1. Detect and Process
         if mime and mime.startswith('video'):
-            self.process_video(filename, video_bitrate)
+            kind, params = "video", {"video_bitrate": video_bitrate}
         elif mime and mime.startswith('image'):
+            kind, params = "image", {"image_quality": image_quality}
+        else:
+            kind, params = "file", {"lzma_chunk_mb": lzma_chunk_mb}
+
+        # The payload key also identifies the transfer on air
+        key = payload_key(filename, kind, **params)
+        self.content_id = content_id(key)
+
+        # 1. Reuse a cached payload if this file was prepared before
+        if cache:
+            try:
+                self.cache = TranscodeCache(cache_dir or None)
+                self.cache_key = key
+                cached = self.cache.load(self.cache_key)
+                if cached: self.data = SegmentedPayload([cached])
+            except OSError as e:
+                print(f"[Smart Source] Cache disabled: {e}")
+                self.cache = None
+            if self.data:
+                print(f"[Smart Source] Using cached {kind} payload ({len(self.data)} bytes).")
+
+        # 2. Detect and Process
+        from_cache = bool(self.data)
+        if from_cache:
+            pass
+        elif kind == "video" and streaming and not resume:
+            self.start_video_stream(filename, video_bitrate)
+            return
+        elif kind == "video":
+            self.process_video(filename, video_bitrate)
+        elif kind == "image":
             self.process_image(filename, image_quality)
         else:
             self.process_general_file(filename)
 
-        # 2. Finalize and Pad
+        if self.data and self.cache and not from_cache:
+            try:
+                self.cache.store(self.cache_key, self.data.views)
+            except OSError as e:
+                print(f"[Smart Source] Could not cache payload: {e}")
+
+        # 3. Finalize and Pad
         if self.data:
-            # Align to 10 bytes for the encoder
-            align_pad = (10 - (len(self.data) % 10)) % 10
-            self.data += b"\x00" * align_pad
-            
-            # Add Large Flush Tail (4000 bytes)
-            # Smart Source flows through more buffers, so we add extra "lead-out"
-            self.data += b"\x00" * 4000
+            self.content_len = len(self.data)
+            self.data.append(self.trailer(self.content_len))
+            print(f"[Smart Source] Final Payload: {self.content_len} bytes (Ready for SDR)")
+            self.ranges = self.resume_ranges(resume) if resume else [(0, len(self.data))]
+            self.ptr = self.ranges[0][0]
 
-            # Append EOF sentinel (50 copies for reliability)
-            # The encoder recognizes this pattern and sends END packets
-            self.data += EOF_SENTINEL * 50
+    def resume_ranges(self, path):
+        """
+        Payload byte ranges the receiver is still missing according to its
+        checkpoint (group-aligned); the whole payload when the checkpoint does
+        not belong to this payload.
+        """
+        everything = [(0, len(self.data))]
+        cp = Checkpoint.load(path)
+        if cp is None:
+            print(f"[Smart Source] No checkpoint in {path}. Sending everything.")
+            return everything
+        if cp.content_id != self.content_id or cp.length not in (None, self.content_len):
+            print(f"[Smart Source] Checkpoint {path} is for different content. Sending everything.")
+            return everything
+        if cp.group_bytes != self.data_slots * self.payload_len:
+            print(f"[Smart Source] Checkpoint groups ({cp.group_bytes} bytes) do not match "
+                  f"data_slots {self.data_slots} x payload_len {self.payload_len}. Sending everything.")
+            return everything
+        ranges = cp.missing(len(self.data))
+        if not ranges:
+            # Nothing missing: the last group still goes out so the transfer ends with END
+            start = (len(self.data) - 1) // cp.group_bytes * cp.group_bytes
+            ranges = [(start, len(self.data))]
+        print(f"[Smart Source] Resuming: {sum(e - s for s, e in ranges)} of {len(self.data)} bytes "
+              f"in {len(ranges)} ranges.")
+        return ranges
 
-            print(f"[Smart Source] Final Payload with Flush Tail: {len(self.data)} bytes (Ready for SDR)")
+    def trailer(self, length):
+        # Align to the encoder's payload length (10 bytes by default); the exact
+        # length travels in the EOF tag, so the receiver drops this padding
+        L = self.payload_len
+        return b"\x00" * ((L - (length % L)) % L)
 
-    def process_video(self, filename, bitrate):
-        print(f"[Smart Source] Detected VIDEO. Transcoding to HEVC @ {bitrate}...")
-        cmd = [
+    def tag_eof(self, offset, length):
+        """
+        Marks the end of a transfer out of band: an EOF_TAG stream tag (value:
+        the exact byte count) on the first byte of the last encoder vector,
+        which stays on that vector through stream_to_vector. The encoder sends
+        END packets after it.
+        """
+        self.add_item_tag(0, offset, self.eof_key, pmt.from_uint64(length))
+
+    def video_command(self, filename, bitrate):
+        return [
             'ffmpeg', '-i', filename, '-y',
             '-c:v', 'libx265', '-preset', 'ultrafast', '-b:v', bitrate,
             '-c:a', 'aac', '-b:a', '64k',
             '-f', 'mpegts', 'pipe:1'
         ]
+
+    def start_video_stream(self, filename, bitrate):
+        print(f"[Smart Source] Detected VIDEO. Streaming HEVC transcode @ {bitrate}...")
+        self.ring = ByteRing()
+        self.stream_len = None
+        self.stream_thread = threading.Thread(target=self.stream_video, args=(filename, bitrate), daemon=True)
+        self.stream_thread.start()
+
+    def stream_video(self, filename, bitrate):
+        """Background thread: pipes ffmpeg output into the ring buffer."""
+        ring = self.ring
+        total = 0
+        complete = False
+        cached = None
+        try:
+            if self.cache:
+                cached = self.cache.writer(self.cache_key)
+        except OSError as e:
+            print(f"[Smart Source] Could not cache payload: {e}")
+        try:
+            cmd = self.video_command(filename, bitrate)
+            cmd[1:1] = ['-loglevel', 'error']
+            self.process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            # Signature: 'VID\x00', sent with the first transcoded bytes so a
+            # transcode that fails to start sends nothing
+            signature = b"VID\x00"
+            prof = self.profiler
+            while True:
+                t0 = time.perf_counter()
+                chunk = self.process.stdout.read1(65536)
+                if prof: prof.record("ffmpeg read", t0, len(chunk))
+                if not chunk:
+                    break
+                chunk, signature = signature + chunk, b""
+                if not ring.write(chunk):
+                    break
+                total += len(chunk)
+                if cached: cached.write(chunk)
+            err = self.process.stderr.read()
+            if self.process.wait() != 0 and not ring.closed:
+                print(f"[Smart Source] FFmpeg Error: {err.decode(errors='replace')}")
+            complete = self.process.returncode == 0 and not chunk
+            # Only a complete transcode goes into the cache
+            if cached and complete:
+                cached.commit()
+                cached = None
+        except Exception as e:
+            print(f"[Smart Source] Video Failed: {e}")
+        if cached:
+            cached.abort()
+
+        # The length is set before the padding goes in; work_stream holds the
+        # last vector back until the ring is closed and tags it then. A failed
+        # transcode gets no length (no EOF tag, no END packets), so the sink
+        # never sees it as a finished file.
+        if complete and total > 0:
+            self.stream_len = total
+            if ring.write(self.trailer(total)):
+                print(f"[Smart Source] Final Payload: {total} bytes (Streamed)")
+        elif total > 0 and not ring.closed:
+            print(f"[Smart Source] Transcode failed after {total} bytes; the transfer is not ended.")
+        ring.close()
+
+    def process_video(self, filename, bitrate):
+        print(f"[Smart Source] Detected VIDEO. Transcoding to HEVC @ {bitrate}...")
+        cmd = self.video_command(filename, bitrate)
         try:
             process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
             transcoded, err = process.communicate()
             if process.returncode == 0:
                 # Signature: 'VID\x00'
-                self.data = b"VID\x00" + transcoded
+                self.data = SegmentedPayload([b"VID\x00", transcoded])
             else:
                 print(f"[Smart Source] FFmpeg Error: {err.decode()}")
         except Exception as e:
@@ -85,29 +368,104 @@ class smart_multimedia_source(gr.basic_block):
             buf = io.BytesIO()
             img.save(buf, format='JPEG', quality=quality)
             # Signature: 'IMG\x00'
-            self.data = b"IMG\x00" + buf.getvalue()
+            self.data = SegmentedPayload([b"IMG\x00", buf.getbuffer()])
         except Exception as e:
             print(f"[Smart Source] Image Failed: {e}")
 
     def process_general_file(self, filename):
+        if os.path.getsize(filename) > self.lzma_chunk_size:
+            return self.process_general_file_chunked(filename)
         print(f"[Smart Source] Detected GENERAL FILE. Compressing with LZMA...")
         try:
             with open(filename, 'rb') as f:
                 raw = f.read()
             compressed = lzma.compress(raw)
             # Signature: 'FIL\x00'
-            self.data = b"FIL\x00" + compressed
+            self.data = SegmentedPayload([b"FIL\x00", compressed])
+        except Exception as e:
+            print(f"[Smart Source] File Failed: {e}")
+
+    def process_general_file_chunked(self, filename):
+        threads = self.lzma_threads or os.cpu_count()
+        print(f"[Smart Source] Detected LARGE FILE. Compressing with LZMA "
+              f"({self.lzma_chunk_size // 1024} KB chunks, {threads} threads)...")
+        try:
+            # Signature: 'FLP\x00' followed by framed chunks
+            data = SegmentedPayload([CHUNK_SIGNATURE])
+            with open(filename, 'rb') as f:
+                for header, chunk in compress_chunks(f, self.lzma_chunk_size, threads):
+                    data.append(header)
+                    data.append(chunk)
+            self.data = data
         except Exception as e:
             print(f"[Smart Source] File Failed: {e}")
 
     def general_work(self, input_items, output_items):
         out = output_items[0]
+        if self.ring is not None:
+            return self.work_stream(out)
         n = len(out)
-        remaining = len(self.data) - self.ptr
-        if remaining <= 0:
-            if self.repeat: self.ptr = 0; remaining = len(self.data)
-            else: return -1
-        n_out = min(n, remaining)
-        out[:n_out] = np.frombuffer(self.data[self.ptr : self.ptr + n_out], dtype=np.uint8)
-        self.ptr += n_out
+        n_out = 0
+        # Copy the ranges straight from the payload segments, wrapping around on repeat
+        while n_out < n and len(self.data) > 0:
+            begin, end = self.ranges[self.range_idx]
+            if self.ptr >= end:
+                if self.range_idx + 1 < len(self.ranges):
+                    self.range_idx += 1
+                elif not self.repeat: break
+                else: self.range_idx = 0
+                self.ptr = self.ranges[self.range_idx][0]
+                continue
+            start = self.ptr
+            item = self.nitems_written(0) + n_out
+            if start == begin:
+                # Every pass starts with the content ID, every skip with the new offset
+                if self.range_idx == 0:
+                    self.add_item_tag(0, item, self.content_key, pmt.from_uint64(self.content_id))
+                if begin > 0:
+                    self.add_item_tag(0, item, self.offset_key, pmt.from_uint64(begin))
+            copied = self.data.copy_into(out[n_out:n_out + end - start], start)
+            self.ptr += copied
+            # Every pass ends with an EOF tag
+            last = self.ranges[-1][1] - self.payload_len
+            if self.range_idx == len(self.ranges) - 1 and start <= last < self.ptr:
+                self.tag_eof(item + last - start, self.content_len)
+            n_out += copied
+        return n_out if n_out > 0 else -1
+
+    def work_stream(self, out):
+        ring = self.ring
+        start = ring.read_pos
+        # The last encoder vector stays in the ring until the transcode has
+        # ended, so it is still unread once its EOF tag can be placed
+        n_out = ring.read_into(out, keep=self.payload_len)
+        if start == 0 and n_out and self.content_id is not None:
+            self.add_item_tag(0, self.nitems_written(0), self.content_key, pmt.from_uint64(self.content_id))
+        if ring.closed and self.stream_len is not None:
+            last = ring.write_pos - self.payload_len
+            if start <= last < start + n_out:
+                self.tag_eof(self.nitems_written(0) + last - start, self.stream_len)
+        if n_out == 0 and ring.eof():
+            if not self.repeat: return -1
+            cached = self.cache.load(self.cache_key) if self.cache else None
+            if cached:
+                # Next passes come from the cache
+                self.ring = None
+                self.content_len = len(cached)
+                self.data = SegmentedPayload([cached, self.trailer(len(cached))])
+                self.ranges = [(0, len(self.data))]
+                self.range_idx = 0
+                self.ptr = 0
+            else:
+                # Transcode again for the next pass
+                self.start_video_stream(self.filename, self.video_bitrate)
         return n_out
+
+    def stop(self):
+        if self.ring is not None:
+            self.ring.close()
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+        if self.profiler:
+            self.profiler.report()
+        return True
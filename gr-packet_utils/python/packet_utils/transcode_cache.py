@@ -0,0 +1,177 @@
+"""
+On-disk cache of prepared Smart Source payloads.
+
+Transcoding (HEVC, JPEG) and LZMA compression of the same input file with the
+same parameters always gives the same payload, so the Smart Source stores it
+here and memory-maps it on the next run instead of transcoding again.
+
+Entries are keyed by the input file identity (absolute path, size, mtime) plus
+the transcoding parameters. The cache is bounded in size and evicts the least
+recently used entries first. The same key also names the payload on air: its
+first 63 bits are the content ID of resumable transfers (see checkpoint.py).
+
+Pre-warm from the command line:
+    python -m gnuradio.packet_utils.transcode_cache warm videos/1080p.mp4 --video-bitrate 500k
+"""
+import os
+import sys
+import mmap
+import json
+import hashlib
+import argparse
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "packet_utils")
+DEFAULT_MAX_MB = 4096
+
+def payload_key(filename, kind, **params):
+    """Hex SHA-256 of the input file identity and the transcoding parameters."""
+    st = os.stat(filename)
+    ident = {
+        "path": os.path.abspath(filename),
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "kind": kind,
+        "params": params,
+    }
+    return hashlib.sha256(json.dumps(ident, sort_keys=True).encode()).hexdigest()
+
+def content_id(key):
+    """64-bit content ID of a payload key (sent in the START packets, see checkpoint.py)."""
+    return int(key[:16], 16) >> 1 # Never UNKNOWN_VALUE (all ones)
+
+class TranscodeCache:
+    """Size-bounded LRU cache of payload files, memory-mapped on reuse."""
+    def __init__(self, cache_dir=None, max_mb=None):
+        self.cache_dir = cache_dir or os.environ.get("PACKET_UTILS_CACHE_DIR", DEFAULT_CACHE_DIR)
+        self.max_bytes = int(max_mb if max_mb is not None else
+                             os.environ.get("PACKET_UTILS_CACHE_MB", DEFAULT_MAX_MB)) * 1024 * 1024
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, filename, kind, **params):
+        return payload_key(filename, kind, **params)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + ".bin")
+
+    def load(self, key):
+        """Returns the cached payload as a read-only mmap, or None on a miss."""
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return None
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            os.utime(path) # Mark as recently used
+            return data
+        except OSError:
+            return None
+
+    def store(self, key, buffers):
+        """Stores the concatenation of 'buffers' under key."""
+        with self.writer(key) as w:
+            for buf in buffers:
+                w.write(buf)
+
+    def writer(self, key):
+        return CacheWriter(self, key)
+
+    def entries(self):
+        out = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".bin"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            out.append((st.st_mtime, st.st_size, name))
+        return out
+
+    def evict(self, keep=None):
+        """Deletes least recently used entries until the cache fits max_bytes."""
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            if keep and name == keep + ".bin":
+                continue
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+                total -= size
+            except OSError:
+                pass
+
+class CacheWriter:
+    """
+    Incrementally writes one cache entry (e.g. while streaming a transcode).
+    The entry only becomes visible on commit(); abort() discards it.
+    Used as a context manager it commits on success and aborts on error.
+    """
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        self.tmp_path = cache.path(key) + f".{os.getpid()}.tmp"
+        self.file = open(self.tmp_path, "wb")
+
+    def write(self, data):
+        self.file.write(data)
+
+    def commit(self):
+        self.file.close()
+        os.replace(self.tmp_path, self.cache.path(self.key))
+        self.cache.evict(keep=self.key)
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+        return False
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Smart Source transcode cache")
+    parser.add_argument("--cache-dir", default=None, help="cache directory (default: %s)" % DEFAULT_CACHE_DIR)
+    parser.add_argument("--max-mb", type=int, default=None, help="cache size bound in MB")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    warm = sub.add_parser("warm", help="prepare and cache payloads for the given files")
+    warm.add_argument("files", nargs="+")
+    warm.add_argument("--video-bitrate", default="500k")
+    warm.add_argument("--image-quality", type=int, default=75)
+
+    sub.add_parser("list", help="list cache entries")
+    sub.add_parser("clear", help="delete all cache entries")
+
+    args = parser.parse_args(argv)
+    cache = TranscodeCache(args.cache_dir, args.max_mb)
+
+    if args.command == "warm":
+        from .smart_multimedia_source import smart_multimedia_source
+        for filename in args.files:
+            smart_multimedia_source(filename, video_bitrate=args.video_bitrate,
+                                    image_quality=args.image_quality, streaming=False,
+                                    cache_dir=cache.cache_dir)
+        cache.evict()
+    elif args.command == "list":
+        entries = sorted(cache.entries(), reverse=True)
+        for _, size, name in entries:
+            print(f"{name}  {size / 1024:.1f} KB")
+        print(f"{len(entries)} entries, {sum(e[1] for e in entries) / 1024 / 1024:.1f} MB")
+    elif args.command == "clear":
+        for _, _, name in cache.entries():
+            os.remove(os.path.join(cache.cache_dir, name))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())